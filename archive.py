@@ -0,0 +1,229 @@
+# archive.py
+# Columnar archives of experiment results, for analysis across many runs.
+#
+# Each run becomes a directory of NumPy .npy columns plus a meta.json:
+#   outputs/archive/consolidated_14/
+#       meta.json             test id, kind, config hash, config, client names, column dtypes/shapes
+#       plate_history.npy     (T,) float64
+#       object_history.npy    (T,) float64
+#       client_plates.npy     (clients, T) float64, NaN-padded where a client has fewer values
+#       client_objects.npy    (clients, T) float64
+#   outputs/archive/objects_0/
+#       meta.json             ... plus "labels" and "object_ids" (the string tables for the integer columns below)
+#       client.npy, frame.npy, object.npy, label.npy   (N,) int32, one row per detection (object = -1 for list-style frames)
+#       score.npy             (N,) float32
+#       bounding_box.npy      (N,4) float32, NaN when the frame had no boxes
+#
+# Columns are opened with mmap, so querying every run only parses the small meta.json files.
+#
+#   python archive.py convert                               (convert everything in outputs/)
+#   python archive.py query plate_history                   (per-run stats of a column, over all archived runs)
+#   python archive.py query client_plates --config <hash>   (only runs with that config)
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
+import numpy as np
+
+archive_version = 1
+default_root = "outputs/archive"
+
+def configHash(config):
+    return hashlib.sha1(json.dumps(config,sort_keys=True).encode("utf-8")).hexdigest()[:12]
+
+def paddedSeries(series):
+    # List of lists -> (len(series), longest) float64 array, NaN-padded
+    width = max((len(values) for values in series),default=0)
+    table = np.full((len(series),width),np.nan)
+    for i,values in enumerate(series):
+        table[i,:len(values)] = values
+    return table
+
+def consolidatedColumns(data):
+    clients = sorted(data["client_reports"].keys())
+    columns = {
+        "plate_history":np.asarray(data["plate_history"],dtype=np.float64),
+        "object_history":np.asarray(data["object_history"],dtype=np.float64),
+        "client_plates":paddedSeries([data["client_reports"][name]["plates"] for name in clients]),
+        "client_objects":paddedSeries([data["client_reports"][name]["objects"] for name in clients]),
+    }
+    return columns,{"clients":clients}
+
+def objectColumns(data):
+    # Raw frames come in two shapes: a list of detections [{"class_name","score","bounding_box",...}, ...] from the
+    # vehicles' detectors, or {object_id:{label:score}} from the fusion clients. Both flatten to one row per detection
+    clients = sorted(data["raw_data"].keys())
+    labels = {}
+    object_ids = {}
+    rows = {"client":[],"frame":[],"object":[],"label":[],"score":[],"bounding_box":[]}
+    no_box = [np.nan] * 4
+    def addRow(client,frame,object_id,label,score,box):
+        rows["client"].append(client)
+        rows["frame"].append(frame)
+        rows["object"].append(object_id)
+        rows["label"].append(labels.setdefault(label,len(labels)))
+        rows["score"].append(score)
+        rows["bounding_box"].append(box)
+    for c,name in enumerate(clients):
+        for f,frame in enumerate(data["raw_data"][name]):
+            if isinstance(frame,dict):
+                for object_id,scores in frame.items():
+                    index = object_ids.setdefault(object_id,len(object_ids))
+                    for label,score in (scores or {}).items():
+                        addRow(c,f,index,label,score,no_box)
+            else:
+                for detection in frame or []:
+                    addRow(c,f,-1,detection.get("class_name"),detection.get("score",np.nan),detection.get("bounding_box",no_box))
+    columns = {
+        "client":np.asarray(rows["client"],dtype=np.int32),
+        "frame":np.asarray(rows["frame"],dtype=np.int32),
+        "object":np.asarray(rows["object"],dtype=np.int32),
+        "label":np.asarray(rows["label"],dtype=np.int32),
+        "score":np.asarray(rows["score"],dtype=np.float32),
+        "bounding_box":np.asarray(rows["bounding_box"],dtype=np.float32).reshape(-1,4),
+    }
+    extra = {
+        "clients":clients,
+        "labels":list(labels.keys()),
+        "object_ids":list(object_ids.keys()),
+        "object_locations":data.get("object_locations"),
+        "vehicle_locations":data.get("vehicle_locations"),
+    }
+    return columns,extra
+
+def exportRun(output_path,root=default_root,test_id=None):
+    # Converts one outputs/.../output_{id}.json file. Returns the run's archive directory
+    with open(output_path,"r") as output_file:
+        data = json.load(output_file)
+    if "raw_data" in data:
+        kind = "objects"
+        columns,extra = objectColumns(data)
+        test_id = data.get("test_id",test_id)
+    else:
+        kind = "consolidated"
+        columns,extra = consolidatedColumns(data)
+    if test_id == None:
+        # outputs/output_14.json -> 14
+        test_id = os.path.splitext(os.path.basename(output_path))[0].split("_",1)[-1]
+    config = data.get("config") or {}
+    meta = {
+        "archive_version":archive_version,
+        "test_id":str(test_id),
+        "kind":kind,
+        "source":output_path,
+        "config_hash":configHash(config),
+        "config":config,
+        "columns":{name:{"dtype":str(column.dtype),"shape":list(column.shape)} for name,column in columns.items()},
+    }
+    meta.update(extra)
+    # Write into a scratch directory and swap it in, so a half-written run is never visible to readers
+    run_dir = os.path.join(root,f"{kind}_{test_id}")
+    scratch_dir = run_dir + ".tmp"
+    shutil.rmtree(scratch_dir,ignore_errors=True)
+    os.makedirs(scratch_dir)
+    for name,column in columns.items():
+        np.save(os.path.join(scratch_dir,name + ".npy"),column)
+    with open(os.path.join(scratch_dir,"meta.json"),"w") as meta_file:
+        json.dump(meta,meta_file)
+    shutil.rmtree(run_dir,ignore_errors=True)
+    os.replace(scratch_dir,run_dir)
+    return run_dir
+
+def convertAll(outputs_dir="outputs",root=default_root,skip_existing=True):
+    # Bulk conversion of outputs/output_*.json and outputs/objects/output_*.json. Returns the run directories written
+    written = []
+    paths = sorted(glob.glob(os.path.join(outputs_dir,"output_*.json"))) + sorted(glob.glob(os.path.join(outputs_dir,"objects","output_*.json")))
+    for path in paths:
+        kind = "objects" if os.path.basename(os.path.dirname(path)) == "objects" else "consolidated"
+        test_id = os.path.splitext(os.path.basename(path))[0].split("_",1)[-1]
+        meta_path = os.path.join(root,f"{kind}_{test_id}","meta.json")
+        if skip_existing and os.path.exists(meta_path) and os.path.getmtime(meta_path) >= os.path.getmtime(path):
+            continue
+        try:
+            written.append(exportRun(path,root))
+        except (ValueError,KeyError,TypeError) as e:
+            print(f"Skipping {path}: {e}")
+    return written
+
+class Run:
+    # One archived run. Columns are memory-mapped on first use: run["plate_history"], run.series("alice","client_plates")
+    def __init__(self,run_dir):
+        self.dir = run_dir
+        with open(os.path.join(run_dir,"meta.json"),"r") as meta_file:
+            self.meta = json.load(meta_file)
+        self.test_id = self.meta["test_id"]
+        self.kind = self.meta["kind"]
+        self.config_hash = self.meta["config_hash"]
+        self.clients = self.meta["clients"]
+        self.columns = {}
+
+    def __getitem__(self,name):
+        if name not in self.columns:
+            if name not in self.meta["columns"]:
+                raise KeyError(f"{self.dir} has no column {name}")
+            self.columns[name] = np.load(os.path.join(self.dir,name + ".npy"),mmap_mode="r")
+        return self.columns[name]
+
+    def series(self,client_name,column="client_plates"):
+        # One client's values, without the NaN padding
+        values = self[column][self.clients.index(client_name)]
+        return values[~np.isnan(values)]
+
+    def __repr__(self):
+        return f"Run({self.kind} {self.test_id}, config {self.config_hash}, {len(self.clients)} clients)"
+
+def openRuns(root=default_root,kind=None,config_hash=None,test_ids=None):
+    # Every archived run matching the filters, ordered by test id. Only meta.json is read here
+    runs = []
+    for meta_path in glob.glob(os.path.join(root,"*","meta.json")):
+        run = Run(os.path.dirname(meta_path))
+        if kind != None and run.kind != kind:
+            continue
+        if config_hash != None and run.config_hash != config_hash:
+            continue
+        if test_ids != None and str(run.test_id) not in {str(test_id) for test_id in test_ids}:
+            continue
+        runs.append(run)
+    runs.sort(key=lambda run: (run.kind,int(run.test_id) if str(run.test_id).isdigit() else float("inf"),str(run.test_id)))
+    return runs
+
+def query(column,root=default_root,kind=None,config_hash=None,test_ids=None):
+    # {test_id: memory-mapped column} for every matching run that has the column
+    return {run.test_id:run[column] for run in openRuns(root,kind,config_hash,test_ids) if column in run.meta["columns"]}
+
+def main():
+    parser = argparse.ArgumentParser(description="Columnar experiment archives")
+    commands = parser.add_subparsers(dest="command",required=True)
+    convert_parser = commands.add_parser("convert",help="Convert output JSON files into archives")
+    convert_parser.add_argument("paths",nargs="*",help="Output files to convert (default: everything in outputs/)")
+    convert_parser.add_argument("--root",default=default_root)
+    convert_parser.add_argument("--force",action="store_true",help="Re-convert runs that are already archived")
+    query_parser = commands.add_parser("query",help="Per-run statistics of one column")
+    query_parser.add_argument("column")
+    query_parser.add_argument("--root",default=default_root)
+    query_parser.add_argument("--kind",choices=["consolidated","objects"],default=None)
+    query_parser.add_argument("--config",default=None,help="Only runs with this config hash")
+    query_parser.add_argument("--ids",nargs="*",default=None,help="Only these test ids")
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        if len(args.paths) > 0:
+            written = [exportRun(path,args.root) for path in args.paths]
+        else:
+            written = convertAll(root=args.root,skip_existing=not args.force)
+        print(f"Archived {len(written)} runs in {args.root}")
+        return
+
+    print(f"{'run':>20} {'config':>14} {'count':>8} {'mean':>8} {'std':>8}")
+    for run in openRuns(args.root,args.kind,args.config,args.ids):
+        if args.column not in run.meta["columns"]:
+            continue
+        values = np.asarray(run[args.column],dtype=np.float64)
+        count = np.count_nonzero(~np.isnan(values))
+        mean,std = (np.nanmean(values),np.nanstd(values)) if count > 0 else (np.nan,np.nan)
+        print(f"{run.kind + ' ' + str(run.test_id):>20} {run.config_hash:>14} {count:>8} {mean:>8.4f} {std:>8.4f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# benchmarks/plate_assignment.py
+# Compares the greedy parseStack assignment with the optimal assignment engine:
+#  - accuracy against the true occupants, on noisy plate positions around a real lot layout
+#  - time per verdict as the number of plates and spots grows, on a lot layout (where most plates' nearest spots
+#    differ, so assignPlates rarely needs the solver) and on random cost matrices (the solver's worst case)
+# Run from the repository root: python -m benchmarks.plate_assignment
+import argparse
+import json
+import time
+import numpy as np
+from plate_assignment import assignPlates, parseStack, solveAssignment, linear_sum_assignment
+
+def greedy(plates,spots):
+    taken_spots = [{'position':{'x':x,'y':y},'plate':None} for x,y in spots]
+    parseStack([list(plate) for plate in plates],taken_spots)
+    return [spot['plate'] for spot in taken_spots]
+
+def makeRound(spots,occupancy,noise,rng):
+    # One verdict's worth of averaged plate positions: each occupied spot's plate, seen with some position error
+    truth = [None] * len(spots)
+    plates = []
+    for i in np.flatnonzero(rng.random(len(spots)) < occupancy):
+        truth[i] = f"PLATE{i}"
+        plates.append([truth[i],spots[i,0] + rng.normal(0,noise),spots[i,1] + rng.normal(0,noise)])
+    rng.shuffle(plates)
+    return plates,truth
+
+def accuracy(assigned,truth):
+    return np.mean([(plate[0] if plate != None else None) == true for plate,true in zip(assigned,truth)])
+
+def timeIt(fn,repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best,time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Plate assignment benchmark")
+    parser.add_argument("--config",default="consolidated_config.json",help="Lot layout to test accuracy on")
+    parser.add_argument("--rounds",type=int,default=2000)
+    parser.add_argument("--noise",type=float,nargs="+",default=[0.5,1.0,2.0,3.0],help="Std. dev. of plate position error")
+    parser.add_argument("--sizes",type=int,nargs="+",default=[8,50,100,250,500])
+    parser.add_argument("--repeats",type=int,default=5)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    with open(args.config,"r") as config_file:
+        config = json.load(config_file)
+    spots = np.array([(spot['x'],spot['y']) for spot in config["occupied_parking_spot_locations"]],dtype=np.float64)
+
+    print(f"Accuracy on {args.config} ({len(spots)} spots, {args.rounds} rounds, 60% occupancy)")
+    print(f"{'noise':>6} {'greedy':>8} {'optimal':>8}")
+    for noise in args.noise:
+        greedy_acc = []
+        optimal_acc = []
+        for _ in range(args.rounds):
+            plates,truth = makeRound(spots,0.6,noise,rng)
+            greedy_acc.append(accuracy(greedy(plates,spots),truth))
+            optimal_acc.append(accuracy(assignPlates(plates,spots),truth))
+        print(f"{noise:>6.1f} {np.mean(greedy_acc)*100:>7.2f}% {np.mean(optimal_acc)*100:>7.2f}%")
+
+    print()
+    print("Time per verdict, every spot occupied, plates seen with 1.0 position error")
+    print(f"{'plates x spots':>15} {'greedy (ms)':>12} {'optimal (ms)':>13}")
+    for size in args.sizes:
+        per_row = int(np.ceil(np.sqrt(size)))
+        lot = np.array([(3.5*(i % per_row),6.0*(i // per_row)) for i in range(size)],dtype=np.float64)
+        plates,truth = makeRound(lot,1.0,1.0,rng)
+        optimal_time = timeIt(lambda: assignPlates(plates,lot),args.repeats)
+        greedy_time = timeIt(lambda: greedy(plates,lot),1 if size > 100 else args.repeats)
+        print(f"{f'{len(plates)} x {size}':>15} {greedy_time*1000:>12.3f} {optimal_time*1000:>13.3f}")
+
+    print()
+    print(f"Worst case: solveAssignment on random cost matrices ({'scipy' if linear_sum_assignment != None else 'built-in solver, scipy is not installed'})")
+    print(f"{'size':>15} {'optimal (ms)':>13}")
+    for size in args.sizes:
+        cost = rng.random((size,size))
+        print(f"{f'{size} x {size}':>15} {timeIt(lambda: solveAssignment(cost),args.repeats)*1000:>13.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+# benchmarks/run.py
+# Benchmark suite for the fusion hot path, with regression tracking against a saved baseline.
+#
+#   python -m benchmarks.run --output results.json                   (run everything, save the results)
+#   python -m benchmarks.run --compare baseline.json --threshold 0.25 (fail if anything got >25% slower)
+#   python -m benchmarks.run --quick --filter getVerdict              (a smaller grid, only matching benchmarks)
+import argparse
+import contextlib
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+import numpy as np
+import replay
+from client_registry import ClientRegistry
+from fusion_context import LotGeometry, partialTally
+from incremental_fusion import IncrementalTally
+from metrics import Metrics
+from plate_assignment import assignPlates, parseStack
+from reputation_fusion import ObjectFusion, safeDistanceWeight
+from result_writer import ResultWriter
+from ring_buffer import RingBuffer
+from spot_index import SpotIndex
+
+full_grid = {"clients":[4,32,128],"spots":[8,64],"objects":[3,20]}
+quick_grid = {"clients":[4,64],"spots":[8],"objects":[3]}
+
+class Scenario:
+    # A synthetic lot and one frame per client: `spots` parking spots with a plate in half of them, `objects` objects
+    def __init__(self,clients,spots,objects,seed=0):
+        rng = np.random.default_rng(seed)
+        self.params = {"clients":clients,"plates":spots // 2,"spots":spots,"objects":objects}
+        per_row = int(np.ceil(np.sqrt(spots)))
+        self.empty_locations = [{"x":3.5*(i % per_row),"y":8.0*(i // per_row)} for i in range(spots)]
+        self.occupied_locations = [{"x":spot["x"],"y":spot["y"] + 4.0} for spot in self.empty_locations]
+        self.truth = ["EMPTY"] * spots
+        for i in rng.choice(spots,spots // 2,replace=False):
+            self.truth[i] = f"PLATE{i}"
+        self.object_locations = {f"object{k}":{"identities":[f"label{k}"],"x":float(k),"y":0.0} for k in range(objects)}
+        self.frames = []
+        for c in range(clients):
+            parking_list = []
+            for i,plate in enumerate(self.truth):
+                if rng.random() < 0.1:
+                    continue # Missed detection
+                spot = self.empty_locations[i] if plate == "EMPTY" else self.occupied_locations[i]
+                parking_list.append({"text":plate,"position":{"x":spot["x"] + rng.normal(0,0.5),"y":spot["y"] + rng.normal(0,0.5)},"distance":5.0})
+            object_list = {object_id:{obj["identities"][0]:float(rng.uniform(0.5,0.9)),"person":0.3} for object_id,obj in self.object_locations.items()}
+            self.frames.append({"source":f"car{c:04d}","parking_list":parking_list,"object_list":object_list})
+        self.config = {
+            "empty_parking_spot_locations":self.empty_locations,
+            "occupied_parking_spot_locations":self.occupied_locations,
+            "true_parking_occupants":self.truth,
+            "object_locations":self.object_locations,
+        }
+        self.verdicts = {
+            "plates":{str(i):plate for i,plate in enumerate(self.truth)},
+            "objects":{object_id:obj["identities"][0] for object_id,obj in self.object_locations.items()},
+        }
+
+    def label(self):
+        return ",".join(f"{key}={value}" for key,value in self.params.items())
+
+def loadBroker(name,scenario):
+    # Point a broker module at the scenario's lot and give every client its frame
+    module = replay.loadBroker(name,"benchmark")
+    module.quitIfExhausted = lambda: False
+    client = replay.InProcessClient()
+    module.CLIENT = client
+    module.main_client = client
+    if hasattr(module,"geometry"):
+        module.geometry = LotGeometry(scenario.config)
+    if hasattr(module,"empty_locations"):
+        module.empty_locations = scenario.empty_locations
+        module.occupied_locations = scenario.occupied_locations
+        module.truth_values = scenario.truth
+        module.empty_spot_index = SpotIndex(scenario.empty_locations)
+        module.occupied_spot_index = SpotIndex(scenario.occupied_locations)
+    if hasattr(module,"object_locations"):
+        module.object_locations = scenario.object_locations
+    module.activeClients = ClientRegistry()
+    if getattr(module,"fusion_tally",None) != None:
+        module.fusion_tally = IncrementalTally()
+    for frame in scenario.frames:
+        decision = dict(frame)
+        if name == "parking":
+            decision["object_list"] = decision.pop("parking_list") # parking_broker.py keeps plates in "object_list"
+        decision["timestamp"] = time.time() + 1e6 # Never expires during the run
+        module.initializeClient(frame["source"]).setDecision(decision)
+    module.verdict_id = 11 # Past object_data_collection.py's warm-up verdicts
+    if hasattr(module,"result_writer"):
+        module.result_writer = ResultWriter(os.devnull,fsync_interval=None)
+    return module
+
+def parkingVerdict(module):
+    def run():
+        module.last_verdict_time = 0.0 # parking_broker.py rate-limits getVerdict itself
+        module.getVerdict()
+    return run
+
+def makeBenchmarks(scenario):
+    # Returns [(name, callable)]. Each callable is one verdict's worth of the function being measured
+    benchmarks = []
+    consolidated = loadBroker("consolidated",scenario)
+    benchmarks.append(("consolidated.getVerdict",consolidated.getVerdict))
+    clients = list(consolidated.activeClients)
+    benchmarks.append(("consolidated.Client.noteOutcome",lambda: [client.noteOutcome(scenario.verdicts,consolidated.geometry) for client in clients]))
+    benchmarks.append(("consolidated.log_decision",lambda: consolidated.log_decision(scenario.verdicts)))
+    consolidated.log_decision(scenario.verdicts)
+    snapshot = consolidated.dashboardSnapshot(time.time(),[{"plate":None}] * len(scenario.occupied_locations),scenario.verdicts)
+    benchmarks.append(("consolidated.dashboardSnapshot",lambda: consolidated.dashboardSnapshot(snapshot["time"],[{"plate":None}] * len(scenario.occupied_locations),scenario.verdicts)))
+    benchmarks.append(("consolidated.renderDashboard",lambda: consolidated.renderDashboard(snapshot)))
+    frame_text = json.dumps(scenario.frames[0])
+    benchmarks.append(("encodePayload",lambda: consolidated.encodePayload({"message":scenario.verdicts})))
+    benchmarks.append(("decodePayload",lambda: consolidated.decodePayload(frame_text)))
+
+    parking = loadBroker("parking",scenario)
+    benchmarks.append(("parking.getVerdict",parkingVerdict(parking)))
+    objects = loadBroker("objects",scenario)
+    benchmarks.append(("objects.getVerdict",objects.getVerdict))
+
+    # Plate assignment on the mean positions of every plate the fleet saw
+    tally = {}
+    for frame in scenario.frames:
+        for qr in frame["parking_list"]:
+            if qr["text"] != "EMPTY":
+                x,y,count = tally.get(qr["text"],(0.0,0.0,0))
+                tally[qr["text"]] = (x + qr["position"]["x"],y + qr["position"]["y"],count + 1)
+    stack = [[plate,x/count,y/count] for plate,(x,y,count) in tally.items()]
+    spot_coords = SpotIndex(scenario.occupied_locations).coords
+    benchmarks.append(("parseStack",lambda: parseStack([list(plate) for plate in stack],[{'position':spot,'plate':None} for spot in scenario.occupied_locations])))
+    benchmarks.append(("assignPlates",lambda: assignPlates(stack,spot_coords)))
+
+    # Closest-spot lookups for every detection in every frame (what getClosestObject used to do one at a time)
+    index = SpotIndex(scenario.empty_locations)
+    positions = [[qr["position"] for qr in frame["parking_list"]] for frame in scenario.frames]
+    benchmarks.append(("SpotIndex.nearestMany",lambda: [index.nearestMany(frame) for frame in positions]))
+
+    # Rebuilding the tallies from every frame vs. replacing one vehicle's frame in running tallies
+    decisions = [dict(frame,timestamp=0.0) for frame in scenario.frames]
+    benchmarks.append(("partialTally",lambda: partialTally(decisions)))
+    incremental = IncrementalTally()
+    for decision in decisions:
+        incremental.setDecision(decision["source"],decision)
+    benchmarks.append(("IncrementalTally.setDecision",lambda: incremental.setDecision(decisions[0]["source"],decisions[0])))
+
+    history = RingBuffer(1000)
+    benchmarks.append(("RingBuffer.append+mean",lambda: (history.append(0.875),history.mean())))
+
+    # What one stage timer costs (a verdict records about ten)
+    metrics = Metrics()
+    benchmarks.append(("Metrics.record",lambda: metrics.record("verdict",time.perf_counter_ns())))
+    return benchmarks
+
+def objectFusionBenchmarks(clients=1000,labels=80,objects=20,labels_per_object=5,seed=0):
+    # Weighted object fusion at fleet scale: every client reports a few of the 80 COCO-sized labels for every object.
+    # "loop" is the same vote done the way main_broker.py used to, one client and one object at a time
+    rng = np.random.default_rng(seed)
+    object_ids = [f"object{k}" for k in range(objects)]
+    label_names = [f"label{k}" for k in range(labels)]
+    frames = {f"car{c:04d}":{object_id:{str(label):float(rng.uniform(0.3,0.95)) for label in rng.choice(label_names,labels_per_object,replace=False)} for object_id in object_ids} for c in range(clients)}
+    fusion = ObjectFusion(object_ids,{"label0":[0.8,0.1]})
+    for name,frame in frames.items():
+        fusion.setFrame(name,frame,1e12)
+    reputations = {name:0.5 for name in frames}
+    distance_weight = float(safeDistanceWeight(0.0))
+    def loop():
+        verdicts = {}
+        for object_id in object_ids:
+            scores = {}
+            for name,frame in frames.items():
+                for label,score in frame[object_id].items():
+                    scores[label] = scores.get(label,0.0) + score * reputations[name] * distance_weight
+            verdicts[object_id] = max(scores,key=scores.get)
+        return verdicts
+    def verdictAndReputations():
+        fusion.verdicts(1e12)
+        fusion.updateReputations(1e12)
+    first = next(iter(frames))
+    params = {"clients":clients,"labels":labels,"objects":objects}
+    return params,[
+        ("ObjectFusion.setFrame",lambda: fusion.setFrame(first,frames[first],1e12)),
+        ("ObjectFusion.verdicts",lambda: fusion.verdicts(1e12)),
+        ("ObjectFusion.verdicts+updateReputations",verdictAndReputations),
+        ("ObjectFusion.loop",loop),
+    ]
+
+def timeBenchmark(fn,repeats,target_time):
+    # Calibrate the loop count to roughly target_time per repeat, then report per-call times
+    start = time.perf_counter()
+    fn()
+    once = max(time.perf_counter() - start,1e-7)
+    number = max(1,int(target_time / once))
+    samples = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return {"best":min(samples),"median":float(np.median(samples)),"number":number,"repeats":repeats}
+
+def runSuite(grid,repeats,target_time,name_filter=None):
+    results = {}
+    for clients,spots,objects in itertools.product(grid["clients"],grid["spots"],grid["objects"]):
+        scenario = Scenario(clients,spots,objects)
+        with open(os.devnull,"w") as sink, contextlib.redirect_stdout(sink):
+            benchmarks = makeBenchmarks(scenario)
+            for name,fn in benchmarks:
+                if name_filter != None and name_filter not in name:
+                    continue
+                result = timeBenchmark(fn,repeats,target_time)
+                result["params"] = scenario.params
+                results[f"{name}[{scenario.label()}]"] = result
+        print(f"{scenario.label()}: done")
+    params,benchmarks = objectFusionBenchmarks()
+    label = ",".join(f"{key}={value}" for key,value in params.items())
+    for name,fn in benchmarks:
+        if name_filter != None and name_filter not in name:
+            continue
+        result = timeBenchmark(fn,repeats,target_time)
+        result["params"] = params
+        results[f"{name}[{label}]"] = result
+    print(f"{label}: done")
+    return results
+
+def compareResults(results,baseline,threshold):
+    # Returns the list of benchmarks that got slower than allowed
+    regressions = []
+    print(f"{'benchmark':<90} {'baseline (us)':>14} {'now (us)':>10} {'change':>8}")
+    for key,result in results.items():
+        if key not in baseline:
+            continue
+        before = baseline[key]["median"]
+        ratio = result["median"] / before if before > 0 else 1.0
+        flag = ""
+        if ratio > 1 + threshold:
+            regressions.append(key)
+            flag = "  <-- REGRESSION"
+        print(f"{key:<90} {before*1e6:>14.2f} {result['median']*1e6:>10.2f} {(ratio-1)*100:>+7.1f}%{flag}")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Fusion hot path benchmark suite")
+    parser.add_argument("--quick",action="store_true",help="Smaller scenario grid")
+    parser.add_argument("--filter",default=None,help="Only run benchmarks whose name contains this")
+    parser.add_argument("--repeats",type=int,default=5)
+    parser.add_argument("--target-time",type=float,default=0.05,help="Seconds per repeat")
+    parser.add_argument("-o","--output",default=None,help="Save results to this JSON file (e.g. to use as a baseline)")
+    parser.add_argument("--compare",default=None,help="Baseline JSON file to compare against")
+    parser.add_argument("--threshold",type=float,default=0.25,help="Allowed slowdown vs. the baseline (0.25 = 25%%)")
+    args = parser.parse_args()
+
+    results = runSuite(quick_grid if args.quick else full_grid,args.repeats,args.target_time,args.filter)
+    report = {
+        "meta":{
+            "time":time.time(),
+            "python":platform.python_version(),
+            "numpy":np.__version__,
+            "machine":platform.machine(),
+            "processor":platform.processor(),
+        },
+        "results":results,
+    }
+    if args.output != None:
+        with open(args.output,"w") as output_file:
+            json.dump(report,output_file,indent=4)
+
+    if args.compare != None:
+        with open(args.compare,"r") as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+        regressions = compareResults(results,baseline,args.threshold)
+        if len(regressions) > 0:
+            print(f"\n{len(regressions)} benchmark(s) slowed down by more than {args.threshold*100:.0f}%")
+            sys.exit(1)
+        print("\nNo regressions")
+    else:
+        print(f"{'benchmark':<90} {'median (us)':>12} {'best (us)':>10}")
+        for key,result in results.items():
+            print(f"{key:<90} {result['median']*1e6:>12.2f} {result['best']*1e6:>10.2f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# benchmarks/spot_lookup.py
+# Per-verdict cost of closest-spot lookups vs. number of parking spots: the old per-spot Python loop against SpotIndex.
+# Run from the repository root: python -m benchmarks.spot_lookup
+import argparse
+import time
+import numpy as np
+from spot_index import SpotIndex
+
+def legacyClosestObject(parking_list,pos):
+    # The getClosestObject loop the brokers used before SpotIndex
+    closest_id = 0
+    closest_distance = -1
+    for i,obj in enumerate(parking_list):
+        distance = np.sqrt((obj['x']-pos['x'])**2 + (obj['y']-pos['y'])**2)
+        if distance < closest_distance or closest_distance == -1:
+            closest_distance = distance
+            closest_id = i
+    return closest_id
+
+def makeLot(spot_count):
+    # Two facing rows of spots, 3.5 units apart, like consolidated_config.json
+    per_row = (spot_count + 1) // 2
+    spots = [{"x":9.5 + 3.5*(i % per_row),"y":14.0 if i < per_row else 44.0} for i in range(spot_count)]
+    return spots[:spot_count]
+
+def makeFrames(spots,clients,detections,rng):
+    frames = []
+    for c in range(clients):
+        picks = rng.integers(0,len(spots),detections)
+        frames.append([{"x":spots[i]["x"] + rng.normal(0,0.8),"y":spots[i]["y"] + rng.normal(0,0.8)} for i in picks])
+    return frames
+
+def timeIt(fn,repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best,time.perf_counter() - start)
+    return best
+
+def main():
+    parser = argparse.ArgumentParser(description="Closest-spot lookup benchmark")
+    parser.add_argument("--clients",type=int,default=4,help="Vehicles reporting per verdict")
+    parser.add_argument("--detections",type=int,default=8,help="Detections per vehicle frame")
+    parser.add_argument("--spots",type=int,nargs="+",default=[8,32,128,512,2048])
+    parser.add_argument("--repeats",type=int,default=5)
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    print(f"{args.clients} clients x {args.detections} detections per verdict (each looked up twice: tally + noteOutcome)")
+    print(f"{'spots':>7} {'legacy (ms)':>12} {'SpotIndex (ms)':>15} {'speedup':>8}")
+    for spot_count in args.spots:
+        spots = makeLot(spot_count)
+        frames = makeFrames(spots,args.clients,args.detections,rng)
+        index = SpotIndex(spots)
+
+        def legacy():
+            for _ in range(2):
+                for frame in frames:
+                    for pos in frame:
+                        legacyClosestObject(spots,pos)
+
+        def vectorized():
+            for _ in range(2):
+                for frame in frames:
+                    index.nearestMany(frame)
+
+        # Same answers (ties aside, which the random noise makes vanishingly unlikely)
+        for frame in frames:
+            assert list(index.nearestMany(frame)) == [legacyClosestObject(spots,pos) for pos in frame]
+
+        legacy_time = timeIt(legacy,args.repeats)
+        new_time = timeIt(vectorized,args.repeats)
+        print(f"{spot_count:>7} {legacy_time*1000:>12.3f} {new_time*1000:>15.3f} {legacy_time/new_time:>7.1f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,584 @@
+# broker_core.py
+# The network side of a broker, on one asyncio event loop. consolidated_broker.py, parking_broker.py and
+# object_data_collection.py are modes of it: each keeps its fusion state and verdict logic, and hands startBroker() a
+# CoreClient in place of paho's mqtt.Client. The core then runs these tasks:
+#   ingest     takes messages off the transport and hands them to the mode's on_message, one at a time. on_message
+#              (and an inline verdict with it) runs on a delivery thread of its own, like it ran on paho's network
+#              thread, so the loop keeps publishing and receiving meanwhile
+#   control    broker_control and clock_pong messages. The transport sorts these into a queue of their own as they
+#              come off the network, so they don't wait behind a backlog of frames, and stamps when they arrived
+#              (CoreMessage.receive_time, the t3 of a clock pong)
+#   fusion     scheduled verdicts (settings["verdict_trigger"] == "scheduled"), see ScheduledFusion. Each slot runs on
+#              a worker thread, holding the mode's state_lock there
+#   publisher  subscribes and publishes, in the order the mode asked for them. They may come from any thread
+#   outputs    flushes and fsyncs the mode's result stream (result_writer.py) on a worker thread, instead of the
+#              writer's own thread
+#
+# Shutdown is cooperative. When the experiment is over (quitIfExhausted), the client disconnects, or the process gets
+# SIGINT/SIGTERM, intake stops, the fusion task or thread stops, every queued publish is sent and flushed, and only
+# then does the mode's "finished" message go out (its will message, if it stopped early), followed by the disconnect.
+#
+# Transports: PahoTransport talks to a real MQTT broker. MemoryTransport keeps everything in the process, for tests:
+#
+#   transport = MemoryTransport()
+#   core = BrokerCore(replay.loadBroker("consolidated","test"),transport)
+#   task = asyncio.create_task(core.run())
+#   transport.inject("data_V2B",json.dumps({...}))
+#   ...
+#   transport.payloads("verdict")
+#
+# The ingest_mode "queued"/"mailbox" fusion worker (ingest_queue.py) stays a thread of its own: it exists to keep
+# fusion off the thread messages arrive on.
+#
+#   python broker_core.py trace.jsonl -b consolidated   (check that a trace replayed through MemoryTransport gives the
+#                                                        same messages as replay.py, with "finished" last)
+#   python broker_core.py --startup                     (check that every broker starts and stops with its defaults)
+import argparse
+import asyncio
+import concurrent.futures
+import glob
+import importlib
+import multiprocessing
+import os
+import queue
+import signal
+import tempfile
+import threading
+import time
+import traceback
+from collections import deque
+from colors import *
+from config_model import control_topic
+from clock_sync import pong_topic
+
+control_topics = (control_topic,pong_topic)
+final_topic = "finished" # Held back until everything else queued has been published
+
+class CoreMessage:
+    # Just enough of paho's MQTTMessage for the brokers' on_message, plus when the transport received it
+    def __init__(self,topic,payload,receive_time):
+        self.topic = topic
+        self.payload = payload
+        self.receive_time = receive_time
+
+class MemoryTransport:
+    # A broker inside the process. inject() plays a vehicle, `published` keeps (topic, payload, retain) of everything the
+    # broker sent. Call inject() from the event loop's thread. clock() gives the receive times (a replay's clock, say)
+    def __init__(self,on_publish=None,clock=time.time):
+        self.on_publish = on_publish
+        self.clock = clock
+        self.subscriptions = set()
+        self.published = []
+        self.will = None
+        self.connected = False
+        self.control_topics = ()
+        self.inbox = asyncio.Queue()
+        self.control = asyncio.Queue()
+
+    async def connect(self,will=None,control_topics=()):
+        self.will = will
+        self.control_topics = control_topics
+        self.connected = True
+
+    async def subscribe(self,topic,qos=0):
+        self.subscriptions.add(topic)
+
+    def publish(self,topic,payload=None,qos=0,retain=False):
+        self.published.append((topic,payload,retain))
+        if self.on_publish != None:
+            self.on_publish(topic,payload)
+
+    async def flush(self,timeout=None):
+        return True
+
+    def inject(self,topic,payload):
+        # Returns False (and drops the message) if the broker isn't subscribed to the topic
+        if topic not in self.subscriptions:
+            return False
+        if isinstance(payload,str):
+            payload = payload.encode("utf-8")
+        (self.control if topic in self.control_topics else self.inbox).put_nowait((topic,payload,self.clock()))
+        return True
+
+    async def receive(self):
+        # The next (topic, payload, receive time), or None once disconnected
+        return await self.inbox.get()
+
+    async def receiveControl(self):
+        # The same, for the control topics
+        return await self.control.get()
+
+    async def disconnect(self):
+        self.connected = False
+        self.inbox.put_nowait(None)
+        self.control.put_nowait(None)
+
+    def topics(self):
+        return [topic for topic,_,_ in self.published]
+
+    def payloads(self,topic):
+        return [payload for published_topic,payload,_ in self.published if published_topic == topic]
+
+class PahoTransport:
+    # paho's network loop runs on its own thread (loop_start). Incoming messages are handed to the event loop, and
+    # flush() waits until every publish so far has left the socket (or was acknowledged, for qos > 0)
+    def __init__(self,host="localhost",port=1883,keepalive=60):
+        import paho.mqtt.client as mqtt
+        self.host = host
+        self.port = port
+        self.keepalive = keepalive
+        self.client = mqtt.Client()
+        self.subscriptions = {}
+        self.in_flight = deque() # MQTTMessageInfo of the publishes that haven't gone out yet, oldest first
+        self.control_topics = ()
+        self.inbox = None
+        self.control = None
+        self.loop = None
+        self.connected = None
+
+    async def connect(self,will=None,control_topics=()):
+        self.loop = asyncio.get_running_loop()
+        self.inbox = asyncio.Queue()
+        self.control = asyncio.Queue()
+        self.control_topics = control_topics
+        self.connected = self.loop.create_future()
+        if will != None:
+            self.client.will_set(*will)
+        self.client.on_connect = self.onConnect
+        self.client.on_message = self.onMessage
+        self.client.connect_async(self.host,self.port,keepalive=self.keepalive)
+        self.client.loop_start()
+        await self.connected
+
+    def onConnect(self,client,userdata,flags,rc):
+        # On paho's thread. Subscriptions are made again after a reconnect
+        prCyan(f"Connected with result code {rc}")
+        for topic,qos in self.subscriptions.items():
+            client.subscribe(topic,qos)
+        self.loop.call_soon_threadsafe(self.resolveConnected,rc)
+
+    def resolveConnected(self,rc):
+        if not self.connected.done():
+            if rc == 0:
+                self.connected.set_result(rc)
+            else:
+                self.connected.set_exception(ConnectionError(f"MQTT connection refused with result code {rc}"))
+
+    def onMessage(self,client,userdata,msg):
+        # On paho's thread. The receive time is taken here, before the message waits for the event loop
+        target = self.control if msg.topic in self.control_topics else self.inbox
+        self.loop.call_soon_threadsafe(target.put_nowait,(msg.topic,msg.payload,time.time()))
+
+    async def subscribe(self,topic,qos=0):
+        self.subscriptions[topic] = qos
+        self.client.subscribe(topic,qos)
+
+    def publish(self,topic,payload=None,qos=0,retain=False):
+        self.in_flight.append(self.client.publish(topic,payload=payload,qos=qos,retain=retain))
+        self.prune()
+
+    def prune(self):
+        # Forget the publishes that went out. They go out in order, so only the front of the queue needs checking
+        while len(self.in_flight) > 0 and self.in_flight[0].is_published():
+            self.in_flight.popleft()
+
+    async def flush(self,timeout=None):
+        # Returns False if some publishes were still in flight after `timeout` seconds
+        deadline = None if timeout == None else self.loop.time() + timeout
+        while True:
+            self.in_flight = deque(info for info in self.in_flight if not info.is_published())
+            if len(self.in_flight) == 0:
+                return True
+            if deadline != None and self.loop.time() >= deadline:
+                return False
+            await asyncio.sleep(0.01)
+
+    async def receive(self):
+        return await self.inbox.get()
+
+    async def receiveControl(self):
+        return await self.control.get()
+
+    async def disconnect(self):
+        self.client.disconnect()
+        await asyncio.to_thread(self.client.loop_stop)
+        self.inbox.put_nowait(None)
+        self.control.put_nowait(None)
+
+class CoreClient:
+    # What a broker mode sees in place of paho's mqtt.Client
+    def __init__(self,core):
+        self.core = core
+        self.on_connect = None
+        self.on_message = None
+        self.will = None
+
+    def will_set(self,topic,payload=None,qos=0,retain=False):
+        self.will = (topic,payload,qos,retain)
+
+    def subscribe(self,topic,qos=0):
+        self.core.send(("subscribe",topic,qos))
+
+    def publish(self,topic,payload=None,qos=0,retain=False):
+        self.core.send(("publish",topic,payload,qos,retain))
+
+    def disconnect(self):
+        self.core.requestShutdown()
+
+    def requestShutdown(self):
+        # The mode is done (quitIfExhausted). Its "finished" publish goes out once everything before it has
+        self.core.requestShutdown()
+
+    def scheduledFusion(self,scheduler,run_verdict,lock):
+        # See verdict_scheduler.schedulerThreadFor
+        return ScheduledFusion(self.core,scheduler,run_verdict,lock)
+
+class ScheduledFusion:
+    # verdict_scheduler.SchedulerThread as a task on the core's event loop. Same start/notify/stop. The slot itself runs
+    # on a worker thread, so a verdict (or another thread holding `lock`) never stalls the loop
+    def __init__(self,core,scheduler,run_verdict,lock):
+        self.core = core
+        self.scheduler = scheduler
+        self.run_verdict = run_verdict
+        self.lock = lock
+        self.wakeup = asyncio.Event()
+        self.stopping = False
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def notify(self):
+        self.core.callSoon(self.wakeup.set)
+
+    def stop(self):
+        self.stopping = True
+        self.core.callSoon(self.wakeup.set)
+
+    def runSlot(self):
+        # On a worker thread. Returns False once the broker is done
+        try:
+            with self.lock:
+                if self.scheduler.isDue():
+                    self.scheduler.runSlot(self.run_verdict)
+            return True
+        except SystemExit:
+            # The broker finished its experiment (quitIfExhausted)
+            return False
+
+    async def run(self):
+        try:
+            while not self.stopping:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(),self.scheduler.timeUntilNext())
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                if self.stopping or not await asyncio.to_thread(self.runSlot):
+                    break
+        except Exception:
+            prRed("Scheduled fusion stopped:")
+            traceback.print_exc()
+        finally:
+            self.stopping = True
+            self.core.requestShutdown()
+
+class BrokerCore:
+    def __init__(self,module,transport,drain_timeout=5.0):
+        # module: a broker mode (anything with startBroker(client)). drain_timeout: seconds shutdown waits for queued
+        # publishes to go out, before and after "finished"
+        self.module = module
+        self.transport = transport
+        self.drain_timeout = drain_timeout
+        self.client = CoreClient(self)
+        self.held = [] # "finished" publishes, sent after the drain
+        self.loop = None
+        self.loop_thread = None
+        self.outbox = None
+        self.stopping = None
+        self.deliveries = None # One thread, so on_message never runs twice at once
+        self.delivering = set()
+
+    def callSoon(self,callback,*args):
+        # Runs callback on the event loop, from any thread
+        if threading.get_ident() == self.loop_thread:
+            callback(*args)
+        elif self.loop != None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(callback,*args)
+
+    def send(self,operation):
+        if operation[0] == "publish" and operation[1] == final_topic:
+            self.held.append(operation)
+            return
+        self.callSoon(self.outbox.put_nowait,operation)
+
+    def requestShutdown(self):
+        self.callSoon(self.stopping.set)
+
+    def deliver(self,topic,payload,receive_time):
+        try:
+            self.client.on_message(self.client,None,CoreMessage(topic,payload,receive_time))
+        except SystemExit:
+            self.requestShutdown()
+        except Exception:
+            # One bad message shouldn't take the broker down
+            prRed(f"Error handling a {topic} message:")
+            traceback.print_exc()
+
+    async def handOff(self,message):
+        # Waits for on_message on the delivery thread. Cancelling the wait (at shutdown) leaves the delivery running,
+        # shutdown waits for it in self.delivering
+        future = self.loop.run_in_executor(self.deliveries,self.deliver,*message)
+        self.delivering.add(future)
+        future.add_done_callback(self.delivering.discard)
+        await asyncio.shield(future)
+
+    async def ingest(self):
+        while not self.stopping.is_set():
+            message = await self.transport.receive()
+            if message == None:
+                self.requestShutdown()
+                return
+            await self.handOff(message)
+
+    async def handleControl(self):
+        while not self.stopping.is_set():
+            message = await self.transport.receiveControl()
+            if message == None:
+                return
+            await self.handOff(message)
+
+    async def publishOutbox(self):
+        while True:
+            operation = await self.outbox.get()
+            try:
+                if operation[0] == "subscribe":
+                    await self.transport.subscribe(operation[1],operation[2])
+                else:
+                    self.transport.publish(*operation[1:])
+            except Exception as e:
+                prRed(f"Could not {operation[0]} on {operation[1]}: {e}")
+            finally:
+                self.outbox.task_done()
+
+    async def flushOutputs(self):
+        writer = getattr(self.module,"result_writer",None)
+        if writer == None:
+            return
+        # File writes and fsyncs happen on a worker thread, the loop only keeps time
+        await asyncio.to_thread(writer.detach)
+        while not writer.closed:
+            await asyncio.sleep(writer.flush_interval)
+            await asyncio.to_thread(writer.tick)
+
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.outbox = asyncio.Queue()
+        self.stopping = asyncio.Event()
+        self.deliveries = concurrent.futures.ThreadPoolExecutor(max_workers=1,thread_name_prefix="on_message")
+        for signal_number in (signal.SIGINT,signal.SIGTERM):
+            try:
+                self.loop.add_signal_handler(signal_number,self.requestShutdown)
+            except (NotImplementedError,RuntimeError,ValueError):
+                pass # Not on the main thread, or not supported here. Ctrl+C then stops the process the usual way
+        self.module.startBroker(self.client)
+        await self.transport.connect(self.client.will,control_topics)
+        tasks = {
+            "publisher":asyncio.create_task(self.publishOutbox()),
+            "outputs":asyncio.create_task(self.flushOutputs()),
+            "ingest":asyncio.create_task(self.ingest()),
+            "control":asyncio.create_task(self.handleControl()),
+        }
+        if self.client.on_connect != None:
+            self.client.on_connect(self.client,None,{},0)
+        try:
+            await self.stopping.wait()
+        finally:
+            await self.shutdown(tasks)
+
+    async def shutdown(self,tasks):
+        for name in ("ingest","control"):
+            tasks[name].cancel()
+        if len(self.delivering) > 0:
+            await asyncio.wait(list(self.delivering),timeout=self.drain_timeout)
+        # No new verdicts. A fusion thread may be in the middle of one, so wait for it
+        for name in ("scheduler_thread","fusion_worker"):
+            worker = getattr(self.module,name,None)
+            if worker == None:
+                continue
+            worker.stop()
+            if isinstance(worker,threading.Thread) and worker is not threading.current_thread():
+                await asyncio.to_thread(worker.join,self.drain_timeout)
+            elif isinstance(worker,ScheduledFusion) and worker.task != None:
+                await asyncio.wait([worker.task],timeout=self.drain_timeout)
+        try:
+            await asyncio.wait_for(self.outbox.join(),self.drain_timeout)
+        except asyncio.TimeoutError:
+            prRed(f"Gave up on {self.outbox.qsize()} queued publishes after {self.drain_timeout}s")
+        tasks["publisher"].cancel()
+        if not await self.transport.flush(self.drain_timeout):
+            prRed("Some publishes were still in flight at shutdown")
+        final = [operation[1:] for operation in self.held]
+        if len(final) == 0 and self.client.will != None:
+            final = [self.client.will] # Stopped before the experiment was over. A clean disconnect doesn't send the will
+        for message in final:
+            self.transport.publish(*message)
+        await self.transport.flush(self.drain_timeout)
+        tasks["outputs"].cancel()
+        writer = getattr(self.module,"result_writer",None)
+        if writer != None:
+            # Already closed if the experiment finished. Otherwise the stream can be finalized by hand
+            await asyncio.to_thread(writer.close)
+        await asyncio.gather(*tasks.values(),return_exceptions=True)
+        self.deliveries.shutdown(wait=False)
+        await self.transport.disconnect()
+
+def runBroker(module,transport,drain_timeout=5.0):
+    # Blocks until the broker shuts down
+    asyncio.run(BrokerCore(module,transport,drain_timeout).run())
+
+async def replayThroughCore(module,header,records,clock):
+    # Feeds a trace through MemoryTransport, one message at a time like replay.py, and shuts the broker down at the end
+    # of the trace if it hasn't finished its experiment by then. Returns the transport
+    import replay
+    transport = MemoryTransport(clock=clock.time)
+    core = BrokerCore(module,transport)
+    task = asyncio.create_task(core.run())
+    while (core.outbox == None or core.outbox.qsize() > 0 or len(transport.subscriptions) == 0) and not task.done():
+        await asyncio.sleep(0)
+    for record in records:
+        if task.done():
+            break
+        clock.now = header["start_time"] + record["t"]
+        transport.inject(record["topic"],replay.recordPayload(record))
+        while (transport.inbox.qsize() > 0 or transport.control.qsize() > 0 or len(core.delivering) > 0) and not task.done():
+            await asyncio.sleep(0)
+    core.requestShutdown()
+    await task
+    return transport
+
+def runCheck(path,trace_path,broker,overrides,results):
+    # Runs in its own process, so both paths start from a freshly imported broker
+    import contextlib
+    import io
+    import replay
+    header,records = replay.loadTrace(trace_path)
+    module = replay.loadBroker(broker,"core_check",dict(overrides,dashboard_mode="off"))
+    published = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if path == "replay":
+            replay.replayTrace(module,header,records,speed=0,on_publish=lambda topic,payload: published.append((topic,payload)))
+        else:
+            clock = replay.ReplayClock(header["start_time"])
+            module.time = clock
+            transport = asyncio.run(replayThroughCore(module,header,records,clock))
+            published = [(topic,payload) for topic,payload,_ in transport.published]
+    for pattern in ("outputs/output_core_check.json*","outputs/objects/output_core_check.json*"):
+        for output_path in glob.glob(pattern):
+            os.remove(output_path)
+    results.put([(topic,None if payload == None else bytes(payload)) for topic,payload in published])
+
+def checkTrace(trace_path,broker="consolidated",overrides=None):
+    # Returns a list of problems, empty if the core published exactly what replay.py's client did, with "finished" last
+    published = {}
+    for path in ("replay","core"):
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=runCheck,args=(path,trace_path,broker,overrides or {},results))
+        worker.start()
+        while path not in published:
+            try:
+                published[path] = results.get(timeout=1)
+            except queue.Empty:
+                if not worker.is_alive():
+                    return [f"The {path} run failed (exit code {worker.exitcode})"]
+        worker.join()
+    problems = []
+    finished = [i for i,(topic,_) in enumerate(published["core"]) if topic == final_topic]
+    if len(finished) > 0 and finished != [len(published["core"]) - 1]:
+        problems.append(f"\"{final_topic}\" was not the last publish, or went out more than once")
+    core = published["core"]
+    if len(finished) > 0 and not any(topic == final_topic for topic,_ in published["replay"]):
+        core = core[:-1] # The trace ended before the experiment did, so the core sent the will on its way out
+    if core != published["replay"]:
+        for i,(expected,got) in enumerate(zip(published["replay"],core)):
+            if expected != got:
+                problems.append(f"Message {i} differs: {expected[0]} from replay.py, {got[0]} from the core")
+                break
+        if len(core) != len(published["replay"]):
+            problems.append(f"{len(published['replay'])} messages from replay.py, {len(core)} from the core")
+    return problems
+
+async def startAndStop(module):
+    transport = MemoryTransport()
+    core = BrokerCore(module,transport)
+    task = asyncio.create_task(core.run())
+    while (core.outbox == None or core.outbox.qsize() > 0 or len(transport.subscriptions) == 0) and not task.done():
+        await asyncio.sleep(0)
+    core.requestShutdown()
+    await task
+
+def runStartup(broker,results):
+    # Runs in its own process. The broker is imported and started the way `python <broker>.py` would, with nothing
+    # set on the module from outside (replay.loadBroker sets test_id, for one), so a missing global shows up here
+    import contextlib
+    import io
+    from replay import brokers
+    try:
+        module = importlib.import_module(brokers[broker])
+        # The lot config is loaded by now. Outputs go to a scratch directory instead of over a real run's
+        with tempfile.TemporaryDirectory(prefix="broker_startup_") as scratch:
+            os.chdir(scratch)
+            os.makedirs("outputs/objects")
+            with contextlib.redirect_stdout(io.StringIO()):
+                asyncio.run(startAndStop(module))
+            os.chdir(os.path.dirname(os.path.abspath(__file__)))
+        results.put(None)
+    except BaseException:
+        results.put(traceback.format_exc())
+
+def checkStartup(broker):
+    # None if the broker starts and stops cleanly with its defaults, the traceback otherwise
+    results = multiprocessing.Queue()
+    worker = multiprocessing.Process(target=runStartup,args=(broker,results))
+    worker.start()
+    while True:
+        try:
+            problem = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not worker.is_alive():
+                problem = f"Exited with code {worker.exitcode}"
+                break
+    worker.join()
+    return problem
+
+def main():
+    from replay import brokers, parseOverrides
+    parser = argparse.ArgumentParser(description="Check broker_core.py against replay.py on a trace")
+    parser.add_argument("trace",nargs="?")
+    parser.add_argument("-b","--broker",default="consolidated",help=f"One of {list(brokers.keys())}")
+    parser.add_argument("--set",nargs="*",default=[],metavar="KEY=VALUE",help="Override server_config settings")
+    parser.add_argument("--startup",action="store_true",help="Instead, start and stop every broker with its defaults")
+    args = parser.parse_args()
+    if args.startup:
+        failed = False
+        for broker in brokers:
+            problem = checkStartup(broker)
+            if problem != None:
+                prRed(f"{broker} did not start:\n{problem}")
+                failed = True
+            else:
+                prGreen(f"{broker} started and stopped cleanly")
+        exit(1 if failed else 0)
+    if args.trace == None:
+        parser.error("give a trace, or --startup")
+    problems = checkTrace(args.trace,args.broker,parseOverrides(args.set))
+    if len(problems) > 0:
+        for problem in problems:
+            prRed(problem)
+        exit(1)
+    prGreen(f"{args.broker}: the core and replay.py published the same messages")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+# client_registry.py
+import bisect
+
+class ClientRegistry:
+    # Keeps track of the active clients, with dict lookup by name and iteration in name order.
+    # Iterating (and indexing, len) behaves like the old sorted `activeClients` list, so existing loops keep working.
+    def __init__(self):
+        self.by_name = {}
+        self.names = [] # Always sorted
+        self.ordered = () # Clients in name order, rebuilt lazily after a join or leave
+        self.changed = False
+
+    def add(self,client):
+        name = client.getName()
+        if name in self.by_name:
+            raise KeyError(f"Client already exists: {name}")
+        self.by_name[name] = client
+        bisect.insort(self.names,name)
+        self.changed = True
+        return client
+
+    def remove(self,client_name):
+        client = self.by_name.pop(client_name) # Raises KeyError if the client is unknown
+        del self.names[bisect.bisect_left(self.names,client_name)]
+        self.changed = True
+        return client
+
+    def get(self,client_name):
+        return self.by_name.get(client_name)
+
+    def view(self):
+        # Snapshot of the clients in name order. Safe to hold on to while clients join or leave
+        if self.changed:
+            self.ordered = tuple(self.by_name[name] for name in self.names)
+            self.changed = False
+        return self.ordered
+
+    def __contains__(self,client_name):
+        return client_name in self.by_name
+
+    def __iter__(self):
+        return iter(self.view())
+
+    def __len__(self):
+        return len(self.by_name)
+
+    def __getitem__(self,index):
+        return self.view()[index]
+
+    def __repr__(self):
+        return repr(list(self.view()))
@@ -0,0 +1,190 @@
+# clock_sync.py
+# Sensor time instead of arrival time. Vehicles stamp each V2B frame with the time they captured it ("timestamp", on
+# the vehicle's own clock). The broker keeps that capture time, corrected onto its own clock with a per-vehicle offset
+# estimate, next to the time the frame arrived.
+#
+# Offsets come from an NTP-style ping/pong on MQTT:
+#   clock_ping  (broker -> vehicles)  {"seq":7,"t0":<broker send time>}
+#   clock_pong  (vehicle -> broker)   {"source":"car1","seq":7,"t0":<echoed>,"t1":<vehicle receive time>,"t2":<vehicle send time>}
+# With t3 the broker's receive time, offset = ((t1 - t0) + (t2 - t3)) / 2 and round trip = (t3 - t0) - (t2 - t1).
+# The offset of the fastest of the last few round trips is used, since a slow one is probably queued on one leg.
+# Only vehicles the broker knows (expect(), when they join) are tracked; pongs from anyone else are ignored. A vehicle
+# that hasn't answered a ping after a full interval is logged once, since its frames keep their arrival time.
+#
+# Every stored frame ends up with:
+#   arrival_time  when it reached the broker (broker clock)
+#   capture_time  when it was captured (broker clock). The arrival time when there is nothing better to go on
+#   timestamp     what oldest_allowable_data is checked against: arrival_time, or capture_time when
+#                 settings["staleness_clock"] == "capture"
+import heapq
+import threading
+from collections import deque
+
+ping_topic = "clock_ping"
+pong_topic = "clock_pong"
+
+def pongFor(ping,source,received_time,now):
+    # What a vehicle sends back for a clock_ping (for vehicle code and simulators)
+    return {"source":source,"seq":ping.get("seq"),"t0":ping.get("t0"),"t1":received_time,"t2":now}
+
+def receiveTime(msg,now):
+    # When a message reached the broker. broker_core.py stamps that as messages come off the network, so a pong's round
+    # trip leaves out the time it spent queued inside the broker. `now` for clients that don't (paho, replay.py)
+    return getattr(msg,"receive_time",now)
+
+def isTime(value):
+    return isinstance(value,(int,float)) and not isinstance(value,bool)
+
+class VehicleClock:
+    def __init__(self,window=8,joined=0):
+        self.samples = deque(maxlen=window) # (round trip, offset)
+        self.offset = None
+        self.round_trip = None
+        self.joined = joined # The last ping sent before the vehicle joined
+        self.reported = False # Logged as having no estimate
+
+    def add(self,round_trip,offset):
+        self.samples.append((round_trip,offset))
+        self.round_trip,self.offset = min(self.samples)
+
+class ClockSync:
+    def __init__(self,assume_synced=True,window=8):
+        # assume_synced: take vehicle timestamps as they are while there is no estimate (clocks synced some other
+        # way, e.g. NTP). Otherwise frames fall back to their arrival time until the first pong
+        self.assume_synced = assume_synced
+        self.window = window
+        self.clocks = {} # vehicle name -> VehicleClock
+        self.seq = 0
+        self.pongs = 0
+        self.ignored = 0 # Pongs from vehicles that aren't clients
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self,publish,now,interval,log=print):
+        # publish(message) sends a clock_ping, now() is the broker's clock, log(text) reports vehicles with no estimate
+        self.assume_synced = interval <= 0
+        if interval <= 0:
+            return self
+        def run():
+            while not self.stopped.wait(interval):
+                self.reportMissing(log)
+                self.seq += 1
+                publish({"seq":self.seq,"t0":now()})
+        self.thread = threading.Thread(target=run,name="clock_sync",daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def expect(self,source):
+        # A vehicle joined. Its pongs count from now on
+        if source not in self.clocks:
+            self.clocks[source] = VehicleClock(self.window,self.seq)
+
+    def unsynced(self):
+        # Vehicles without an offset estimate yet, whose frames are stamped with their arrival time (unless assume_synced)
+        return sorted(source for source,clock in list(self.clocks.items()) if clock.offset == None)
+
+    def reportMissing(self,log):
+        # Logs each vehicle that was sent a ping a whole interval ago and still has no estimate, once
+        missing = []
+        for source,clock in list(self.clocks.items()):
+            if clock.offset == None and not clock.reported and clock.joined < self.seq:
+                clock.reported = True
+                missing.append(source)
+        if len(missing) > 0:
+            log(f"No clock_pong from {', '.join(sorted(missing))}, their frames keep their arrival time as capture time")
+
+    def onPong(self,payload,t3):
+        # Returns the round trip, or None for a malformed pong
+        source = payload.get("source")
+        t0,t1,t2 = payload.get("t0"),payload.get("t1"),payload.get("t2")
+        if source == None or not all(isTime(t) for t in (t0,t1,t2)):
+            return None
+        clock = self.clocks.get(source)
+        if clock == None:
+            self.ignored += 1 # Not a client (or one that already left)
+            return None
+        round_trip = (t3 - t0) - (t2 - t1)
+        if round_trip < 0:
+            return None
+        clock.add(round_trip,((t1 - t0) + (t2 - t3)) / 2)
+        self.pongs += 1
+        return round_trip
+
+    def offset(self,source):
+        # Vehicle clock minus broker clock, or None without an estimate
+        clock = self.clocks.get(source)
+        if clock != None and clock.offset != None:
+            return clock.offset
+        return 0.0 if self.assume_synced else None
+
+    def forget(self,source):
+        self.clocks.pop(source,None)
+
+    def stamp(self,payload,arrival_time,staleness_clock="arrival"):
+        capture_time = arrival_time
+        sent = payload.get("timestamp")
+        if isTime(sent):
+            offset = self.offset(payload.get("source"))
+            if offset != None:
+                capture_time = min(sent - offset,arrival_time) # Nothing is captured after it arrives
+        payload["arrival_time"] = arrival_time
+        payload["capture_time"] = capture_time
+        payload["timestamp"] = capture_time if staleness_clock == "capture" else arrival_time
+
+    def getReport(self):
+        clocks = [clock for clock in list(self.clocks.values()) if clock.offset != None]
+        missing = self.unsynced()
+        if len(clocks) == 0:
+            report = f"Clock sync: no estimates yet ({self.seq} pings sent)"
+        else:
+            offsets = sorted(clock.offset for clock in clocks)
+            round_trips = sorted(clock.round_trip for clock in clocks)
+            report = f"Clock sync: {len(clocks)} vehicles, offsets {offsets[0]*1000:.1f}..{offsets[-1]*1000:.1f}ms, median round trip {round_trips[len(round_trips)//2]*1000:.1f}ms"
+        if len(missing) > 0:
+            report += f", no estimate for {', '.join(missing)}"
+        return report
+
+class SampleAges:
+    # Oldest and newest capture time among the frames a verdict uses, without a pass over the fleet.
+    # Two heaps of (capture time, seq, vehicle). An entry stops counting when its vehicle sends a newer frame or
+    # leaves, or when its frame goes stale, and none of those can be undone, so dead entries are dropped lazily
+    # when they reach the top of a heap
+    def __init__(self):
+        self.current = {} # vehicle -> (seq, staleness timestamp)
+        self.oldest_heap = []
+        self.newest_heap = []
+        self.seq = 0
+
+    def set(self,source,decision):
+        self.seq += 1
+        self.current[source] = (self.seq,decision["timestamp"])
+        capture_time = decision.get("capture_time",decision["timestamp"])
+        heapq.heappush(self.oldest_heap,(capture_time,self.seq,source))
+        heapq.heappush(self.newest_heap,(-capture_time,self.seq,source))
+        if len(self.oldest_heap) > 2 * len(self.current) + 64:
+            self.compact()
+
+    def remove(self,source):
+        self.current.pop(source,None)
+
+    def live(self,entry,cutoff):
+        current = self.current.get(entry[2])
+        return current != None and current[0] == entry[1] and current[1] >= cutoff
+
+    def window(self,cutoff):
+        # (oldest, newest) capture times of the frames whose staleness timestamp is >= cutoff. (None, None) if none
+        for heap in (self.oldest_heap,self.newest_heap):
+            while len(heap) > 0 and not self.live(heap[0],cutoff):
+                heapq.heappop(heap)
+        if len(self.oldest_heap) == 0:
+            return None,None
+        return self.oldest_heap[0][0],-self.newest_heap[0][0]
+
+    def compact(self):
+        self.oldest_heap = [entry for entry in self.oldest_heap if self.current.get(entry[2],(None,))[0] == entry[1]]
+        self.newest_heap = [entry for entry in self.newest_heap if self.current.get(entry[2],(None,))[0] == entry[1]]
+        heapq.heapify(self.oldest_heap)
+        heapq.heapify(self.newest_heap)
@@ -0,0 +1,182 @@
+# codec.py
+# Wire formats shared by the brokers.
+#
+#   "json"    - UTF-8 JSON. Uses orjson when it is installed, the standard library otherwise. Always understood by every client
+#   "msgpack" - MessagePack (needs the msgpack package)
+#   "packed"  - A compact struct-packed layout for verdict messages, full tables and delta-mode changes alike (see
+#               encodeVerdict). Other messages fall back to JSON
+#
+# Incoming payloads are sniffed, so decode() takes any of the three without being told which one it got.
+import json
+import struct
+
+try:
+    import orjson
+except ImportError:
+    orjson = None # Optional, the standard library json module is used instead
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None # Optional, "msgpack" is only offered when it is installed
+
+packed_magic = b"VF"
+packed_version = 1
+packed_header = struct.Struct("<2sBBHH") # magic, version, flags, plate count, object count
+packed_string = struct.Struct("<H") # Every string is a length followed by that many UTF-8 bytes
+
+def availableFormats():
+    formats = ["json","packed"]
+    if msgpack != None:
+        formats.append("msgpack")
+    return formats
+
+def plainValue(value):
+    # The `default` hook for the encoders: numpy scalars and arrays (e.g. a position from an estimator) become Python
+    # numbers and lists. orjson handles most numpy values itself, this catches the rest
+    if hasattr(value,"tolist"):
+        return value.tolist()
+    raise TypeError(f"Type is not serializable: {type(value).__name__}")
+
+def encodeJson(data):
+    if orjson != None:
+        return orjson.dumps(data,default=plainValue,option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+    return json.dumps(data,ensure_ascii=False,separators=(",",":"),default=plainValue).encode("utf-8")
+
+def packString(parts,text):
+    raw = str(text).encode("utf-8")
+    parts.append(packed_string.pack(len(raw)))
+    parts.append(raw)
+
+def unpackString(raw,offset):
+    (length,) = packed_string.unpack_from(raw,offset)
+    offset += packed_string.size
+    return raw[offset:offset+length].decode("utf-8"),offset + length
+
+packed_plates_only = 1 # Flag: the message is the plate table itself (parking_broker.py's verdicts)
+packed_keyed_spots = 2 # Flag: each spot string is preceded by its key, for tables that skip spots (verdict_delta.py's deltas)
+
+def isSpotTable(table):
+    return isinstance(table,dict) and all(isinstance(table.get(str(i)),str) for i in range(len(table)))
+
+def isKeyedSpotTable(table):
+    return isinstance(table,dict) and all(isinstance(key,str) and isinstance(value,str) for key,value in table.items())
+
+def isPackable(data):
+    # The packed layout covers {"message":{"plates":{"0":..,"1":..},"objects":{..}}, ...} and {"message":{"0":..,"1":..}, ...},
+    # including delta messages, whose plate tables only have the spots that changed
+    message = data.get("message")
+    if not isinstance(message,dict):
+        return False
+    if set(message.keys()) == {"plates","objects"}:
+        objects = message["objects"]
+        return isKeyedSpotTable(message["plates"]) and isinstance(objects,dict) and all(isinstance(label,str) or (isinstance(label,(list,tuple)) and len(label) > 0) for label in objects.values())
+    return isKeyedSpotTable(message)
+
+def encodeVerdict(data):
+    # Layout: header, source, one string per spot (in spot order, so the spot keys are implied; or (spot key, plate)
+    # pairs when the table skips spots), then (object id, label) string pairs, then any other top-level fields as a
+    # JSON object.
+    # Object verdicts with no label (the NoneObject placeholder) are sent as their first element, "None"
+    message = data["message"]
+    flags = 0
+    if "plates" in message and "objects" in message:
+        plates = message["plates"]
+        objects = message["objects"]
+    else:
+        flags = packed_plates_only
+        plates = message
+        objects = {}
+    keyed = not isSpotTable(plates)
+    if keyed:
+        flags |= packed_keyed_spots
+    parts = [packed_header.pack(packed_magic,packed_version,flags,len(plates),len(objects))]
+    packString(parts,data.get("source",""))
+    if keyed:
+        for spot,plate in plates.items():
+            packString(parts,spot)
+            packString(parts,plate)
+    else:
+        for i in range(len(plates)):
+            packString(parts,plates[str(i)])
+    for object_id,label in objects.items():
+        packString(parts,object_id)
+        packString(parts,label[0] if isinstance(label,(list,tuple)) else label)
+    extra = {key:value for key,value in data.items() if key not in ("message","source")}
+    if len(extra) > 0:
+        parts.append(encodeJson(extra))
+    return b"".join(parts)
+
+def decodeVerdict(raw):
+    magic,version,flags,plate_count,object_count = packed_header.unpack_from(raw,0)
+    if version != packed_version:
+        raise ValueError(f"Unsupported packed verdict version {version}")
+    offset = packed_header.size
+    source,offset = unpackString(raw,offset)
+    plates = {}
+    for i in range(plate_count):
+        spot = str(i)
+        if flags & packed_keyed_spots:
+            spot,offset = unpackString(raw,offset)
+        plates[spot],offset = unpackString(raw,offset)
+    objects = {}
+    for _ in range(object_count):
+        object_id,offset = unpackString(raw,offset)
+        objects[object_id],offset = unpackString(raw,offset)
+    data = {"source":source,"message":plates if flags & packed_plates_only else {"plates":plates,"objects":objects}}
+    if offset < len(raw):
+        data.update(decodeJson(raw[offset:]))
+    return data
+
+def decodeJson(raw):
+    if orjson != None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+def encode(data,wire_format="json"):
+    # data is never modified. Returns bytes
+    if wire_format == "packed" and isPackable(data):
+        return encodeVerdict(data)
+    if wire_format == "msgpack" and msgpack != None:
+        return msgpack.packb(data,use_bin_type=True,default=plainValue)
+    return encodeJson(data)
+
+def decode(raw):
+    # raw: bytes (or str) in any of the supported formats
+    if isinstance(raw,str):
+        return decodeJson(raw)
+    raw = bytes(raw)
+    if raw[:2] == packed_magic:
+        return decodeVerdict(raw)
+    first = raw.lstrip()[:1]
+    if first in (b"{",b"[",b'"') or msgpack == None:
+        return decodeJson(raw)
+    return msgpack.unpackb(raw,raw=False,strict_map_key=False)
+
+class FormatNegotiator:
+    # Picks the verdict wire format. Every subscriber receives the same verdict bytes, so the preferred format is only
+    # used while every connected client has said it accepts it (the "formats" list in its request_config message).
+    # Clients that never said anything only get JSON.
+    def __init__(self,preferred="json"):
+        if preferred not in ("json","packed","msgpack"):
+            raise ValueError(f"Unknown wire format: {preferred}")
+        if preferred == "msgpack" and msgpack == None:
+            print("msgpack is not installed, verdicts will be sent as JSON")
+            preferred = "json"
+        self.preferred = preferred
+        self.accepted = {} # client name -> set of formats it can decode
+
+    def accept(self,name,formats):
+        if formats != None:
+            self.accepted[name] = set(formats) | {"json"}
+
+    def forget(self,name):
+        self.accepted.pop(name,None)
+
+    def choose(self,names):
+        if self.preferred == "json":
+            return "json"
+        for name in names:
+            if self.preferred not in self.accepted.get(name,()):
+                return "json"
+        return self.preferred
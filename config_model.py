@@ -0,0 +1,176 @@
+# config_model.py
+# The client config files (consolidated_config.json, parking_config.json, object_config.json), checked once when they
+# are loaded and turned into the arrays and lookup tables the brokers use every verdict.
+#
+# A LotConfig never changes after it is built. Reloading means building a new one and handing it to the broker, which
+# swaps it in at the start of its next verdict (so a verdict never sees half of one config and half of another).
+# Reloads come from a ConfigWatcher (settings["config_reload"] = "watch") or from the control topic:
+#   broker_control  {"command":"reload_config"}                  (re-read the config file)
+#   broker_control  {"command":"reload_config","config":{...}}   (use this config instead)
+import json
+import os
+import threading
+from types import MappingProxyType
+from codec import encodeJson, availableFormats
+from spot_index import SpotIndex
+
+control_topic = "broker_control"
+
+required_keys = {
+    "consolidated":["max_decision_history","empty_parking_spot_locations","occupied_parking_spot_locations","true_parking_occupants","object_locations","vehicle_locations"],
+    "parking":["max_decision_history","empty_parking_spot_locations","occupied_parking_spot_locations","true_parking_occupants","vehicle_locations"],
+    "objects":["max_decision_history","object_locations","vehicle_locations"],
+}
+
+class ConfigError(ValueError):
+    pass
+
+def isNumber(value):
+    return isinstance(value,(int,float)) and not isinstance(value,bool)
+
+def positionProblems(where,position):
+    if not isinstance(position,dict):
+        return [f"{where} should be an object with x and y"]
+    return [f"{where}.{axis} should be a number" for axis in ("x","y") if not isNumber(position.get(axis))]
+
+def validateConfig(data,kind):
+    # Raises ConfigError listing everything wrong with the config, so one edit can fix them all
+    if kind not in required_keys:
+        raise ConfigError(f"Unknown config kind {kind}")
+    if not isinstance(data,dict):
+        raise ConfigError("The config should be a JSON object")
+    problems = [f"missing {key}" for key in required_keys[kind] if key not in data]
+    if len(problems) > 0:
+        raise ConfigError("; ".join(problems))
+    if not isinstance(data["max_decision_history"],int) or isinstance(data["max_decision_history"],bool) or data["max_decision_history"] < 1:
+        problems.append("max_decision_history should be a positive integer")
+    if "empty_parking_spot_locations" in required_keys[kind]:
+        empty = data["empty_parking_spot_locations"]
+        occupied = data["occupied_parking_spot_locations"]
+        truth = data["true_parking_occupants"]
+        for key,spots in (("empty_parking_spot_locations",empty),("occupied_parking_spot_locations",occupied),("true_parking_occupants",truth)):
+            if not isinstance(spots,list):
+                problems.append(f"{key} should be a list")
+        if len(problems) == 0:
+            if len(empty) == 0:
+                problems.append("the lot has no parking spots")
+            if not len(empty) == len(occupied) == len(truth):
+                problems.append(f"{len(empty)} empty spot locations, {len(occupied)} occupied spot locations and {len(truth)} true occupants should all match")
+            for i,spot in enumerate(empty):
+                problems += positionProblems(f"empty_parking_spot_locations[{i}]",spot)
+            for i,spot in enumerate(occupied):
+                problems += positionProblems(f"occupied_parking_spot_locations[{i}]",spot)
+            problems += [f"true_parking_occupants[{i}] should be a string" for i,plate in enumerate(truth) if not isinstance(plate,str)]
+    if "object_locations" in required_keys[kind]:
+        if not isinstance(data["object_locations"],dict) or len(data["object_locations"]) == 0:
+            problems.append("object_locations should be a non-empty object")
+        else:
+            for object_id,obj in data["object_locations"].items():
+                problems += positionProblems(f"object_locations.{object_id}",obj)
+                if isinstance(obj,dict) and "identities" in obj and not (isinstance(obj["identities"],list) and all(isinstance(label,str) for label in obj["identities"])):
+                    problems.append(f"object_locations.{object_id}.identities should be a list of labels")
+    if not isinstance(data["vehicle_locations"],dict):
+        problems.append("vehicle_locations should be an object")
+    else:
+        for name,vehicle in data["vehicle_locations"].items():
+            problems += positionProblems(f"vehicle_locations.{name}",vehicle)
+    if len(problems) > 0:
+        raise ConfigError("; ".join(problems))
+
+def readOnly(array):
+    array.flags.writeable = False
+    return array
+
+class LotConfig:
+    # Has the same attributes as fusion_context.LotGeometry, so it can be passed anywhere a geometry is expected
+    def __init__(self,data,kind,path=None):
+        validateConfig(data,kind)
+        self.kind = kind
+        self.path = path
+        self.data = data # The config as loaded. Sent to clients and written into output files, so leave it alone
+        self.max_decision_history = data["max_decision_history"]
+        # Parking spots
+        self.empty_locations = data.get("empty_parking_spot_locations",[])
+        self.occupied_locations = data.get("occupied_parking_spot_locations",[])
+        self.truth_values = tuple(data.get("true_parking_occupants",[]))
+        self.empty_spot_index = SpotIndex(self.empty_locations)
+        self.occupied_spot_index = SpotIndex(self.occupied_locations)
+        readOnly(self.empty_spot_index.coords)
+        readOnly(self.occupied_spot_index.coords)
+        # Objects, in config order
+        self.object_locations = data.get("object_locations",{})
+        self.object_ids = tuple(self.object_locations.keys())
+        self.object_identities = MappingProxyType({object_id:tuple(obj.get("identities",[])) for object_id,obj in self.object_locations.items()})
+        # Vehicles
+        self.vehicle_locations = data["vehicle_locations"]
+        self.payloads = {} # verdict format -> the encoded config message
+        self.payload_lock = threading.Lock()
+
+    def payload(self,verdict_format):
+        # The config message for clients: the config, plus the format verdicts are sent in and the formats we can send
+        with self.payload_lock:
+            if verdict_format not in self.payloads:
+                self.payloads[verdict_format] = encodeJson(dict(self.data,wire_format=verdict_format,wire_formats=availableFormats()))
+            return self.payloads[verdict_format]
+
+def loadConfig(path,kind):
+    try:
+        with open(path,"r") as config_file:
+            data = json.load(config_file)
+    except (OSError,json.JSONDecodeError) as e:
+        raise ConfigError(f"Could not read {path}: {e}")
+    return LotConfig(data,kind,path)
+
+def configFromControl(payload,current):
+    # The new config asked for by a broker_control reload_config message
+    if "config" in payload:
+        return LotConfig(payload["config"],current.kind,current.path)
+    return loadConfig(current.path,current.kind)
+
+class ConfigWatcher:
+    # Polls the config file's modification time and passes every valid new version to on_change.
+    # A broken edit is reported and skipped, and the broker keeps running on the config it has
+    def __init__(self,config,on_change,on_error=print,interval=1.0):
+        self.path = config.path
+        self.kind = config.kind
+        self.on_change = on_change
+        self.on_error = on_error
+        self.interval = interval
+        self.signature = self.fileSignature()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,name="config_watcher",daemon=True)
+
+    def fileSignature(self):
+        try:
+            info = os.stat(self.path)
+            return (info.st_mtime_ns,info.st_size)
+        except OSError:
+            return None
+
+    def check(self):
+        signature = self.fileSignature()
+        if signature == None or signature == self.signature:
+            return False
+        self.signature = signature
+        try:
+            self.on_change(loadConfig(self.path,self.kind))
+        except ConfigError as e:
+            self.on_error(f"Keeping the current config. {e}")
+            return False
+        return True
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.check()
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+def watcherFromSettings(settings,config,on_change,on_error=print):
+    if settings["config_reload"] != "watch":
+        return None
+    return ConfigWatcher(config,on_change,on_error,settings["config_reload_interval"]).start()
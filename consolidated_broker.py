@@ -1,13 +1,34 @@
 # parking_broker.py
-import paho.mqtt.client as mqtt
 import json
+import sys
 from collections import defaultdict as dd
 import time
 import numpy as np
 from colors import *
 from server_config import config as settings
+from broker_core import runBroker, PahoTransport
+from client_registry import ClientRegistry
+from ring_buffer import RingBuffer
+from fusion_context import NoneObject, LotClient, partialTally, fuseTally, verdictAccuracy, liveDecisions, isExhausted
+from incremental_fusion import IncrementalTally
+from reputation_fusion import ObjectFusion
+from temporal_fusion import temporalFromSettings
 from time import sleep as wait
+from time import perf_counter_ns # Stage timers. Not through `time`, which replays swap for a simulated clock
 import argparse
+import threading
+from ingest_queue import IngestQueue, FusionWorker
+from vehicle_mailbox import VehicleMailbox, peekSource
+from verdict_scheduler import schedulerThreadFor, schedulerFromSettings
+from codec import encode, decode, encodeJson, availableFormats, FormatNegotiator
+from config_model import loadConfig, configFromControl, watcherFromSettings, ConfigError, control_topic
+from verdict_delta import VerdictPublisher
+from dashboard import dashboardFromSettings, clear_screen
+from result_writer import writerFromSettings, finalizeConsolidated
+from archive import exportRun
+from metrics import registry as broker_metrics, reporterFromSettings, metrics_topic
+from clock_sync import ClockSync, SampleAges, ping_topic, pong_topic, receiveTime
+from profiler import ProfileControl, profile_commands, profile_topic
 
 broker_IP = "localhost"
 port_Num = 1883
@@ -15,128 +36,101 @@ last_verdict_time = 0.0
 
 broker_start_time = 0
 
-client_config_file = open("consolidated_config.json","r")
-client_config_str = client_config_file.read()
-client_config_data = json.loads(client_config_str)
-client_config_file.close()
+# Validated once here (see config_model.py). Replaced by a new LotConfig when the config is reloaded
+lot_config = loadConfig("consolidated_config.json","consolidated")
+client_config_data = lot_config.data
+pending_config = None # A reloaded config, swapped in at the start of the next verdict
+config_watcher = None # Only used when settings["config_reload"] == "watch"
 
-empty_locations = client_config_data["empty_parking_spot_locations"]
-occupied_locations = client_config_data["occupied_parking_spot_locations"]
-truth_values = client_config_data["true_parking_occupants"]
-object_locations = client_config_data["object_locations"]
-vehicle_locations = client_config_data["vehicle_locations"]
+# Spot and object locations, ground truth and spot indexes. A LotConfig works as a fusion_context.LotGeometry
+geometry = lot_config
 
-NoneObject = ["None",0.1,0.0]
-
-plate_history = [] # Contents look like: 0.75, 0.67, ... THIS is a list of PARKING decisions based on snapshot accuracy %
-object_history = [] # Contents look like: 0.75, 0.67, ... THIS is a list of OBJECT decisions based on snapshot accuracy %
+# Both histories keep only the last max_decision_history verdicts
+plate_history = RingBuffer(client_config_data["max_decision_history"]) # Contents look like: 0.75, 0.67, ... THIS is a list of PARKING decisions based on snapshot accuracy %
+object_history = RingBuffer(client_config_data["max_decision_history"]) # Contents look like: 0.75, 0.67, ... THIS is a list of OBJECT decisions based on snapshot accuracy %
 verdict_id = 0
 
+ingest_queue = None # Only used when settings["ingest_mode"] is "queued" or "mailbox"
+vehicle_mailbox = None # Only used when settings["ingest_mode"] == "mailbox"
+fusion_worker = None
+fusion_tally = IncrementalTally() if settings["fusion_mode"] == "incremental" else None # Running tallies, see incremental_fusion.py
+object_fusion = ObjectFusion(lot_config.object_ids,settings["confidence_calibration"]) if settings["object_fusion"] == "weighted" else None # Weighted object votes, see reputation_fusion.py
+temporal_fusion = temporalFromSettings(settings) # Votes over the last temporal_window verdicts, see temporal_fusion.py. None when off
+state_lock = threading.RLock() # Held while client decisions change or a verdict runs on the network thread
+verdict_scheduler = None # Paces the fusion worker, or the scheduler thread when settings["verdict_trigger"] == "scheduled"
+scheduler_thread = None
+dashboard = None # Console output, see dashboard.py. None when settings["dashboard_mode"] == "off"
+result_writer = None # Streams results to outputs/output_{test_id}.jsonl as they are produced, see result_writer.py
+metrics_reporter = None # Serves and publishes broker_metrics, see metrics.py
+profile_control = None # Runs the start_profile/stop_profile control commands, see profiler.py
+clock_sync = ClockSync() # Per-vehicle clock offsets, so frames keep their capture time. See clock_sync.py
+sample_ages = SampleAges() # Capture times of the frames the next verdict can use
+
 parser = argparse.ArgumentParser(description="Consolidated Broker for Parking Lot Data")
 parser.add_argument("-id",type=int,help="Test ID number",default=0)
-args = parser.parse_args()
-test_id = args.id
+test_id = 0 # Set from the command line when run as a script
 
 def log_decision(verdicts):
-    # Plates
-    accuracy = len([v for i,v in verdicts["plates"].items() if truth_values[int(i)]==v]) / len(verdicts["plates"])
-    plate_history.append(accuracy)
-    # Objects
-    accuracy = len([v for i,v in verdicts["objects"].items() if object_locations[i]==v]) / len(verdicts["objects"])
-    object_history.append(accuracy)
-    # Clear the oldest piece of data if the log is too long
-    if len(object_history) > client_config_data["max_decision_history"]:
-        object_history.pop(0)
-        plate_history.pop(0)
-
-
-def print_decision_report():
-    global broker_start_time
-    print()
+    plates,objects = verdictAccuracy(verdicts,geometry)
+    plate_history.append(plates)
+    object_history.append(objects)
+
+
+def getDecisionReport(snapshot):
+    # Returns the report as a list of lines
+    lines = [""]
     # Print the accuracy of all available decisions, for both QR plate detection and object detection
-    print(f"Mean QR PLATE accuracy in last {getYellow(len(plate_history))} verdicts: {getGreen(np.round(np.mean(plate_history)*100,3))}%")
-    print(f"Mean OBJECT accuracy in last {getYellow(len(object_history))} verdicts: {getGreen(np.round(np.mean(object_history)*100,3))}%")
+    count,mean,std = snapshot["plate_history"]
+    lines.append(f"Mean QR PLATE accuracy in last {getYellow(count)} verdicts: {getGreen(np.round(mean*100,3))}% (std {np.round(std*100,3)}%)")
+    count,mean,std = snapshot["object_history"]
+    lines.append(f"Mean OBJECT accuracy in last {getYellow(count)} verdicts: {getGreen(np.round(mean*100,3))}% (std {np.round(std*100,3)}%)")
     # Determine how far along we are in the experiment
-    ratio = (len(plate_history)-10)/(client_config_data['max_decision_history']-10)*50
-    avg_time_per_verdict = (time.time()-broker_start_time) / len(plate_history)
+    count = snapshot["plate_history"][0]
+    verdict_id = snapshot["verdict_id"]
+    ratio = (count-10)/(client_config_data['max_decision_history']-10)*50
+    avg_time_per_verdict = (snapshot["time"]-broker_start_time) / count
     if avg_time_per_verdict < 0.1 or avg_time_per_verdict > 2:
         avg_time_per_verdict = 1
     # Progress / status bar
-    print(f"[{getCyan('#'*int(ratio))}{'.'*(50-int(ratio))}]")
-    print(f"Progress: {getYellow(verdict_id-10)}/{client_config_data['max_decision_history']} ({getGreen(np.round((verdict_id-10)/client_config_data['max_decision_history']*100,3))}%). ETA: {getYellow(np.round((client_config_data['max_decision_history']-verdict_id+10)*avg_time_per_verdict,3))}s")
-
-class Client:
+    lines.append(f"[{getCyan('#'*int(ratio))}{'.'*(50-int(ratio))}]")
+    lines.append(f"Progress: {getYellow(verdict_id-10)}/{client_config_data['max_decision_history']} ({getGreen(np.round((verdict_id-10)/client_config_data['max_decision_history']*100,3))}%). ETA: {getYellow(np.round((client_config_data['max_decision_history']-verdict_id+10)*avg_time_per_verdict,3))}s")
+    lines.extend(snapshot["reports"])
+    return lines
+
+def accuracyReport(plate_votes,plate_accuracy,object_votes,object_accuracy):
+    line1 = f"Accuracy of last {getYellow(plate_votes)} PLATE votes: {getGreen(np.round(plate_accuracy*100,3))}%"
+    line2 = f"Accuracy of last {getYellow(object_votes)} OBJECT votes: {getGreen(np.round(object_accuracy*100,3))}%"
+    return (line1+'\n'+line2) if plate_votes > 0 else "No decisions made yet."
+
+class Client(LotClient):
+    # fusion_context.LotClient, plus what this broker tracks for every decision (metrics, sample ages, fusion tallies)
     def __init__(self,client_name):
-        self.name = client_name
-        self.decision = None
+        super().__init__(client_name,client_config_data["max_decision_history"])
         self.reputation = 0.5
-        self.plate_history = []
-        self.object_history = []
 
     def makeDecision(self,decision):
         self.decision = decision
 
-    def getDecision(self):
-        return self.decision
-    
     def setDecision(self,decision):
         self.decision = decision
+        broker_metrics.noteFrame(decision)
+        sample_ages.set(self.name,decision)
+        if fusion_tally != None:
+            fusion_tally.setDecision(self.name,decision)
+        if object_fusion != None:
+            object_fusion.setFrame(self.name,decision["object_list"],decision["timestamp"])
     
     def getReputation(self):
+        if object_fusion != None:
+            return object_fusion.getReputation(self.name)
         return self.reputation
     
+    def getAccuracy(self):
+        # (plate votes, plate accuracy, object votes, object accuracy), see accuracyReport
+        return (len(self.plate_history),self.plate_history.mean(),len(self.object_history),self.object_history.mean())
+
     def getAccuracyReport(self):
-        line1 = f"Accuracy of last {getYellow(len(self.plate_history))} PLATE votes: {getGreen(np.round(np.mean(self.plate_history)*100,3))}%"
-        line2 = f"Accuracy of last {getYellow(len(self.object_history))} OBJECT votes: {getGreen(np.round(np.mean(self.object_history)*100,3))}%"
-        return (line1+'\n'+line2) if len(self.plate_history) > 0 else "No decisions made yet."
-    
-    def noteOutcome(self,verdicts):
-        val = 0
-        # Update accuracy history...
-        dec = self.decision
-        if dec != None:
-            val = 0
-            for obj in dec["parking_list"]:
-                if obj == None:
-                    continue
-                if obj['text'] == "EMPTY":
-                    closest_spot = getClosestObject(empty_locations,obj['position'])
-                    if verdicts["plates"][str(closest_spot)] == "EMPTY":
-                        val += 1
-                else:
-                    if verdicts["plates"][str(getClosestObject(occupied_locations,obj['position']))] == obj['text']:
-                        val += 1
-            self.plate_history.append(val / len(verdicts["plates"]))
-
-            obj_val = 0
-            for id,obj in dec["object_list"].items():
-                if obj == None or len(obj)==0:
-                    continue
-                my_dec = max(obj,key=obj.get)
-                if my_dec != None and my_dec != "None" and verdicts["objects"][id] == my_dec:
-                    obj_val += 1
-            self.object_history.append(obj_val / len(verdicts["objects"]))
-            # Trim the decision history to prevent memory leakage
-            if len(self.plate_history) > client_config_data["max_decision_history"]:
-                self.plate_history.pop(0)
-                self.object_history.pop(0)
-
-        # Update reputation...
-        try:
-            # Don't do anything if you made NO decisions
-            if self.getDecision() == None:
-                return
-            #self.reputation = clamp(self.reputation + sum(comparisons) * settings["reputation_increment"], settings["min_reputation"], 1)
-            dec = self.getDecision()['parking_list']
-            # Return the number of decisions that were changed (disagreements)
-            val = len(empty_locations) - len(dec)
-        except Exception as e:
-            print(e)
-        finally:
-            return val
-
-    def getName(self):
-        return self.name
+        return accuracyReport(*self.getAccuracy())
 
     def __str__(self):
         return self.name + ": " + str(self.decision)
@@ -150,17 +144,25 @@ main_client = None
 def clamp(value,min_value=0.0,max_value=1.0):
     return max(min_value, min(value, max_value))
 
-def encodePayload(data):
-    data["source"] = "main_broker"
-    output = bytearray()
-    output.extend(map(ord,json.dumps(data)))
-    return output
+def encodePayload(data,wire_format="json"):
+    return encode(dict(data,source="main_broker"),wire_format)
 
-def decodePayload(string_data):
-    return json.loads(string_data)
+def decodePayload(raw):
+    return decode(raw)
 
 def publish(CLIENT,topic,message):
-    CLIENT.publish(topic,payload=encodePayload(message),qos=0,retain=False)
+    # Verdicts go out in the negotiated wire format, everything else as JSON
+    CLIENT.publish(topic,payload=encodePayload(message,verdict_format if topic == "verdict" else "json"),qos=0,retain=False)
+
+verdict_publisher = VerdictPublisher() # Replaced in startBroker, according to settings["verdict_publish_mode"]
+
+def publishVerdict(verdicts,sample_age=None):
+    # The full verdict, or (in delta mode) what changed since the last one. Keyframes also replace the retained snapshot.
+    # Verdict messages also say how old the frames behind them were: {"oldest":seconds,"newest":seconds}
+    for topic,message,retain in verdict_publisher.messages(verdict_id,verdicts):
+        if topic == "verdict":
+            message = dict(message,sample_age=sample_age)
+        main_client.publish(topic,payload=encodePayload(message,verdict_format),qos=0,retain=retain)
 
 def on_connect(CLIENT, userdata, flags, rc):
     prCyan(f"Connected with result code {rc}")
@@ -170,106 +172,141 @@ def on_connect(CLIENT, userdata, flags, rc):
     # Subscribe to view incoming data from clients
     CLIENT.subscribe("data_V2B")
     CLIENT.subscribe("request_config")
+    CLIENT.subscribe(control_topic)
+    CLIENT.subscribe(pong_topic)
 
-activeClients = []
+activeClients = ClientRegistry() # Looks up clients by name, iterates in name order
+
+wire_formats = FormatNegotiator() # Replaced in startBroker, with settings["wire_format"] as the preferred format
+verdict_format = "json" # The format verdicts currently go out in
+
+def updateWireFormat():
+    # Re-negotiate the verdict format after the client list (or what a client accepts) changed. Returns True if it changed
+    global verdict_format
+    chosen = wire_formats.choose(client.getName() for client in activeClients)
+    if chosen == verdict_format:
+        return False
+    prCyan(f"Verdicts are now sent as {chosen}")
+    verdict_format = chosen
+    return True
 
 def issueConfig():
-    CLIENT.publish("config",payload=client_config_str,qos=0,retain=False)
+    # The client config, plus the format verdicts are sent in and the formats this broker can send
+    CLIENT.publish("config",payload=lot_config.payload(verdict_format),qos=0,retain=False)
+
+def queueConfig(new_config):
+    # Called by the config watcher thread, or for a broker_control reload. The swap waits for the next verdict
+    global pending_config
+    pending_config = new_config
+    prCyan("Config reloaded, it takes effect at the next verdict")
+
+def reloadFromControl(payload):
+    try:
+        queueConfig(configFromControl(payload,lot_config))
+    except ConfigError as e:
+        prRed(f"Keeping the current config. {e}")
+
+def applyPendingConfig():
+    # Swap in a reloaded config between verdicts. Clients, their decisions and every history stay as they are
+    global pending_config, lot_config, client_config_data, geometry
+    new_config = pending_config
+    if new_config == None:
+        return False
+    pending_config = None
+    if new_config.max_decision_history != lot_config.max_decision_history:
+        prYellow("max_decision_history changed. The run ends at the new count, histories keep their old length")
+    lot_config = new_config
+    client_config_data = new_config.data
+    geometry = new_config
+    if object_fusion != None:
+        object_fusion.setObjects(new_config.object_ids)
+    if result_writer != None:
+        result_writer.write({"type":"config","config":client_config_data})
+    issueConfig()
+    return True
 
 def initializeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                raise Exception("Client already exists")
-        new_client = Client(client_name)
-        activeClients.append(new_client)
-        activeClients.sort(key=lambda x: x.name)
+        if client_name in activeClients:
+            raise Exception("Client already exists")
+        new_client = activeClients.add(Client(client_name))
+        clock_sync.expect(client_name)
+        updateWireFormat()
         issueConfig()
+        verdict_publisher.requestKeyframe() # So the new client doesn't have to wait for the next scheduled one
         prCyan("Added client: "+client_name)
         return new_client
     except:
         prRed("Failed to add client. Client already exists: "+client_name)
 
 def removeClient(client_name):
+    if vehicle_mailbox != None:
+        vehicle_mailbox.discard(client_name) # A frame parked before end_client must not re-create the client
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                activeClients.remove(client)
-                prCyan("Removed client: "+client_name)
-                return
-        raise Exception("Client not found")
-    except:
+        activeClients.remove(client_name)
+        wire_formats.forget(client_name)
+        clock_sync.forget(client_name)
+        sample_ages.remove(client_name)
+        if fusion_tally != None:
+            fusion_tally.remove(client_name)
+        if object_fusion != None:
+            object_fusion.removeClient(client_name)
+        if updateWireFormat():
+            issueConfig()
+        prCyan("Removed client: "+client_name)
+    except KeyError:
         prRed("Failed to remove client. Client not found: "+client_name)
 
-def getClosestObject(parking_list,pos):
-    closest_id = 0
-    closest_distance = -1
-    for i,obj in enumerate(parking_list):
-        distance = np.sqrt((obj['x']-pos['x'])**2 + (obj['y']-pos['y'])**2)
-        if distance < closest_distance or closest_distance == -1:
-            closest_distance = distance
-            closest_id = i
-    return closest_id
-
 def getDistance(x1,y1,x2,y2):
     return np.sqrt((x1-x2)**2 + (y1-y2)**2)
 
 def quitIfExhausted():
     global verdict_id
-    if verdict_id >= client_config_data["max_decision_history"] + 10 or verdict_id<0:
+    if isExhausted(verdict_id,client_config_data["max_decision_history"]) or verdict_id<0:
         if verdict_id > 0:
+            for topic,message,retain in verdict_publisher.clearSnapshot():
+                main_client.publish(topic,payload=message,qos=0,retain=retain)
             # Tell the clients that the data collection is done. Communication is key! :)
             publish(main_client,"finished",{"message":"I'm done!"})
+            if dashboard != None:
+                dashboard.stop()
+            if config_watcher != None:
+                config_watcher.stop()
+            if metrics_reporter != None:
+                metrics_reporter.stop()
+            clock_sync.stop()
+            if profile_control != None:
+                profile_control.stop()
             # Display the config data:
             print(f"\nConfig data: {getCyan(client_config_data)}")
-            output_file = open(f"outputs/output_{test_id}.json","w")
-            output_file.write(json.dumps({
-                "plate_history":plate_history,
-                "object_history":object_history,
-                "config":client_config_data,
-                "client_reports": {client.getName(): {"plates":client.plate_history,"objects":client.object_history} for client in activeClients}
-            }))
-            wait(1)
-            exit(0)
+            # Everything is already on disk. Fold the stream into the usual output file
+            if result_writer != None:
+                result_writer.write({"type":"end","clients":[client.getName() for client in activeClients]})
+                result_writer.close()
+                finalizeConsolidated(result_writer.path,f"outputs/output_{test_id}.json")
+                if settings["archive_results"]:
+                    exportRun(f"outputs/output_{test_id}.json")
+            if not hasattr(main_client,"requestShutdown"):
+                # A bare paho client gets a second to send what is queued. broker_core.py drains its queue instead,
+                # and sends "finished" last
+                wait(1)
+                exit(0)
+            main_client.requestShutdown()
         verdict_id = -1
         return True
     else:
         return False
     
-def parseStack(stack,taken_spots):
-    while len(stack) > 0:
-        this_plate = stack.pop()
-        plate,mean_x,mean_y = this_plate
-        closest_spot = None
-        closest_dist = None
-        for i,spot in enumerate(taken_spots):
-            # Distance from the mean position of the license plate to the center of the parking spot
-            dist = getDistance(spot['position']['x'],spot['position']['y'],mean_x,mean_y)
-            # Only consider spots that would actually make an improvement
-            if closest_dist == None or dist < closest_dist:
-                if spot['plate'] == None: # If the spot is empty, just take it
-                        closest_dist = dist
-                        closest_spot = i
-                else: # If the spot is taken, only take it if the current plate is closer than the one already there
-                    if dist < getDistance(spot['position']['x'],spot['position']['y'],spot['plate'][1],spot['plate'][2]):
-                        closest_dist = dist
-                        closest_spot = i
-
-        closest = taken_spots[closest_spot]
-
-        # If replacing an old item, put it back into the stack
-        if closest['plate'] != None:
-            stack.append(closest['plate'])
-
-        closest['plate'] = this_plate
-
 def getVerdict():
     global last_verdict_time
     global verdict_id
 
+    applyPendingConfig()
+
     # Exit out of the loop after all the necessary data has been compiled!
     if quitIfExhausted(): return
 
+    verdict_start = perf_counter_ns()
     NOW = time.time()
     '''if (NOW - last_verdict_time) < settings["verdict_min_refresh_time"]:
         print(f"Returning. Now: {NOW}, Last: {last_verdict_time}")
@@ -279,186 +316,294 @@ def getVerdict():
     last_verdict_time = NOW
     verdict_id += 1 # Increment the verdict ID
 
-    # Initialize a list of blank Default Dictionaries to count occurrences of each decision
-    global dd
-    plate_counts = dd(int)
-    license_plates = ["EMPTY"] * len(empty_locations)
-    # For license plates...
-    position_tally = {}
-
-    # Initialize a dictionary of object identities
-    object_identities = {}
-    for key in object_locations.keys():
-        object_identities[key] = dd(float)
+    broker_metrics.recordAges(NOW)
+    oldest,newest = sample_ages.window(NOW - settings["oldest_allowable_data"])
+    sample_age = None
+    if oldest != None:
+        sample_age = {"oldest":NOW - oldest,"newest":NOW - newest}
+        broker_metrics.recordAge("verdict_oldest",sample_age["oldest"])
+        broker_metrics.recordAge("verdict_newest",sample_age["newest"])
+
+    start = perf_counter_ns()
+    if fusion_tally != None:
+        # The tallies are kept up to date as decisions arrive. Only the expired ones are left to take out
+        fusion_tally.expire(NOW)
+        tally = fusion_tally.tally()
+    else:
+        tally = partialTally(liveDecisions(activeClients,NOW))
+    broker_metrics.record("tally",start)
+    start = perf_counter_ns()
+    verdicts,taken_spots = fuseTally(tally,geometry)
+    broker_metrics.record("fuse",start)
+    if object_fusion != None:
+        start = perf_counter_ns()
+        verdicts["objects"] = object_fusion.verdicts(NOW,NoneObject)
+        broker_metrics.record("object_fusion",start)
+    if temporal_fusion != None:
+        start = perf_counter_ns()
+        verdicts = temporal_fusion.smooth(verdicts)
+        broker_metrics.record("temporal",start)
 
-    # Clear the output log
-    print("\033[H\033[J", end="")
+    # Publish the verdict
+    start = perf_counter_ns()
+    publishVerdict(verdicts,sample_age)
+    broker_metrics.record("publish",start)
 
-    # Display separator for verdict presentation
-    if settings["show_verbose_output"]:
-        print("-"*40)
-        print(f"Getting verdict #{getYellow(verdict_id)} (t=...{getCyan(np.round(NOW%10000,3))}s)")
-        print("-"*40)
+    # Log the decision
+    start = perf_counter_ns()
+    log_decision(verdicts)
+    broker_metrics.record("log_decision",start)
 
+    start = perf_counter_ns()
     for client in activeClients:
-        local_weight_factor = 1 # This variable will serve as the reliability of the vehicle
-        decision = client.getDecision()
-        # Throw out expired decisions
-        if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
-            print(f"Skipping client: {client.getName()}")
-            continue
-        ############################################################################################################
-        ''' DO OBJECT DETECTION STUFF '''
-        ############################################################################################################
-        for object_id,this_dd in decision["object_list"].items():
-            if this_dd == None:
-                continue
-            for key in this_dd.keys():
-                object_identities[object_id][key] += this_dd[key] * local_weight_factor
-        ############################################################################################################
-        ''' DO LICENSE PLATE STUFF '''
-        ############################################################################################################
-        # Get the list of detected plates
-        detected_plates = decision["parking_list"]
-
-        # Go through each detected plate and tally up the position
-        for qr in detected_plates:
-            if qr['text'] == "EMPTY":
-                closest_spot = getClosestObject(empty_locations,qr['position'])
-                plate_counts[closest_spot] -= 1
-            else:
-                if qr['text'] not in position_tally.keys():
-                    position_tally[qr['text']] = {'x':0,'y':0,'count':0}
-
-                position_tally[qr['text']]['x'] += qr['position']['x']
-                position_tally[qr['text']]['y'] += qr['position']['y']
-                position_tally[qr['text']]['count'] += 1
-
-        # Verbose output
-        if settings["show_verbose_output"]:
-            print(f"@{getPurple(client.getName())} (rep={getYellow(np.round(client.getReputation(),3))}) ({client.getAccuracyReport()}):")
-            if len(detected_plates) > 0:
-                for qr in detected_plates:
-                    print(f"--> {getGreen(qr['text'])} (x={getCyan(np.round(qr['position']['x'],2))},y={getCyan(np.round(qr['position']['y'],2))},|d|={getCyan(np.round(qr['distance'],2))})")
+        client.noteOutcome(verdicts,geometry)
+    if object_fusion != None:
+        object_fusion.updateReputations(NOW)
+    broker_metrics.record("outcomes",start)
+
+    if result_writer != None:
+        start = perf_counter_ns()
+        result_writer.write({"type":"verdict","id":verdict_id,"time":NOW,"plates":plate_history.last(),"objects":object_history.last()})
+        result_writer.write({"type":"outcomes","id":verdict_id,"clients":{client.getName():[client.plate_history.last(),client.object_history.last()] for client in activeClients if client.getDecision() != None}})
+        broker_metrics.record("result_writer",start)
+
+    if dashboard != None:
+        # Hand the renderer a copy of what it shows. All of the formatting happens in renderDashboard
+        start = perf_counter_ns()
+        dashboard.update(dashboardSnapshot(NOW,taken_spots,verdicts))
+        broker_metrics.record("dashboard",start)
+    broker_metrics.record("verdict",verdict_start)
+
+def dashboardSnapshot(NOW,taken_spots,verdicts):
+    # Plain copies of everything renderDashboard shows, taken under state_lock. The renderer runs on its own thread
+    # while the next verdicts update the clients, histories and counters, so it must not hold on to any of them
+    with state_lock:
+        clients = []
+        for client in activeClients:
+            decision = client.getDecision()
+            if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
+                clients.append((client.getName(),None))
+            elif not settings["show_verbose_output"]:
+                clients.append((client.getName(),{}))
             else:
-                print(f"--> {getRed('No QR codes detected')}")
-        # example: @euclid (rep=0.500): ABCD123 (x=4.56,y=-6.40, |d|=8.41), IJKL456, XY12ZA3
-
-    print() # Get that nice, sweet newline!
-    
-    # Record table of average positions for each detected license plate
-    stack = []
-    taken_spots = [{'position':x,'plate':None} for x in occupied_locations]
-
-    for plate,val in position_tally.items():
-        mean_x = val['x'] / val['count']
-        mean_y = val['y'] / val['count']
-        stack.append([plate,mean_x,mean_y])
-
-    # Optimize the license plate positions into unique 2D spots. Updates the value of taken_spots
-    parseStack(stack,taken_spots)
-    
-    # Empty verdicts table
-    plate_verdicts = {}
-    object_verdicts = {}
-    # Summarize the final plate verdicts in a simpler format
-    for i,spot in enumerate(taken_spots):
-        if spot['plate'] != None:
-            plate,mean_x,mean_y = spot['plate']
-            plate_verdicts[str(i)] = plate
+                clients.append((client.getName(),{
+                    "reputation":client.getReputation(),
+                    "accuracy":client.getAccuracy(),
+                    "counters":vehicle_mailbox.getCounters(client.getName()) if vehicle_mailbox != None else None,
+                    "plates":[(qr["text"],qr["position"]["x"],qr["position"]["y"],qr["distance"]) for qr in decision["parking_list"]],
+                }))
+        return {
+            "verdict_id":verdict_id,
+            "time":NOW,
+            "clients":clients,
+            "spots":[spot['plate'] for spot in taken_spots], # (plate, mean x, mean y) tuples or None
+            "objects":{i:(None if obj == None else obj[0]) for i,obj in verdicts["objects"].items()},
+            "plate_history":(len(plate_history),plate_history.mean(),plate_history.std()),
+            "object_history":(len(object_history),object_history.mean(),object_history.std()),
+            "reports":[part.getReport() for part in (ingest_queue,vehicle_mailbox,verdict_scheduler,clock_sync if settings["clock_sync_interval"] > 0 else None) if part != None],
+        }
+
+def renderDashboard(snapshot):
+    # One screen of console output for a verdict snapshot (see dashboard.py)
+    lines = []
+    NOW = snapshot["time"]
+    if settings["show_verbose_output"]:
+        # Display separator for verdict presentation
+        lines.append("-"*40)
+        lines.append(f"Getting verdict #{getYellow(snapshot['verdict_id'])} (t=...{getCyan(np.round(NOW%10000,3))}s)")
+        lines.append("-"*40)
+    for name,client in snapshot["clients"]:
+        if client == None:
+            lines.append(f"Skipping client: {name}")
+            continue
+        if not settings["show_verbose_output"]:
+            continue
+        detected_plates = client["plates"]
+        lines.append(f"@{getPurple(name)} (rep={getYellow(np.round(client['reputation'],3))}) ({accuracyReport(*client['accuracy'])}):")
+        if client["counters"] != None:
+            received,superseded = client["counters"]
+            lines.append(f"    frames received: {getYellow(received)}, superseded unread: {getYellow(superseded)}")
+        if len(detected_plates) > 0:
+            for text,x,y,distance in detected_plates:
+                lines.append(f"--> {getGreen(text)} (x={getCyan(np.round(x,2))},y={getCyan(np.round(y,2))},|d|={getCyan(np.round(distance,2))})")
         else:
-            plate_verdicts[str(i)] = "EMPTY"
-    # Update the list of object verdicts
-    for key in object_identities.keys():
-        object_verdicts[key] = max(object_identities[key],key=object_identities[key].get,default=NoneObject)
-    
-    verdicts = {
-        "plates":plate_verdicts,
-        "objects":object_verdicts,
-    }
-
-    # Publish the verdict
-    publish(main_client,"verdict",{"message":verdicts})
-
+            lines.append(f"--> {getRed('No QR codes detected')}")
+        # example: @euclid (rep=0.500): ABCD123 (x=4.56,y=-6.40, |d|=8.41), IJKL456, XY12ZA3
+    lines.append("")
     if settings["show_verbose_output"]:
-        for i,spot in enumerate(taken_spots):
-            if spot['plate'] != None:
-                plate,mean_x,mean_y = spot['plate']
-                print(f"{getYellow(i+1)}) Consensus: {getGreen(plate)} ({getCyan(np.round(mean_x,2))},{getCyan(np.round(mean_y,2))})")
+        for i,plate in enumerate(snapshot["spots"]):
+            if plate != None:
+                plate,mean_x,mean_y = plate
+                lines.append(f"{getYellow(i+1)}) Consensus: {getGreen(plate)} ({getCyan(np.round(mean_x,2))},{getCyan(np.round(mean_y,2))})")
             else:
-                print(f"{getYellow(i+1)}) Consensus: {getRed('EMPTY')}")
-        print()
-        for i,obj in object_verdicts.items():
-            if obj == None:
-                print(f"Object {getYellow(i)}: {getRed('None')}")
+                lines.append(f"{getYellow(i+1)}) Consensus: {getRed('EMPTY')}")
+        lines.append("")
+        for i,label in snapshot["objects"].items():
+            if label == None:
+                lines.append(f"Object {getYellow(i)}: {getRed('None')}")
             else:
-                print(f"Object {getYellow(i)}: {getGreen(obj[0])}")
-
-    # Log the decision
-    log_decision(verdicts)
-
-    print_decision_report()
-
-    for client in activeClients:
-        client.noteOutcome(verdicts)
+                lines.append(f"Object {getYellow(i)}: {getGreen(label)}")
+    lines.extend(getDecisionReport(snapshot))
+    return clear_screen + "\n".join(lines) + "\n"
 
 def didEveryoneDecide():
+    # True once every live client (one with unexpired data) has reported since the last verdict
+    NOW = time.time()
+    anyone_live = False
     for client in activeClients:
-        if client.getDecision() == None:
+        decision = client.getDecision()
+        if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
+            continue
+        if decision.get("arrival_time",decision["timestamp"]) <= last_verdict_time:
             return False
-    return True
+        anyone_live = True
+    return anyone_live
 
 def getClientByName(client_name):
-    for client in activeClients:
-        if client.getName() == client_name:
-            return client
-    return None
+    return activeClients.get(client_name)
 
-def interpretData(payload):
+def storeDecision(payload):
+    start = perf_counter_ns()
     client = getClientByName(payload["source"])
-    payload["timestamp"] = time.time()
+    broker_metrics.record("lookup",start)
     if client == None:
         prCyan("Attempting to create new client, "+payload["source"])
         client = initializeClient(payload["source"])
         if client == None:
             prRed("Failed to create new client")
-            return
+            return None
+    start = perf_counter_ns()
     client.setDecision(payload)
-    if time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
+    broker_metrics.record("store",start)
+    return client
+
+def interpretData(payload):
+    if storeDecision(payload) == None:
+        return
+    if scheduler_thread != None:
+        # Verdicts run on a fixed schedule. Just let the scheduler know, in case everyone has reported now
+        scheduler_thread.notify()
+    elif time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
         getVerdict()
 
-# The callback function, it will be triggered when receiving messages
-def on_message(CLIENT, userdata, msg):
-    global broker_start_time
-    if broker_start_time == 0:
-        broker_start_time = time.time()
-    # Turn from byte array to string text
-    payload = msg.payload.decode("utf-8")
-    # Turn from string text to data structure
-    payload = decodePayload(payload)
+def fuseMailbox():
+    # Decode only the newest frame from each vehicle, then run the verdict
+    for source,(raw,receive_time) in vehicle_mailbox.collect().items():
+        start = perf_counter_ns()
+        payload = decodePayload(raw)
+        broker_metrics.record("decode",start)
+        clock_sync.stamp(payload,receive_time,settings["staleness_clock"])
+        storeDecision(payload)
+    getVerdict()
+
+# Messages that change the client list or client decisions. In queued mode only the fusion worker may apply these
+state_topics = ("new_client","end_client","data_V2B")
+
+def handleMessage(topic,payload):
     # Decide what to do, based on the message's topic
-    if msg.topic == "new_client":
+    if topic == "new_client":
         # Add a new client!
+        wire_formats.accept(payload["source"],payload.get("formats"))
         initializeClient(payload["source"])
-    elif msg.topic == "end_client":
+    elif topic == "end_client":
         # Remove an existing client. Sad!
         removeClient(payload["source"])
-    elif msg.topic == "data_V2B":
+    elif topic == "data_V2B":
         # Interpret the data
-        interpretData(payload)
-    elif msg.topic == "request_config":
+        if ingest_queue == None:
+            interpretData(payload)
+        else:
+            # The fusion worker runs verdicts on its own schedule
+            storeDecision(payload)
+    elif topic == "request_config":
+        # Clients may list the wire formats they can decode, e.g. {"source":"car1","formats":["packed","json"]}
+        wire_formats.accept(payload.get("source"),payload.get("formats"))
+        updateWireFormat()
         issueConfig()
+    elif topic == control_topic:
+        if payload.get("command") == "reload_config":
+            reloadFromControl(payload)
+        elif payload.get("command") in profile_commands and profile_control != None:
+            profile_control.handle(payload)
 
-CLIENT = mqtt.Client()
-CLIENT.on_connect = on_connect
-CLIENT.on_message = on_message
-main_client = CLIENT
-
-# Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
-CLIENT.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
-
-# Create connection, the three parameters are broker address, broker port number, and keep-alive time respectively
-CLIENT.connect(broker_IP, port_Num, keepalive=60)
+def notePong(payload,receive_time):
+    round_trip = clock_sync.onPong(payload,receive_time)
+    if round_trip != None:
+        broker_metrics.recordAge("clock_round_trip",round_trip)
 
-# Set the network loop blocking, it will not actively end the program before calling disconnect() or the program crash
-CLIENT.loop_forever()
\ No newline at end of file
+# The callback function, it will be triggered when receiving messages
+def on_message(CLIENT, userdata, msg):
+    global broker_start_time
+    if broker_start_time == 0:
+        broker_start_time = time.time()
+    broker_metrics.count(msg.topic)
+    if vehicle_mailbox != None and msg.topic == "data_V2B":
+        # Park the raw frame. It only gets decoded if it is still the newest one from this vehicle at fusion time
+        vehicle_mailbox.post(peekSource(msg.payload),msg.payload,time.time())
+        return
+    # Turn from bytes (JSON, MessagePack or packed) to data structure
+    start = perf_counter_ns()
+    payload = decodePayload(msg.payload)
+    broker_metrics.record("decode",start)
+    if msg.topic == pong_topic:
+        # Needs no state, and the receive time is t3 of the round trip
+        notePong(payload,receiveTime(msg,time.time()))
+        return
+    if msg.topic == "data_V2B":
+        # Stamp the arrival time here, so time spent waiting in the ingest queue still counts towards staleness
+        clock_sync.stamp(payload,time.time(),settings["staleness_clock"])
+    if ingest_queue != None and msg.topic in state_topics:
+        # Hand the message to the fusion worker and get back to the network loop as quickly as possible
+        if msg.topic == "data_V2B":
+            ingest_queue.putData(payload.get("source"),msg.topic,payload)
+        else:
+            ingest_queue.putControl(msg.topic,payload)
+        return
+    with state_lock:
+        handleMessage(msg.topic,payload)
+
+def startBroker(client):
+    # Wires the broker up to an MQTT client (a real paho client, or an in-process stand-in for replays) and starts
+    # any background fusion threads. Connecting and running the network loop is up to the caller
+    global CLIENT, main_client, wire_formats, verdict_publisher, dashboard, result_writer, ingest_queue, vehicle_mailbox, verdict_scheduler, scheduler_thread, fusion_worker, config_watcher, metrics_reporter, profile_control
+    CLIENT = client
+    main_client = client
+    wire_formats = FormatNegotiator(settings["wire_format"])
+    verdict_publisher = VerdictPublisher(settings["verdict_publish_mode"],settings["verdict_keyframe_interval"])
+    dashboard = dashboardFromSettings(settings,renderDashboard)
+    result_writer = writerFromSettings(settings,f"outputs/output_{test_id}.jsonl")
+    result_writer.write({"type":"header","test_id":test_id,"config":client_config_data,"start_time":time.time()})
+    config_watcher = watcherFromSettings(settings,lot_config,queueConfig,prRed)
+    broker_metrics.name = "consolidated"
+    metrics_reporter = reporterFromSettings(settings,lambda snapshot: publish(main_client,metrics_topic,snapshot),prRed)
+    clock_sync.start(lambda message: publish(main_client,ping_topic,message),lambda: time.time(),settings["clock_sync_interval"],prRed)
+    profile_control = ProfileControl(f"consolidated_{test_id}",lambda summary: publish(main_client,profile_topic,summary),settings,prCyan)
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    # Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
+    client.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
+
+    # Start the fusion worker, if verdicts should be computed off of the network thread
+    if settings["ingest_mode"] in ("queued","mailbox"):
+        ingest_queue = IngestQueue(settings["ingest_queue_size"],settings["ingest_drop_policy"])
+        verdict_scheduler = schedulerFromSettings(settings,didEveryoneDecide,fallback=True)
+        run_verdict = getVerdict
+        if settings["ingest_mode"] == "mailbox":
+            vehicle_mailbox = VehicleMailbox()
+            run_verdict = fuseMailbox
+        fusion_worker = FusionWorker(ingest_queue,handleMessage,run_verdict,verdict_scheduler,on_exit=client.disconnect)
+        fusion_worker.start()
+    else:
+        # Start the fixed-rate verdict scheduler, if verdicts should not be triggered by incoming messages
+        verdict_scheduler = schedulerFromSettings(settings,didEveryoneDecide)
+        if verdict_scheduler != None:
+            scheduler_thread = schedulerThreadFor(client,verdict_scheduler,getVerdict,state_lock)
+            scheduler_thread.start()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    test_id = args.id
+
+    # broker_core.py runs the MQTT connection, publishing, output flushing and shutdown around this module's fusion
+    runBroker(sys.modules[__name__],PahoTransport(broker_IP,port_Num))
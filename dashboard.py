@@ -0,0 +1,71 @@
+# dashboard.py
+# The brokers' console dashboard, kept off of the fusion path.
+#
+# getVerdict hands over a snapshot (plain copies of the values shown, taken under the broker's state_lock, no formatting)
+# and goes back to fusing. The broker's render function turns a snapshot into the full screen of text, which is written
+# to stdout in one go:
+#   "inline"   - render and write every snapshot right away, on the fusion thread (the original behaviour)
+#   "threaded" - a renderer thread draws the newest snapshot at most `rate` times per second, so a slow terminal
+#                (e.g. over SSH) only slows the renderer down, and intermediate verdicts are never formatted at all
+#   "off"      - no dashboard. The broker keeps `dashboard = None`, so the hot path only pays for a None check
+import sys
+import threading
+
+clear_screen = "\033[H\033[J"
+
+class Dashboard:
+    def __init__(self,render,mode="threaded",rate=4.0):
+        if mode not in ("inline","threaded"):
+            raise ValueError(f"Unknown dashboard mode: {mode}")
+        self.render = render
+        self.mode = mode
+        self.period = 1.0 / rate
+        self.snapshot = None
+        self.updates = 0 # Snapshots handed over
+        self.frames = 0 # Snapshots actually drawn
+        self.stopped = threading.Event()
+        self.thread = None
+        if mode == "threaded":
+            self.thread = threading.Thread(target=self.run,name="dashboard",daemon=True)
+            self.thread.start()
+
+    def update(self,snapshot):
+        self.updates += 1
+        if self.mode == "inline":
+            self.draw(snapshot)
+        else:
+            self.snapshot = snapshot # The renderer picks up whatever is newest when its next frame is due
+
+    def draw(self,snapshot):
+        try:
+            text = self.render(snapshot)
+        except Exception as e:
+            # The fusion state moved on under the renderer. Skip this frame, the next one will be fine
+            text = f"Dashboard render failed: {e}\n"
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        self.frames += 1
+
+    def run(self):
+        drawn = None
+        while not self.stopped.wait(self.period):
+            snapshot = self.snapshot
+            if snapshot is not drawn:
+                self.draw(snapshot)
+                drawn = snapshot
+
+    def stop(self):
+        # Draws the newest snapshot one last time, so the final screen matches the final verdict
+        if self.thread == None or self.stopped.is_set():
+            return
+        self.stopped.set()
+        if self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.snapshot != None:
+            self.draw(self.snapshot)
+
+def dashboardFromSettings(settings,render):
+    # Returns None when the dashboard is off
+    if settings["dashboard_mode"] == "off":
+        return None
+    return Dashboard(render,settings["dashboard_mode"],settings["dashboard_rate"])
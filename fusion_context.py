@@ -0,0 +1,255 @@
+# fusion_context.py
+# Per-lot fusion state and the consolidated fusion math, shared by consolidated_broker.py (one lot per process) and
+# lot_server.py (many lots per process).
+import time
+from collections import defaultdict as dd
+from server_config import config as settings
+from client_registry import ClientRegistry
+from ring_buffer import RingBuffer
+from spot_index import SpotIndex
+from plate_assignment import assignPlates, parseStack
+from metrics import registry as metrics_registry
+from clock_sync import ClockSync
+
+NoneObject = ["None",0.1,0.0]
+warmup_verdicts = 10 # Verdicts before the accuracy histories start to count towards max_decision_history
+
+def isExhausted(verdict_id,history_length):
+    # The stopping rule every broker shares: the warm-up verdicts, then a full history's worth
+    return verdict_id >= history_length + warmup_verdicts
+
+def liveDecisions(clients,now):
+    # The clients' decisions that haven't expired yet
+    cutoff = now - settings["oldest_allowable_data"]
+    decisions = []
+    for client in clients:
+        decision = client.getDecision()
+        if decision != None and decision["timestamp"] >= cutoff:
+            decisions.append(decision)
+    return decisions
+
+class LotGeometry:
+    # A lot's static layout, loaded once from its client config
+    def __init__(self,config):
+        self.empty_locations = config["empty_parking_spot_locations"]
+        self.occupied_locations = config["occupied_parking_spot_locations"]
+        self.truth_values = config["true_parking_occupants"]
+        self.object_locations = config["object_locations"]
+        self.vehicle_locations = config.get("vehicle_locations",{})
+        # Spot coordinates as arrays, for vectorized closest-spot lookups
+        self.empty_spot_index = SpotIndex(self.empty_locations)
+        self.occupied_spot_index = SpotIndex(self.occupied_locations)
+
+def partialTally(decisions):
+    # The additive part of fusion: summed plate positions and summed label scores over some set of decisions.
+    # Tallies from disjoint sets of clients can be merged (mergeTallies) and fused as if they came from one broker.
+    # {"plates":{plate:[sum x, sum y, count]}, "objects":{object_id:{label:summed score}}}
+    plates = {}
+    objects = {}
+    for decision in decisions:
+        # Objects: add up every client's score for every label
+        for object_id,this_dd in decision["object_list"].items():
+            if this_dd == None:
+                continue
+            scores = objects.setdefault(object_id,{})
+            for key in this_dd.keys():
+                scores[key] = scores.get(key,0.0) + this_dd[key]
+        # License plates: tally up the position of each detected plate
+        for qr in decision["parking_list"]:
+            if qr['text'] != "EMPTY":
+                if qr['text'] not in plates:
+                    plates[qr['text']] = [0,0,0]
+                tally = plates[qr['text']]
+                tally[0] += qr['position']['x']
+                tally[1] += qr['position']['y']
+                tally[2] += 1
+    return {"plates":plates,"objects":objects}
+
+def mergeTallies(tallies):
+    merged = {"plates":{},"objects":{}}
+    for tally in tallies:
+        for plate,(x,y,count) in tally["plates"].items():
+            total = merged["plates"].setdefault(plate,[0,0,0])
+            total[0] += x
+            total[1] += y
+            total[2] += count
+        for object_id,scores in tally["objects"].items():
+            total = merged["objects"].setdefault(object_id,{})
+            for key,score in scores.items():
+                total[key] = total.get(key,0.0) + score
+    return merged
+
+def fuseTally(tally,geometry):
+    # Turns a (merged) tally into verdicts. Returns (verdicts, taken_spots)
+    object_identities = {key:dd(float) for key in geometry.object_locations.keys()}
+    for object_id,scores in tally["objects"].items():
+        if object_id not in object_identities:
+            continue # Not in this lot (e.g. a vehicle still on a config from before a reload)
+        for key,score in scores.items():
+            object_identities[object_id][key] += score
+
+    # Record table of average positions for each detected license plate
+    stack = [[plate,x / count,y / count] for plate,(x,y,count) in tally["plates"].items()]
+    taken_spots = [{'position':x,'plate':None} for x in geometry.occupied_locations]
+    # Optimize the license plate positions into unique 2D spots. Updates the value of taken_spots
+    start = time.perf_counter_ns()
+    if settings["plate_assignment"] == "optimal":
+        for spot,plate in zip(taken_spots,assignPlates(stack,geometry.occupied_spot_index.coords,settings["max_plate_distance"])):
+            spot['plate'] = plate
+    else:
+        parseStack(stack,taken_spots)
+    metrics_registry.record("assign",start)
+
+    plate_verdicts = {str(i):(spot['plate'][0] if spot['plate'] != None else "EMPTY") for i,spot in enumerate(taken_spots)}
+    object_verdicts = {key:max(scores,key=scores.get,default=NoneObject) for key,scores in object_identities.items()}
+    return {"plates":plate_verdicts,"objects":object_verdicts},taken_spots
+
+def fuseDecisions(decisions,geometry):
+    # decisions: the unexpired client decisions (consolidated V2B format). Returns (verdicts, taken_spots)
+    return fuseTally(partialTally(decisions),geometry)
+
+def verdictAccuracy(verdicts,geometry):
+    # (plate accuracy, object accuracy) of a verdict against the lot's ground truth
+    plates = len([v for i,v in verdicts["plates"].items() if geometry.truth_values[int(i)]==v]) / len(verdicts["plates"])
+    objects = len([v for i,v in verdicts["objects"].items() if geometry.object_locations[i]==v]) / len(verdicts["objects"])
+    return plates,objects
+
+def scoreDecision(decision,verdicts,geometry):
+    # (plate agreement, object agreement) of one client's decision with the verdict
+    empty_plates = []
+    taken_plates = []
+    for obj in decision["parking_list"]:
+        if obj == None:
+            continue
+        if obj['text'] == "EMPTY":
+            empty_plates.append(obj)
+        else:
+            taken_plates.append(obj)
+    val = 0
+    # Look up the closest spots for all of this client's detections at once
+    for closest_spot in geometry.empty_spot_index.nearestMany([obj['position'] for obj in empty_plates]):
+        if verdicts["plates"][str(closest_spot)] == "EMPTY":
+            val += 1
+    for obj,closest_spot in zip(taken_plates,geometry.occupied_spot_index.nearestMany([obj['position'] for obj in taken_plates])):
+        if verdicts["plates"][str(closest_spot)] == obj['text']:
+            val += 1
+    obj_val = 0
+    for id,obj in decision["object_list"].items():
+        if obj == None or len(obj)==0:
+            continue
+        my_dec = max(obj,key=obj.get)
+        if my_dec != None and my_dec != "None" and verdicts["objects"].get(id) == my_dec:
+            obj_val += 1
+    return val / len(verdicts["plates"]),obj_val / len(verdicts["objects"])
+
+class LotClient:
+    # A vehicle and its accuracy histories. consolidated_broker.Client adds the broker-wide bookkeeping on top
+    def __init__(self,client_name,history_length):
+        self.name = client_name
+        self.decision = None
+        self.plate_history = RingBuffer(history_length)
+        self.object_history = RingBuffer(history_length)
+
+    def getName(self):
+        return self.name
+
+    def getDecision(self):
+        return self.decision
+
+    def setDecision(self,decision):
+        self.decision = decision
+
+    def noteOutcome(self,verdicts,geometry):
+        if self.decision != None:
+            plates,objects = scoreDecision(self.decision,verdicts,geometry)
+            self.plate_history.append(plates)
+            self.object_history.append(objects)
+
+class LotMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.messages = 0
+        self.verdicts = 0
+        self.fusion_seconds = 0.0 # Time spent in getVerdict
+
+    def report(self,clients):
+        elapsed = max(time.time() - self.started,1e-9)
+        return {
+            "clients":clients,
+            "messages":self.messages,
+            "verdicts":self.verdicts,
+            "messages_per_second":self.messages / elapsed,
+            "verdicts_per_second":self.verdicts / elapsed,
+            "mean_fusion_ms":self.fusion_seconds / self.verdicts * 1000 if self.verdicts > 0 else 0.0,
+            "fusion_load":self.fusion_seconds / elapsed, # Fraction of the time this lot kept its worker busy
+        }
+
+class LotContext:
+    # Everything consolidated_broker.py keeps in module globals, for one lot: clients, histories, geometry, verdict_id.
+    # handle() takes one decoded message and returns the messages to publish, as (topic, payload dict) pairs
+    def __init__(self,lot_id,config):
+        self.lot_id = lot_id
+        self.config = config
+        self.geometry = LotGeometry(config)
+        self.history_length = config["max_decision_history"]
+        self.clients = ClientRegistry()
+        self.plate_history = RingBuffer(self.history_length)
+        self.object_history = RingBuffer(self.history_length)
+        self.verdict_id = 0
+        self.last_verdict_time = 0.0
+        self.finished = False
+        self.metrics = LotMetrics()
+        # No clock_ping on the lot topics, so vehicle timestamps are taken as synced (see clock_sync.py)
+        self.clock_sync = ClockSync(assume_synced=True)
+
+    def addClient(self,client_name):
+        if client_name in self.clients:
+            return self.clients.get(client_name)
+        return self.clients.add(LotClient(client_name,self.history_length))
+
+    def handle(self,topic,payload,now):
+        self.metrics.messages += 1
+        if self.finished:
+            return []
+        if topic == "new_client":
+            self.addClient(payload["source"])
+            return [("config",self.config)]
+        elif topic == "end_client":
+            if payload["source"] in self.clients:
+                self.clients.remove(payload["source"])
+        elif topic == "request_config":
+            return [("config",self.config)]
+        elif topic == "data_V2B":
+            # Keeps the capture time next to the arrival time, like the other brokers
+            self.clock_sync.stamp(payload,now,settings["staleness_clock"])
+            self.addClient(payload["source"]).setDecision(payload)
+            if now - self.last_verdict_time > settings["verdict_min_refresh_time"]:
+                return self.getVerdict(now)
+        return []
+
+    def getVerdict(self,now):
+        if isExhausted(self.verdict_id,self.history_length):
+            # Same stopping rule as consolidated_broker.py's quitIfExhausted. The lot stops, the process keeps going
+            self.finished = True
+            return [("finished",{"message":"I'm done!"})]
+        start = time.perf_counter()
+        self.last_verdict_time = now
+        self.verdict_id += 1
+        verdicts,taken_spots = fuseDecisions(liveDecisions(self.clients,now),self.geometry)
+        plates,objects = verdictAccuracy(verdicts,self.geometry)
+        self.plate_history.append(plates)
+        self.object_history.append(objects)
+        for client in self.clients:
+            client.noteOutcome(verdicts,self.geometry)
+        self.metrics.verdicts += 1
+        self.metrics.fusion_seconds += time.perf_counter() - start
+        return [("verdict",{"message":verdicts,"seq":self.verdict_id})]
+
+    def getReport(self):
+        # The lot's results, in consolidated_broker.py's output file layout
+        return {
+            "plate_history":self.plate_history.tolist(),
+            "object_history":self.object_history.tolist(),
+            "config":self.config,
+            "client_reports":{client.getName():{"plates":client.plate_history.tolist(),"objects":client.object_history.tolist()} for client in self.clients},
+        }
@@ -0,0 +1,58 @@
+# hash_ring.py
+# Consistent hashing, for splitting vehicles (or lots) between broker replicas.
+# Every replica is placed on the ring at `virtual_nodes` pseudo-random points, and a key belongs to the first point
+# at or after its own hash. Adding or removing a replica only moves the keys next to that replica's points (about
+# 1/N of them), everything else stays where it was. Hashes come from md5 rather than hash(), so every process agrees.
+import bisect
+import hashlib
+
+def hashKey(key):
+    return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8],"big")
+
+class HashRing:
+    def __init__(self,nodes=(),virtual_nodes=64):
+        self.virtual_nodes = virtual_nodes
+        self.nodes = set()
+        self.points = [] # Sorted hashes of every virtual node
+        self.owners = [] # owners[i] is the node at points[i]
+        for node in nodes:
+            self.add(node)
+
+    def rebuild(self):
+        ring = sorted((hashKey(f"{node}#{i}"),node) for node in self.nodes for i in range(self.virtual_nodes))
+        self.points = [point for point,_ in ring]
+        self.owners = [node for _,node in ring]
+
+    def add(self,node):
+        # Returns False if the node was already on the ring
+        if node in self.nodes:
+            return False
+        self.nodes.add(node)
+        self.rebuild()
+        return True
+
+    def remove(self,node):
+        if node not in self.nodes:
+            return False
+        self.nodes.discard(node)
+        self.rebuild()
+        return True
+
+    def owner(self,key):
+        # The node responsible for key, or None if the ring is empty
+        if len(self.points) == 0:
+            return None
+        return self.owners[bisect.bisect_left(self.points,hashKey(key)) % len(self.points)]
+
+    def copy(self):
+        ring = HashRing(virtual_nodes=self.virtual_nodes)
+        ring.nodes = set(self.nodes)
+        ring.points = list(self.points)
+        ring.owners = list(self.owners)
+        return ring
+
+    def __contains__(self,node):
+        return node in self.nodes
+
+    def __len__(self):
+        return len(self.nodes)
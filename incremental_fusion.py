@@ -0,0 +1,176 @@
+# incremental_fusion.py
+# Running fusion tallies, so a verdict doesn't have to walk every client's decision again.
+# When a client's decision is replaced, its old contribution is subtracted and the new one added, so the cost of a
+# message is O(detections in it) instead of O(fleet). Decisions older than oldest_allowable_data are subtracted as
+# they expire, in time order, off a heap. tally() has the same layout as fusion_context.partialTally, so the
+# verdict itself is still fusion_context.fuseTally.
+#
+#   python incremental_fusion.py [steps]   (differential check against the batch path on a random workload)
+import heapq
+import sys
+from server_config import config as settings
+
+class IncrementalTally:
+    def __init__(self,rebuild_interval=100000):
+        self.plates = {} # plate -> [sum x, sum y, count]
+        self.objects = {} # object_id -> {label: [summed score, count]}
+        self.decisions = {} # client name -> (decision, seq) currently counted in the tally
+        self.expiry = [] # Heap of (timestamp, seq, client name). Entries for replaced decisions are skipped when popped
+        self.seq = 0
+        # Subtraction leaves float residue behind. Every rebuild_interval updates the sums are recomputed from scratch
+        self.rebuild_interval = rebuild_interval
+        self.updates = 0
+
+    def add(self,decision,sign):
+        for object_id,scores in decision["object_list"].items():
+            if scores == None:
+                continue
+            labels = self.objects.setdefault(object_id,{})
+            for label,score in scores.items():
+                total = labels.setdefault(label,[0.0,0])
+                total[0] += sign * score
+                total[1] += sign
+                if total[1] == 0:
+                    del labels[label]
+            if len(labels) == 0:
+                del self.objects[object_id]
+        for qr in decision["parking_list"]:
+            if qr['text'] == "EMPTY":
+                continue
+            total = self.plates.setdefault(qr['text'],[0,0,0])
+            total[0] += sign * qr['position']['x']
+            total[1] += sign * qr['position']['y']
+            total[2] += sign
+            if total[2] == 0:
+                del self.plates[qr['text']]
+
+    def setDecision(self,client_name,decision):
+        self.remove(client_name)
+        self.seq += 1
+        self.decisions[client_name] = (decision,self.seq)
+        self.add(decision,1)
+        heapq.heappush(self.expiry,(decision["timestamp"],self.seq,client_name))
+        self.updates += 1
+        if self.updates >= self.rebuild_interval:
+            self.rebuild()
+
+    def remove(self,client_name):
+        if client_name in self.decisions:
+            decision,_ = self.decisions.pop(client_name)
+            self.add(decision,-1)
+            self.updates += 1
+
+    def expire(self,now):
+        # Drop every decision older than oldest_allowable_data, like getVerdict's batch filter
+        oldest = now - settings["oldest_allowable_data"]
+        while len(self.expiry) > 0 and self.expiry[0][0] < oldest:
+            _,seq,client_name = heapq.heappop(self.expiry)
+            if client_name in self.decisions and self.decisions[client_name][1] == seq:
+                self.remove(client_name)
+        if len(self.expiry) > 2 * len(self.decisions) + 64:
+            # Mostly replaced decisions, compact it
+            self.expiry = [(decision["timestamp"],seq,client_name) for client_name,(decision,seq) in self.decisions.items()]
+            heapq.heapify(self.expiry)
+
+    def rebuild(self):
+        self.plates = {}
+        self.objects = {}
+        for decision,_ in self.decisions.values():
+            self.add(decision,1)
+        self.updates = 0
+
+    def tally(self):
+        # The current tally, in fusion_context.partialTally's layout
+        return {
+            "plates":self.plates,
+            "objects":{object_id:{label:total[0] for label,total in labels.items()} for object_id,labels in self.objects.items()},
+        }
+
+def compareTallies(batch,incremental,tolerance=1e-9):
+    # Returns a list of differences, empty when the tallies agree
+    differences = []
+    if set(batch["plates"].keys()) != set(incremental["plates"].keys()):
+        differences.append(f"plates {sorted(batch['plates'].keys())} != {sorted(incremental['plates'].keys())}")
+    for plate,(x,y,count) in batch["plates"].items():
+        other = incremental["plates"].get(plate)
+        if other != None and (other[2] != count or abs(other[0] - x) > tolerance * max(1.0,abs(x)) or abs(other[1] - y) > tolerance * max(1.0,abs(y))):
+            differences.append(f"plate {plate}: {[x,y,count]} != {other}")
+    for object_id,scores in batch["objects"].items():
+        other = incremental["objects"].get(object_id,{})
+        if set(scores.keys()) != set(other.keys()):
+            differences.append(f"object {object_id}: labels {sorted(scores.keys())} != {sorted(other.keys())}")
+            continue
+        for label,score in scores.items():
+            if abs(other[label] - score) > tolerance * max(1.0,abs(score)):
+                differences.append(f"object {object_id} {label}: {score} != {other[label]}")
+    if set(incremental["objects"].keys()) - set(batch["objects"].keys()):
+        differences.append(f"extra objects {sorted(set(incremental['objects'].keys()) - set(batch['objects'].keys()))}")
+    return differences
+
+def differentialCheck(steps=20000,fleet=60,seed=0):
+    # Random joins, frames, leaves and clock jumps. After every step the incremental tally must match partialTally over
+    # the unexpired decisions, and both must fuse to the same verdict. Returns the number of mismatches
+    import json
+    import numpy as np
+    from fusion_context import LotGeometry, partialTally, fuseTally
+    with open("consolidated_config.json","r") as config_file:
+        config = json.load(config_file)
+    geometry = LotGeometry(config)
+    rng = np.random.default_rng(seed)
+    labels = ["person","car","cup","mouse","vase","ball"]
+    truth = config["true_parking_occupants"]
+    def makeDecision(name,now):
+        parking_list = []
+        for i,plate in enumerate(truth):
+            if rng.random() < 0.2:
+                continue
+            if plate != "EMPTY" and rng.random() < 0.05:
+                plate = f"MISREAD{rng.integers(3)}"
+            spot = geometry.empty_locations[i] if plate == "EMPTY" else geometry.occupied_locations[i]
+            parking_list.append({"text":plate,"position":{"x":spot["x"] + rng.normal(0,0.5),"y":spot["y"] + rng.normal(0,0.5)},"distance":5.0})
+        object_list = {}
+        for object_id in geometry.object_locations.keys():
+            if rng.random() < 0.1:
+                object_list[object_id] = None
+            else:
+                object_list[object_id] = {str(label):float(rng.uniform(0.3,0.95)) for label in rng.choice(labels,rng.integers(1,3),replace=False)}
+        return {"source":name,"parking_list":parking_list,"object_list":object_list,"timestamp":now}
+
+    incremental = IncrementalTally(rebuild_interval=5000)
+    decisions = {}
+    now = 1000.0
+    mismatches = 0
+    for step in range(steps):
+        name = f"car{rng.integers(fleet)}"
+        action = rng.random()
+        if action < 0.85:
+            decisions[name] = makeDecision(name,now)
+            incremental.setDecision(name,decisions[name])
+        elif action < 0.95:
+            decisions.pop(name,None)
+            incremental.remove(name)
+        else:
+            now += float(rng.exponential(settings["oldest_allowable_data"] / 4)) # Let some decisions go stale
+        now += 0.01
+        incremental.expire(now)
+        live = [decision for decision in decisions.values() if decision["timestamp"] >= now - settings["oldest_allowable_data"]]
+        batch = partialTally(live)
+        differences = compareTallies(batch,incremental.tally())
+        batch_verdicts,_ = fuseTally(batch,geometry)
+        incremental_verdicts,_ = fuseTally(incremental.tally(),geometry)
+        if batch_verdicts != incremental_verdicts:
+            differences.append(f"verdicts {batch_verdicts} != {incremental_verdicts}")
+        if len(differences) > 0:
+            mismatches += 1
+            if mismatches <= 5:
+                print(f"Step {step}: " + "; ".join(differences))
+    return mismatches
+
+if __name__ == "__main__":
+    steps = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    for mode in ["optimal","greedy"]:
+        settings["plate_assignment"] = mode
+        mismatches = differentialCheck(steps)
+        print(f"{mode}: {steps} steps, {mismatches} mismatches")
+        if mismatches > 0:
+            sys.exit(1)
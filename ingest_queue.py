@@ -0,0 +1,162 @@
+# ingest_queue.py
+import threading
+import time
+from collections import deque
+
+# What to do with a new data frame when the queue is already full
+DROP_OLDEST = "drop_oldest" # Throw away the oldest waiting frame to make room
+DROP_NEWEST = "drop_newest" # Throw away the frame that just arrived
+COALESCE = "coalesce" # Replace the waiting frame from the same source, otherwise behave like DROP_OLDEST
+drop_policies = (DROP_OLDEST,DROP_NEWEST,COALESCE)
+
+class IngestQueue:
+    # Bounded hand-off between the MQTT network thread (producer) and the fusion worker (consumer).
+    # Everything is delivered in arrival order, so a vehicle's frames and its new_client/end_client stay in sequence.
+    # Only data frames count towards max_size and are subject to the drop policy. Control messages (new_client,
+    # end_client, ...) are rare and must never be lost.
+    def __init__(self,max_size=256,policy=COALESCE):
+        if policy not in drop_policies:
+            raise ValueError(f"Unknown drop policy '{policy}', expected one of {drop_policies}")
+        if max_size < 1:
+            raise ValueError("Ingest queue size must be at least 1")
+        self.max_size = max_size
+        self.policy = policy
+        self.entries = deque() # [key, topic, payload, enqueue time, live], in arrival order
+        self.data = deque() # The live data entries, oldest first (for DROP_OLDEST)
+        self.controls = 0 # Control entries waiting
+        self.dead = 0 # Dropped entries still in self.entries
+        self.pending = {} # source -> waiting entry, used for coalescing
+        self.cond = threading.Condition()
+        # Metrics
+        self.enqueued = 0
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.total_lag = 0.0
+
+    def putControl(self,topic,payload):
+        with self.cond:
+            self.entries.append([None,topic,payload,time.monotonic(),True])
+            self.controls += 1
+            self.enqueued += 1
+            # A later frame from this source must not be coalesced into one from before the control message
+            source = payload.get("source") if isinstance(payload,dict) else None
+            self.pending.pop(source,None)
+            self.cond.notify()
+
+    def putData(self,key,topic,payload):
+        # Returns False if the frame was dropped on arrival
+        with self.cond:
+            NOW = time.monotonic()
+            self.enqueued += 1
+            if self.policy == COALESCE and key in self.pending:
+                # Overwrite the stale frame in place. It keeps its spot in line, but the lag clock restarts
+                entry = self.pending[key]
+                entry[2] = payload
+                entry[3] = NOW
+                self.coalesced += 1
+                return True
+            if len(self.data) >= self.max_size:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                oldest = self.data.popleft()
+                oldest[2] = None # Let the payload go now, not when the worker gets to it
+                oldest[4] = False # Left in self.entries, skipped by drain
+                if self.pending.get(oldest[0]) is oldest:
+                    del self.pending[oldest[0]]
+                self.dropped += 1
+                self.dead += 1
+                if self.dead > self.max_size:
+                    # The worker is far behind. Don't let the dropped entries pile up in line either
+                    self.entries = deque(entry for entry in self.entries if entry[4])
+                    self.dead = 0
+            entry = [key,topic,payload,NOW,True]
+            self.entries.append(entry)
+            self.data.append(entry)
+            if key != None:
+                self.pending[key] = entry
+            self.max_depth = max(self.max_depth,len(self.data))
+            self.cond.notify()
+            return True
+
+    def drain(self,timeout=None):
+        # Wait (up to timeout seconds) for something to arrive, then take everything that is waiting.
+        # Returns a list of (topic,payload) in arrival order
+        with self.cond:
+            if self.depth() == 0:
+                self.cond.wait(timeout)
+            NOW = time.monotonic()
+            entries = [entry for entry in self.entries if entry[4]]
+            self.entries.clear()
+            self.data.clear()
+            self.controls = 0
+            self.dead = 0
+            self.pending.clear()
+            for entry in entries:
+                lag = NOW - entry[3]
+                self.total_lag += lag
+                self.max_lag = max(self.max_lag,lag)
+                self.last_lag = lag
+            self.delivered += len(entries)
+            return [(entry[1],entry[2]) for entry in entries]
+
+    def wake(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def depth(self):
+        return self.controls + len(self.data)
+
+    def getStats(self):
+        with self.cond:
+            return {
+                "depth":self.depth(),
+                "max_depth":self.max_depth,
+                "enqueued":self.enqueued,
+                "delivered":self.delivered,
+                "dropped":self.dropped,
+                "coalesced":self.coalesced,
+                "last_lag":self.last_lag,
+                "max_lag":self.max_lag,
+                "mean_lag":(self.total_lag / self.delivered) if self.delivered > 0 else 0.0,
+            }
+
+    def getReport(self):
+        stats = self.getStats()
+        return (f"Ingest queue: depth {stats['depth']} (max {stats['max_depth']}/{self.max_size}), "
+                f"dropped {stats['dropped']}, coalesced {stats['coalesced']}, "
+                f"lag {stats['mean_lag']*1000:.1f}ms avg / {stats['max_lag']*1000:.1f}ms max")
+
+class FusionWorker(threading.Thread):
+    # Owns the broker state while running: applies queued messages, and runs a verdict whenever the scheduler says so
+    def __init__(self,queue,handle_message,run_verdict,scheduler,on_exit=None):
+        super().__init__(name="fusion-worker",daemon=True)
+        self.queue = queue
+        self.handle_message = handle_message
+        self.run_verdict = run_verdict
+        self.scheduler = scheduler
+        self.on_exit = on_exit
+        self.stopping = threading.Event()
+
+    def stop(self):
+        self.stopping.set()
+        self.queue.wake()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                for topic,payload in self.queue.drain(self.scheduler.timeUntilNext()):
+                    self.handle_message(topic,payload)
+                if self.scheduler.isDue():
+                    self.scheduler.runSlot(self.run_verdict)
+        except SystemExit:
+            # The broker finished its experiment (quitIfExhausted)
+            pass
+        finally:
+            self.stopping.set()
+            if self.on_exit != None:
+                self.on_exit()
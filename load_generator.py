@@ -0,0 +1,301 @@
+# load_generator.py
+# Synthetic fleet load generator: simulates many vehicles reporting on the lot described in a broker config,
+# and measures how the broker copes (verdict latency percentiles, frames that never made it into a verdict).
+#
+#   python load_generator.py --fleet 100 1000 5000 --duration 20                (in-process, no MQTT broker needed)
+#   python load_generator.py --fleet 200 --transport mqtt                       (against a broker script already running)
+#   python load_generator.py --fleet 50 --duration 60 --transport trace -o synthetic.jsonl   (write a replay trace)
+import argparse
+import bisect
+import contextlib
+import heapq
+import json
+import multiprocessing
+import os
+import queue
+import time
+import numpy as np
+from colors import *
+from server_config import config as settings
+import replay
+
+broker_configs = {
+    "consolidated":"consolidated_config.json",
+    "parking":"parking_config.json",
+    "objects":"object_config.json",
+}
+
+# Labels a vehicle may confuse an object with
+distractor_labels = ["person","cup","bowl","chair","laptop","keyboard","mouse","vase","sports ball","bottle"]
+
+class SimulatedVehicle:
+    def __init__(self,name,x,y,rate,rng):
+        self.name = name
+        self.x = x
+        self.y = y
+        self.period = 1.0 / rate
+        self.frames = [] # Pre-encoded payload variants, cycled through so generating load stays cheap
+        self.next_frame = 0
+        self.next_send = rng.random() * self.period # Random phase, so the fleet doesn't report in lockstep
+
+    def nextPayload(self):
+        payload = self.frames[self.next_frame]
+        self.next_frame = (self.next_frame + 1) % len(self.frames)
+        return payload
+
+class FleetModel:
+    # Ground truth and noise model for one lot, built from a broker config file
+    def __init__(self,config,payload_format,noise=0.5,dropout=0.1,mislabel=0.05):
+        self.config = config
+        self.payload_format = payload_format
+        self.noise = noise
+        self.dropout = dropout
+        self.mislabel = mislabel
+        self.empty_spots = config.get("empty_parking_spot_locations",[])
+        self.occupied_spots = config.get("occupied_parking_spot_locations",[])
+        self.truth = config.get("true_parking_occupants",[])
+        self.objects = config.get("object_locations",{})
+
+    def makeVehicles(self,count,rate,rng):
+        # Real vehicles from the config first, then copies of them scattered around the lot
+        templates = list(self.config["vehicle_locations"].values())
+        vehicles = []
+        for i in range(count):
+            template = templates[i % len(templates)]
+            name = template["name"] if i < len(templates) else f"{template['name']}_{i}"
+            vehicles.append(SimulatedVehicle(name,template["x"] + rng.normal(0,2),template["y"] + rng.normal(0,2),rate,rng))
+        return vehicles
+
+    def plateDetections(self,vehicle,rng):
+        detections = []
+        for i,true_plate in enumerate(self.truth):
+            if rng.random() < self.dropout:
+                continue
+            spot = self.empty_spots[i] if true_plate == "EMPTY" else self.occupied_spots[i]
+            x = spot["x"] + rng.normal(0,self.noise)
+            y = spot["y"] + rng.normal(0,self.noise)
+            detections.append({"text":true_plate,"position":{"x":x,"y":y},"distance":float(np.hypot(x - vehicle.x,y - vehicle.y))})
+        return detections
+
+    def objectDetections(self,rng):
+        detections = {}
+        for object_id,obj in self.objects.items():
+            if rng.random() < self.dropout:
+                detections[object_id] = None
+                continue
+            identities = obj.get("identities",[obj.get("name",object_id)])
+            label = identities[0]
+            if rng.random() < self.mislabel:
+                label = distractor_labels[rng.integers(len(distractor_labels))]
+            detections[object_id] = {label:float(rng.uniform(0.45,0.95))}
+        return detections
+
+    def makePayload(self,vehicle,rng):
+        if self.payload_format == "parking":
+            # parking_broker.py reads plate detections from "object_list"
+            payload = {"object_list":self.plateDetections(vehicle,rng)}
+        elif self.payload_format == "objects":
+            payload = {"object_list":self.objectDetections(rng)}
+        else:
+            payload = {"parking_list":self.plateDetections(vehicle,rng),"object_list":self.objectDetections(rng)}
+        payload["source"] = vehicle.name
+        return json.dumps(payload)
+
+    def prepare(self,vehicles,variants,rng):
+        for vehicle in vehicles:
+            vehicle.frames = [self.makePayload(vehicle,rng) for _ in range(variants)]
+
+def summarize(fleet_size,send_log,verdict_times,elapsed,extra=None):
+    # A frame counts as fused if it was still its vehicle's newest frame when the next verdict went out.
+    # Its latency is the time until that verdict. Frames overtaken by a newer frame first were never fused
+    verdict_times = sorted(verdict_times)
+    latencies = []
+    superseded = 0
+    unfused_at_end = 0
+    sent = 0
+    for times in send_log.values():
+        sent += len(times)
+        for i,sent_at in enumerate(times):
+            v = bisect.bisect_left(verdict_times,sent_at)
+            if v == len(verdict_times):
+                unfused_at_end += 1
+            elif i+1 < len(times) and times[i+1] <= verdict_times[v]:
+                superseded += 1
+            else:
+                latencies.append(verdict_times[v] - sent_at)
+    latencies = np.array(latencies) if len(latencies) > 0 else np.array([np.nan])
+    result = {
+        "fleet_size":fleet_size,
+        "frames_sent":sent,
+        "send_rate":sent / elapsed if elapsed > 0 else 0.0,
+        "verdicts":len(verdict_times),
+        "verdict_rate":len(verdict_times) / elapsed if elapsed > 0 else 0.0,
+        "latency_p50":float(np.percentile(latencies,50)),
+        "latency_p90":float(np.percentile(latencies,90)),
+        "latency_p99":float(np.percentile(latencies,99)),
+        "latency_max":float(np.max(latencies)),
+        "superseded_frames":superseded,
+        "unfused_at_end":unfused_at_end,
+    }
+    result.update(extra or {})
+    return result
+
+def runSchedule(vehicles,duration,send):
+    # Sends every vehicle's frames on its own schedule (wall clock). Returns {vehicle name: [send times]} and elapsed time
+    send_log = {vehicle.name:[] for vehicle in vehicles}
+    queue = [(vehicle.next_send,i) for i,vehicle in enumerate(vehicles)]
+    heapq.heapify(queue)
+    start = time.perf_counter()
+    while len(queue) > 0:
+        due,i = heapq.heappop(queue)
+        if due > duration:
+            break
+        delay = due - (time.perf_counter() - start)
+        if delay > 0:
+            time.sleep(delay)
+        vehicle = vehicles[i]
+        sent_at = time.perf_counter()
+        send(vehicle.nextPayload())
+        send_log[vehicle.name].append(sent_at)
+        heapq.heappush(queue,(due + vehicle.period,i))
+    return send_log,time.perf_counter() - start
+
+def runInProcess(args,fleet_size,results):
+    # Runs in its own process, so every fleet size starts with a fresh broker
+    rng = np.random.default_rng(args.seed)
+    with open(broker_configs[args.broker],"r") as config_file:
+        model = FleetModel(json.load(config_file),args.broker,args.noise,args.dropout,args.mislabel)
+    vehicles = model.makeVehicles(fleet_size,args.rate,rng)
+    model.prepare(vehicles,args.variants,rng)
+
+    module = replay.loadBroker(args.broker,"loadtest",replay.parseOverrides(args.set))
+    module.quitIfExhausted = lambda: False # Load tests run until the duration is up, not until max_decision_history
+    verdict_times = []
+    client = replay.InProcessClient(lambda topic,payload: verdict_times.append(time.perf_counter()) if topic == "verdict" else None)
+    with open(os.devnull,"w") as sink, contextlib.redirect_stdout(sink):
+        module.startBroker(client)
+        send_log,elapsed = runSchedule(vehicles,args.duration,lambda payload: client.deliver("data_V2B",payload))
+        time.sleep(args.linger)
+    extra = {}
+    if getattr(module,"ingest_queue",None) != None:
+        stats = module.ingest_queue.getStats()
+        extra = {"queue_dropped":stats["dropped"],"queue_coalesced":stats["coalesced"],"queue_max_depth":stats["max_depth"]}
+    results.put(summarize(fleet_size,send_log,verdict_times,elapsed,extra))
+
+def runMqtt(args,fleet_size):
+    import paho.mqtt.client as mqtt
+    rng = np.random.default_rng(args.seed)
+    with open(broker_configs[args.broker],"r") as config_file:
+        model = FleetModel(json.load(config_file),args.broker,args.noise,args.dropout,args.mislabel)
+    vehicles = model.makeVehicles(fleet_size,args.rate,rng)
+    model.prepare(vehicles,args.variants,rng)
+
+    verdict_times = []
+    client = mqtt.Client()
+    client.on_connect = lambda client,userdata,flags,rc: client.subscribe("verdict")
+    client.on_message = lambda client,userdata,msg: verdict_times.append(time.perf_counter())
+    client.connect(settings["broker_IP"],settings["port_Num"],keepalive=60)
+    client.loop_start()
+    failed = [0]
+    def send(payload):
+        if client.publish("data_V2B",payload=payload,qos=0).rc != mqtt.MQTT_ERR_SUCCESS:
+            failed[0] += 1
+    send_log,elapsed = runSchedule(vehicles,args.duration,send)
+    time.sleep(args.linger)
+    client.loop_stop()
+    client.disconnect()
+    return summarize(fleet_size,send_log,verdict_times,elapsed,{"publish_failures":failed[0]})
+
+def writeTrace(args,fleet_size):
+    # Generate a trace for replay.py instead of driving a broker. Uses the schedule's ideal times, no sleeping
+    rng = np.random.default_rng(args.seed)
+    with open(broker_configs[args.broker],"r") as config_file:
+        model = FleetModel(json.load(config_file),args.broker,args.noise,args.dropout,args.mislabel)
+    vehicles = model.makeVehicles(fleet_size,args.rate,rng)
+    with open(args.output,"w") as trace_file:
+        trace_file.write(json.dumps({"trace_version":replay.trace_version,"start_time":time.time(),"topics":["data_V2B"],"fleet_size":fleet_size}) + "\n")
+        queue = [(vehicle.next_send,i) for i,vehicle in enumerate(vehicles)]
+        heapq.heapify(queue)
+        count = 0
+        while len(queue) > 0:
+            due,i = heapq.heappop(queue)
+            if due > args.duration:
+                break
+            # Traces get a fresh frame every time, not cycled variants
+            trace_file.write(json.dumps({"t":due,"topic":"data_V2B","payload":model.makePayload(vehicles[i],rng)}) + "\n")
+            count += 1
+            heapq.heappush(queue,(due + vehicles[i].period,i))
+    prGreen(f"Wrote {count} frames from {fleet_size} vehicles ({args.duration}s) to {args.output}")
+
+def printResults(results):
+    print(f"{'vehicles':>9} {'sent/s':>9} {'verdicts/s':>11} {'p50 (ms)':>9} {'p90 (ms)':>9} {'p99 (ms)':>9} {'superseded':>11} {'other':>s}")
+    for r in results:
+        other = ", ".join(f"{key}={r[key]}" for key in ("queue_dropped","queue_coalesced","queue_max_depth","publish_failures") if key in r)
+        print(f"{r['fleet_size']:>9} {r['send_rate']:>9.1f} {r['verdict_rate']:>11.2f} {r['latency_p50']*1000:>9.1f} {r['latency_p90']*1000:>9.1f} "
+              f"{r['latency_p99']*1000:>9.1f} {r['superseded_frames']:>11} {other}")
+
+def waitForResult(worker,result_queue,timeout):
+    # The run's result, or None if the worker died (e.g. the broker raised) or didn't finish within `timeout` seconds
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            return result_queue.get(timeout=1)
+        except queue.Empty:
+            if worker.exitcode != None:
+                try:
+                    return result_queue.get(timeout=1) # It may have put its result just before exiting
+                except queue.Empty:
+                    return None
+    return None
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic fleet load generator")
+    parser.add_argument("--fleet",type=int,nargs="+",default=[100,1000,5000],help="Fleet sizes to test")
+    parser.add_argument("-b","--broker",choices=list(broker_configs.keys()),default="consolidated")
+    parser.add_argument("--transport",choices=["inprocess","mqtt","trace"],default="inprocess")
+    parser.add_argument("--duration",type=float,default=20.0,help="Seconds of load per fleet size")
+    parser.add_argument("--rate",type=float,default=2.0,help="Frames per second per vehicle")
+    parser.add_argument("--noise",type=float,default=0.5,help="Std. dev. of detected positions")
+    parser.add_argument("--dropout",type=float,default=0.1,help="Chance that any single detection is missing")
+    parser.add_argument("--mislabel",type=float,default=0.05,help="Chance that an object gets the wrong label")
+    parser.add_argument("--variants",type=int,default=8,help="Pre-generated frames per vehicle (cycled)")
+    parser.add_argument("--linger",type=float,default=1.0,help="Seconds to wait for late verdicts after the load stops")
+    parser.add_argument("--seed",type=int,default=0)
+    parser.add_argument("--set",nargs="*",default=[],metavar="KEY=VALUE",help="Override server_config settings (in-process only)")
+    parser.add_argument("-o","--output",default=None,help="Trace file to write (trace transport), or JSON results file")
+    args = parser.parse_args()
+
+    if args.transport == "trace":
+        if args.output == None:
+            parser.error("--transport trace needs -o/--output")
+        writeTrace(args,args.fleet[0])
+        return
+
+    results = []
+    for fleet_size in args.fleet:
+        prCyan(f"Running {fleet_size} vehicles at {args.rate} Hz for {args.duration}s ({args.transport})...")
+        if args.transport == "mqtt":
+            results.append(runMqtt(args,fleet_size))
+        else:
+            result_queue = multiprocessing.Queue()
+            worker = multiprocessing.Process(target=runInProcess,args=(args,fleet_size,result_queue))
+            worker.start()
+            # Generous room for generating the fleet and loading the broker on top of the run itself
+            result = waitForResult(worker,result_queue,args.duration + args.linger + 120)
+            if result == None:
+                if worker.exitcode == None:
+                    worker.terminate()
+                    prRed(f"The {fleet_size} vehicle run did not finish, skipping it")
+                else:
+                    prRed(f"The {fleet_size} vehicle run exited with code {worker.exitcode} without a result, skipping it")
+            else:
+                results.append(result)
+            worker.join()
+    print()
+    printResults(results)
+    if args.output != None:
+        with open(args.output,"w") as output_file:
+            json.dump(results,output_file,indent=4)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+# lot_server.py
+# One process serving many parking lots. Vehicles use the usual topics under a per-lot prefix:
+#   lot/<lot id>/new_client, lot/<lot id>/data_V2B, ...   (in)
+#   lot/<lot id>/config, lot/<lot id>/verdict, lot/<lot id>/finished, lot/<lot id>/metrics   (out)
+# Each lot's state lives in a LotContext (fusion_context.py). Lots are spread over a pool of worker processes, and a
+# lot always goes to the same worker (so its context never moves), which lets different lots fuse in parallel.
+# The network thread only parses the topic and forwards the raw payload; decoding, fusion and encoding happen in
+# the workers.
+#
+#   python lot_server.py --lot A=consolidated_config.json --lot B=lot_b_config.json --workers 2
+import argparse
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from colors import *
+from server_config import config as settings
+from codec import encode, encodeJson, decode
+from fusion_context import LotContext
+
+lot_topics = ["new_client","end_client","data_V2B","request_config"]
+worker_batch_size = 64 # Messages a worker takes off its inbox at a time
+
+def parseLotTopic(topic):
+    # "lot/A/data_V2B" -> ("A", "data_V2B"), anything else -> None
+    parts = topic.split("/")
+    if len(parts) != 3 or parts[0] != "lot":
+        return None
+    return parts[1],parts[2]
+
+def encodeLotMessage(topic,message):
+    if topic == "config":
+        return encodeJson(message) # The config goes out as-is, like the other brokers' issueConfig
+    return encode(dict(message,source="main_broker"))
+
+def writeLotReport(lot,test_id):
+    os.makedirs("outputs/lots",exist_ok=True)
+    with open(f"outputs/lots/output_{lot.lot_id}_{test_id}.json","w") as output_file:
+        output_file.write(json.dumps(lot.getReport()))
+
+def workerMain(lot_configs,inbox,outbox,test_id,metrics_interval):
+    # Runs in a worker process. Owns the LotContexts of the lots routed to it
+    lots = {}
+    next_metrics = time.time() + metrics_interval
+    while True:
+        batch = []
+        try:
+            batch.append(inbox.get(timeout=metrics_interval))
+            while len(batch) < worker_batch_size:
+                batch.append(inbox.get_nowait())
+        except queue.Empty:
+            pass
+        for item in batch:
+            if item == None:
+                outbox.put((None,"metrics",{lot_id:lot.metrics.report(len(lot.clients)) for lot_id,lot in lots.items()}))
+                return
+            lot_id,topic,raw,receive_time = item
+            if lot_id not in lots:
+                lots[lot_id] = LotContext(lot_id,lot_configs[lot_id])
+            lot = lots[lot_id]
+            try:
+                payload = decode(raw)
+            except ValueError as e:
+                print(f"Lot {lot_id}: could not decode a {topic} message ({e})")
+                continue
+            was_finished = lot.finished
+            try:
+                for out_topic,message in lot.handle(topic,payload,receive_time):
+                    outbox.put((lot_id,out_topic,encodeLotMessage(out_topic,message)))
+                if lot.finished and not was_finished:
+                    writeLotReport(lot,test_id)
+            except Exception as e:
+                # A bad message must not take the worker down, and every other lot on it with it
+                print(f"Lot {lot_id}: error handling a {topic} message ({e!r})")
+        if time.time() >= next_metrics:
+            next_metrics = time.time() + metrics_interval
+            outbox.put((None,"metrics",{lot_id:lot.metrics.report(len(lot.clients)) for lot_id,lot in lots.items()}))
+
+class LotServer:
+    def __init__(self,lot_configs,workers=None,test_id=0,metrics_interval=1.0):
+        self.lot_configs = lot_configs # lot id -> client config dict
+        self.worker_count = max(1,min(workers or os.cpu_count() or 1,len(lot_configs)))
+        self.test_id = test_id
+        self.metrics_interval = metrics_interval
+        self.assignment = {} # lot id -> worker index. Sticky: a lot never changes workers
+        self.lots_per_worker = [0] * self.worker_count
+        self.metrics = {} # lot id -> the newest metrics its worker reported
+        self.unknown_lots = set()
+        self.client = None
+        self.inboxes = []
+        self.processes = []
+        self.outbox = None
+        self.publisher = None
+        self.running = False
+
+    def workerFor(self,lot_id):
+        if lot_id not in self.assignment:
+            worker = self.lots_per_worker.index(min(self.lots_per_worker)) # Least loaded worker
+            self.assignment[lot_id] = worker
+            self.lots_per_worker[worker] += 1
+        return self.assignment[lot_id]
+
+    def start(self,client):
+        # Wires the server up to an MQTT client (or replay.py's in-process stand-in) and starts the workers
+        self.client = client
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        self.outbox = multiprocessing.Queue()
+        for _ in range(self.worker_count):
+            inbox = multiprocessing.Queue()
+            process = multiprocessing.Process(target=workerMain,args=(self.lot_configs,inbox,self.outbox,self.test_id,self.metrics_interval),daemon=True)
+            process.start()
+            self.inboxes.append(inbox)
+            self.processes.append(process)
+        for lot_id in sorted(self.lot_configs.keys()):
+            self.workerFor(lot_id)
+        self.running = True
+        self.publisher = threading.Thread(target=self.publishLoop,name="lot_publisher",daemon=True)
+        self.publisher.start()
+
+    def on_connect(self,client,userdata,flags,rc):
+        prCyan(f"Connected with result code {rc}. Serving lots {sorted(self.lot_configs.keys())} on {self.worker_count} workers")
+        for topic in lot_topics:
+            client.subscribe(f"lot/+/{topic}")
+
+    def on_message(self,client,userdata,msg):
+        parsed = parseLotTopic(msg.topic)
+        if parsed == None:
+            return
+        lot_id,topic = parsed
+        if lot_id not in self.lot_configs:
+            if lot_id not in self.unknown_lots:
+                self.unknown_lots.add(lot_id)
+                prRed(f"Ignoring messages for unknown lot {lot_id}")
+            return
+        self.inboxes[self.workerFor(lot_id)].put((lot_id,topic,bytes(msg.payload),time.time()))
+
+    def publishLoop(self):
+        # Publishes whatever the workers produced. Keeps going until every worker has said goodbye
+        while self.running or not self.outbox.empty():
+            try:
+                lot_id,topic,payload = self.outbox.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if lot_id == None:
+                self.metrics.update(payload)
+                for metrics_lot,report in payload.items():
+                    self.client.publish(f"lot/{metrics_lot}/metrics",payload=encodeJson(report),qos=0,retain=False)
+                continue
+            self.client.publish(f"lot/{lot_id}/{topic}",payload=payload,qos=0,retain=False)
+
+    def stop(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for process in self.processes:
+            process.join()
+        self.running = False
+        self.publisher.join()
+
+    def getReport(self):
+        lines = [f"{'lot':>8} {'worker':>6} {'clients':>7} {'msg/s':>8} {'verdicts/s':>10} {'fusion (ms)':>11} {'load':>6}"]
+        for lot_id in sorted(self.metrics.keys()):
+            report = self.metrics[lot_id]
+            lines.append(f"{lot_id:>8} {self.assignment.get(lot_id,-1):>6} {report['clients']:>7} {report['messages_per_second']:>8.1f} {report['verdicts_per_second']:>10.2f} {report['mean_fusion_ms']:>11.3f} {report['fusion_load']*100:>5.1f}%")
+        return "\n".join(lines)
+
+def loadLotConfigs(pairs):
+    # ["A=consolidated_config.json", ...] -> {"A": config dict, ...}
+    lot_configs = {}
+    for pair in pairs:
+        lot_id,path = pair.split("=",1)
+        with open(path,"r") as config_file:
+            lot_configs[lot_id] = json.load(config_file)
+    return lot_configs
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-lot broker")
+    parser.add_argument("--lot",action="append",default=None,metavar="ID=CONFIG",help="A lot and its client config file (repeatable)")
+    parser.add_argument("--workers",type=int,default=None,help="Worker processes (default: one per lot, up to the CPU count)")
+    parser.add_argument("-id",type=int,help="Test ID number",default=0)
+    parser.add_argument("--report",type=float,default=5.0,help="Seconds between metrics printouts")
+    args = parser.parse_args()
+
+    import paho.mqtt.client as mqtt
+    server = LotServer(loadLotConfigs(args.lot or ["0=consolidated_config.json"]),args.workers,args.id)
+    client = mqtt.Client()
+    server.start(client)
+    client.connect(settings["broker_IP"],settings["port_Num"],keepalive=60)
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(args.report)
+            print(server.getReport())
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    server.stop()
+    print(server.getReport())
+    client.disconnect()
+
+if __name__ == "__main__":
+    main()
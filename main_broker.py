@@ -6,6 +6,9 @@ import time
 import numpy as np
 from colors import *
 from server_config import config as settings
+from client_registry import ClientRegistry
+from codec import encode, decode
+from reputation_fusion import ObjectFusion
 
 broker_IP = "localhost"
 port_Num = 1883
@@ -21,6 +24,9 @@ vehicle_locations = client_config_data["vehicle_locations"]
 
 NoneObject = ["None",0.1,0.0]
 
+# Confidence x distance x reputation weighted votes, and every client's reputation (see reputation_fusion.py)
+object_fusion = ObjectFusion(object_locations.keys(),settings["confidence_calibration"])
+
 class Decision:
     def __init__(self,decision_label,confidence,time_stamp):
         self.label = decision_label
@@ -52,7 +58,6 @@ class Client:
     def __init__(self,client_name):
         self.name = client_name
         self.decision = None
-        self.reputation = 0.5
 
     def makeDecision(self,decision):
         self.decision = decision
@@ -62,29 +67,10 @@ class Client:
     
     def setDecision(self,decision):
         self.decision = decision
+        object_fusion.setFrame(self.name,decision["object_list"],decision["timestamp"])
     
     def getReputation(self):
-        return self.reputation
-    
-    def noteOutcome(self,verdicts):
-        output = 0
-        try:
-            # Don't do anything if you made NO decisions
-            if self.getDecision() == None:
-                return
-            # Get list of this client's decisions
-            decisions = self.getDecision()["object_list"]
-            # Compare decisions to actual verdicts. -1 = disagree, 0 = no true verdict, 1 = agree
-            comparisons = [(float(decisions[obj][0] == verdicts[obj] if verdicts[obj] != "None" else 0.5)-0.5)*2 for obj in object_locations.keys()]
-            # Increment (or decrement) reputation based on comparisons
-            print("SUM COMP: ",sum(comparisons))
-            print(comparisons)
-            self.reputation = clamp(self.reputation + sum(comparisons) * settings["reputation_increment"], settings["min_reputation"], 1)
-            output = len([c for c in comparisons if c < -0.5])
-        except Exception as e:
-            print(e)
-        finally:
-            return output
+        return object_fusion.getReputation(self.name)
 
     def getName(self):
         return self.name
@@ -101,13 +87,10 @@ def clamp(value,min_value=0.0,max_value=1.0):
     return max(min_value, min(value, max_value))
 
 def encodePayload(data):
-    data["source"] = "main_broker"
-    output = bytearray()
-    output.extend(map(ord,json.dumps(data)))
-    return output
+    return encode(dict(data,source="main_broker"))
 
-def decodePayload(string_data):
-    return json.loads(string_data)
+def decodePayload(raw):
+    return decode(raw)
 
 def publish(CLIENT,topic,message):
     CLIENT.publish(topic,payload=encodePayload(message),qos=0,retain=False)
@@ -121,18 +104,16 @@ def on_connect(CLIENT, userdata, flags, rc):
     CLIENT.subscribe("data_V2B")
     CLIENT.subscribe("request_config")
 
-activeClients = []
+activeClients = ClientRegistry() # Looks up clients by name, iterates in name order
 
 def issueConfig():
     CLIENT.publish("config",payload=client_config_str,qos=0,retain=False)
 
 def initializeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                raise Exception("Client already exists")
-        new_client = Client(client_name)
-        activeClients.append(new_client)
+        if client_name in activeClients:
+            raise Exception("Client already exists")
+        new_client = activeClients.add(Client(client_name))
         issueConfig()
         prCyan("Added client: "+client_name)
         return new_client
@@ -141,13 +122,10 @@ def initializeClient(client_name):
 
 def removeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                activeClients.remove(client)
-                prCyan("Removed client: "+client_name)
-                return
-        raise Exception("Client not found")
-    except:
+        activeClients.remove(client_name)
+        object_fusion.removeClient(client_name)
+        prCyan("Removed client: "+client_name)
+    except KeyError:
         prRed("Failed to remove client. Client not found: "+client_name)
 
 def getVerdict():
@@ -160,12 +138,6 @@ def getVerdict():
     # Refresh the last verdict time
     last_verdict_time = NOW
 
-    # Initialize a list of blank Default Dictionaries to count occurrences of each decision
-    global dd
-    object_counts = {}
-    for obj in object_locations.keys():
-        object_counts[obj] = dd(int)
-
     # Clear the output log
     print("\033[H\033[J", end="")
 
@@ -175,7 +147,7 @@ def getVerdict():
         print("Getting verdict for t ="+str(NOW))
         print("-"*40)
 
-    # Count the number of each decision made
+    # Verbose output of every live decision. The weighting itself happens in object_fusion, for all clients at once
     for client in activeClients:
         decision = client.getDecision()
         # Throw out expired decisions
@@ -183,16 +155,6 @@ def getVerdict():
             continue
         # Get the dictionary of detected objects
         detected_objects = decision["object_list"]
-        # Add the decision, using confidence level as the weight
-        #counts[decision.getLabel()] += decision.getConfidence() * client.getReputation()
-        ##########################################
-        # NEW LOGIC
-        for obj in object_locations.keys():
-            this_dd = object_counts[obj]
-            chosen_obj = detected_objects[obj] or NoneObject
-            this_dd[chosen_obj[0]] += chosen_obj[1] * client.getReputation() * (1/np.log(chosen_obj[2])) # Confidence * Reputation * (1/log(distance))
-        ##########################################
-        # Verbose output
         if settings["show_verbose_output"]:
             output_str = f"@{client.getName()} (rep={client.getReputation():.3f}):"
             for name,obj in detected_objects.items():
@@ -200,11 +162,8 @@ def getVerdict():
                 else: output_str += f" {name}={obj[0]} ({obj[1]*100:.1f}%) ..."
             prYellow(output_str)
     
-    # Determine the most confident decisions for each object
-    verdicts = {}
-    for obj,this_dd in object_counts.items():
-        verdicts[obj] = max(this_dd,key=this_dd.get)
-    #verdict = f"{max(counts,key=counts.get)}"
+    # Determine the most confident decisions for each object: Confidence * Reputation * distance weight
+    verdicts = object_fusion.verdicts(NOW)
     
     # Publish the verdict
     publish(main_client,"verdict",{"message":verdicts})
@@ -217,10 +176,8 @@ def getVerdict():
         prGreen("Submitted verdict: "+verdicts)
 
     if len(activeClients) > 1:
-        # Update client reputations using Client object methods
-        wrong_decision_count = 0
-        for client in activeClients:
-            wrong_decision_count += client.noteOutcome(verdicts)
+        # Update every client's reputation at once
+        wrong_decision_count = object_fusion.updateReputations(NOW)
         prPurple(f"\n# of clients(x)decisions who had their minds changed: {wrong_decision_count}/{len(activeClients)*len(object_locations)}")
     else:
         prPurple("\nOnly one client, no reputation changes to be made.")
@@ -232,10 +189,7 @@ def didEveryoneDecide():
     return True
 
 def getClientByName(client_name):
-    for client in activeClients:
-        if client.getName() == client_name:
-            return client
-    return None
+    return activeClients.get(client_name)
 
 def interpretData(payload):
     client = getClientByName(payload["source"])
@@ -252,10 +206,8 @@ def interpretData(payload):
 
 # The callback function, it will be triggered when receiving messages
 def on_message(CLIENT, userdata, msg):
-    # Turn from byte array to string text
-    payload = msg.payload.decode("utf-8")
-    # Turn from string text to data structure
-    payload = decodePayload(payload)
+    # Turn from bytes to data structure
+    payload = decodePayload(msg.payload)
     # Decide what to do, based on the message's topic
     if msg.topic == "new_client":
         # Add a new client!
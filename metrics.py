@@ -0,0 +1,217 @@
+# metrics.py
+# Always-on broker instrumentation: how long each stage of message handling and verdicts takes, how many messages
+# arrive per topic, and how old the data is (see clock_sync.py for where capture times come from). Ages:
+#   data            verdict time minus capture time, for each frame at the first verdict it can affect
+#   transit         arrival time minus capture time, for each frame
+#   verdict_oldest  age of the oldest frame each verdict used
+#   verdict_newest  age of the newest frame each verdict used
+#   clock_round_trip  round trip of each clock_ping/clock_pong exchange
+#
+# Timings go into log-linear histograms (like HDR histograms: 32 buckets per power of two, so any quantile is within
+# ~3% of the true value) that cost one bit_length and one list increment per sample. Recording takes no lock. Two
+# threads recording into the same histogram at the same moment can lose a count, which is fine for these numbers.
+#
+#   start = time.perf_counter_ns()
+#   ...
+#   registry.record("publish",start)
+#
+# MetricsReporter serves the numbers as Prometheus text on http://127.0.0.1:<metrics_port>/metrics and publishes a
+# JSON summary on the `metrics` topic every metrics_interval seconds.
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+metrics_topic = "metrics"
+sub_bits = 5
+sub_buckets = 1 << sub_bits
+max_shift = 40 # Values up to 2^46 ns (~19 hours). Anything longer lands in the last bucket
+quantiles = (0.5,0.9,0.99,0.999)
+
+def bucketIndex(value):
+    if value < 2 * sub_buckets:
+        return value
+    shift = value.bit_length() - sub_bits - 1
+    if shift > max_shift:
+        return 2 * sub_buckets + max_shift * sub_buckets - 1
+    return 2 * sub_buckets + (shift - 1) * sub_buckets + (value >> shift) - sub_buckets
+
+def bucketValue(index):
+    # The middle of the bucket's range
+    if index < 2 * sub_buckets:
+        return index
+    shift = (index - 2 * sub_buckets) // sub_buckets + 1
+    mantissa = (index - 2 * sub_buckets) % sub_buckets + sub_buckets
+    return (mantissa << shift) + (1 << (shift - 1))
+
+class Histogram:
+    # Non-negative integer samples (nanoseconds)
+    def __init__(self):
+        self.counts = [0] * (2 * sub_buckets + max_shift * sub_buckets)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self,value):
+        if value < 0:
+            value = 0
+        self.counts[bucketIndex(value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def quantiles(self,qs=quantiles):
+        # Values at each of the (ascending) quantiles qs, in one pass over the buckets
+        values = []
+        if self.count == 0:
+            return [0] * len(qs)
+        seen = 0
+        for index,count in enumerate(self.counts):
+            if count == 0:
+                continue
+            seen += count
+            while len(values) < len(qs) and seen >= qs[len(values)] * self.count:
+                values.append(min(bucketValue(index),self.max))
+            if len(values) == len(qs):
+                break
+        return values + [self.max] * (len(qs) - len(values))
+
+    def summary(self,scale=1e-9):
+        # Count, mean, max and quantiles, in seconds
+        return {
+            "count":self.count,
+            "mean":self.total / self.count * scale if self.count > 0 else 0.0,
+            "max":self.max * scale,
+            **{f"p{q*100:g}":value * scale for q,value in zip(quantiles,self.quantiles())},
+        }
+
+class Metrics:
+    def __init__(self,name="broker"):
+        self.name = name
+        self.stages = {} # stage -> Histogram of durations
+        self.messages = {} # topic -> count
+        self.ages = {} # kind -> Histogram of ages (see above)
+        self.capture_times = [] # Capture time of each frame stored since the last verdict
+        self.start_time = time.time()
+
+    def record(self,stage,start):
+        # start: time.perf_counter_ns() when the stage began
+        elapsed = time.perf_counter_ns() - start
+        histogram = self.stages.get(stage)
+        if histogram == None:
+            histogram = self.stages.setdefault(stage,Histogram())
+        histogram.record(elapsed)
+
+    def count(self,topic):
+        self.messages[topic] = self.messages.get(topic,0) + 1
+
+    def recordAge(self,kind,seconds):
+        histogram = self.ages.get(kind)
+        if histogram == None:
+            histogram = self.ages.setdefault(kind,Histogram())
+        histogram.record(int(seconds * 1e9))
+
+    def noteFrame(self,decision):
+        # A frame was stored. Its data age is recorded at the next verdict, the first one it can affect
+        capture_time = decision.get("capture_time",decision["timestamp"])
+        self.capture_times.append(capture_time)
+        self.recordAge("transit",decision.get("arrival_time",capture_time) - capture_time)
+
+    def recordAges(self,now):
+        capture_times,self.capture_times = self.capture_times,[]
+        for capture_time in capture_times:
+            self.recordAge("data",now - capture_time)
+
+    def reset(self):
+        self.stages = {}
+        self.messages = {}
+        self.ages = {}
+        self.capture_times = []
+        self.start_time = time.time()
+
+    def snapshot(self):
+        return {
+            "broker":self.name,
+            "uptime":time.time() - self.start_time,
+            "stages":{stage:histogram.summary() for stage,histogram in list(self.stages.items())},
+            "messages":dict(self.messages),
+            "ages":{kind:histogram.summary() for kind,histogram in list(self.ages.items())},
+        }
+
+    def prometheus(self):
+        # Prometheus text exposition format
+        broker = self.name
+        lines = ["# HELP broker_stage_seconds Time spent in each stage of message handling and verdicts","# TYPE broker_stage_seconds summary"]
+        for stage,histogram in sorted(list(self.stages.items())):
+            lines += summaryLines("broker_stage_seconds",f'broker="{broker}",stage="{stage}"',histogram)
+        lines += ["# HELP broker_messages_total Messages received per topic","# TYPE broker_messages_total counter"]
+        for topic,count in sorted(list(self.messages.items())):
+            lines.append(f'broker_messages_total{{broker="{broker}",topic="{topic}"}} {count}')
+        lines += ["# HELP broker_sample_age_seconds How old frames are (kind: data, transit, verdict_oldest, verdict_newest, clock_round_trip)","# TYPE broker_sample_age_seconds summary"]
+        for kind,histogram in sorted(list(self.ages.items())):
+            lines += summaryLines("broker_sample_age_seconds",f'broker="{broker}",kind="{kind}"',histogram)
+        lines.append(f'broker_uptime_seconds{{broker="{broker}"}} {time.time() - self.start_time:.3f}')
+        return "\n".join(lines) + "\n"
+
+def summaryLines(metric,labels,histogram):
+    lines = [f'{metric}{{{labels},quantile="{q:g}"}} {value * 1e-9:.9g}' for q,value in zip(quantiles,histogram.quantiles())]
+    lines.append(f"{metric}_sum{{{labels}}} {histogram.total * 1e-9:.9g}")
+    lines.append(f"{metric}_count{{{labels}}} {histogram.count}")
+    return lines
+
+registry = Metrics() # The process's metrics. Brokers set registry.name when they start
+
+class MetricsReporter:
+    # Serves metrics over HTTP and/or publishes them on the metrics topic
+    def __init__(self,metrics,publish=None,interval=0.0,port=0,host="127.0.0.1",on_error=print):
+        self.metrics = metrics
+        self.publish = publish
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.server = None
+        if port > 0:
+            try:
+                self.server = ThreadingHTTPServer((host,port),metricsHandler(metrics))
+                self.server.daemon_threads = True
+                threading.Thread(target=self.server.serve_forever,name="metrics_http",daemon=True).start()
+            except OSError as e:
+                on_error(f"Metrics endpoint not started on port {port}: {e}")
+        if publish != None and interval > 0:
+            threading.Thread(target=self.run,name="metrics_publisher",daemon=True).start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.publish(self.metrics.snapshot())
+
+    def stop(self):
+        self.stopped.set()
+        if self.server != None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
+
+def metricsHandler(metrics):
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path in ("/metrics","/"):
+                body = metrics.prometheus().encode()
+                content_type = "text/plain; version=0.0.4"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.snapshot()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type",content_type)
+            self.send_header("Content-Length",str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self,format,*args):
+            pass # Keep scrapes off the console
+    return MetricsHandler
+
+def reporterFromSettings(settings,publish,on_error=print):
+    return MetricsReporter(registry,publish,settings["metrics_interval"],settings["metrics_port"],on_error=on_error)
@@ -1,14 +1,27 @@
 # parking_broker.py
-import paho.mqtt.client as mqtt
 import json
+import sys
 from collections import defaultdict as dd
 import time
 import numpy as np
 from colors import *
 from server_config import config as settings
+from broker_core import runBroker, PahoTransport
+from client_registry import ClientRegistry
 from time import sleep as wait
+from time import perf_counter_ns # Stage timers. Not through `time`, which replays swap for a simulated clock
 import argparse
 import os
+import threading
+from verdict_scheduler import schedulerThreadFor, schedulerFromSettings
+from codec import encode, decode, encodeJson, availableFormats, FormatNegotiator
+from config_model import loadConfig, configFromControl, watcherFromSettings, ConfigError, control_topic
+from dashboard import dashboardFromSettings, clear_screen
+from metrics import registry as broker_metrics, reporterFromSettings, metrics_topic
+from clock_sync import ClockSync, SampleAges, ping_topic, pong_topic, receiveTime
+from profiler import ProfileControl, profile_commands, profile_topic
+from result_writer import writerFromSettings, finalizeObjects
+from archive import exportRun
 
 if not os.path.exists('outputs'):
    os.makedirs('outputs')
@@ -21,23 +34,32 @@ last_verdict_time = 0.0
 
 broker_start_time = 0
 
-client_config_file = open("object_config.json","r")
-client_config_str = client_config_file.read()
-client_config_data = json.loads(client_config_str)
-client_config_file.close()
+# Validated once here (see config_model.py). Replaced by a new LotConfig when the config is reloaded
+lot_config = loadConfig("object_config.json","objects")
+client_config_data = lot_config.data
+pending_config = None # A reloaded config, swapped in at the start of the next verdict
+config_watcher = None # Only used when settings["config_reload"] == "watch"
 
-object_locations = client_config_data["object_locations"]
-vehicle_locations = client_config_data["vehicle_locations"]
+object_locations = lot_config.object_locations
+vehicle_locations = lot_config.vehicle_locations
 
 NoneObject = ["None",0.1,0.0]
 
 object_history = [] # Contents look like: 0.75, 0.67, ... THIS is a list of OBJECT decisions based on snapshot accuracy %
 verdict_id = 0
 
+state_lock = threading.RLock() # Held while client decisions change or a verdict runs
+verdict_scheduler = None # Only used when settings["verdict_trigger"] == "scheduled"
+scheduler_thread = None
+dashboard = None # Console output, see dashboard.py. None when settings["dashboard_mode"] == "off"
+metrics_reporter = None # Serves and publishes broker_metrics, see metrics.py
+profile_control = None # Runs the start_profile/stop_profile control commands, see profiler.py
+clock_sync = ClockSync() # Per-vehicle clock offsets, so frames keep their capture time. See clock_sync.py
+result_writer = None # Streams every client's raw object_list to outputs/objects/output_{test_id}.jsonl, see result_writer.py
+
 parser = argparse.ArgumentParser(description="Consolidated Broker for Object Detection Data")
 parser.add_argument("-id",type=int,help="Test ID number",default=0)
-args = parser.parse_args()
-test_id = args.id
+test_id = 0 # Set from the command line when run as a script
 
 def log_decision(verdicts):
     # Objects
@@ -61,6 +83,8 @@ def print_decision_report():
     # Progress / status bar
     print(f"[{getCyan('#'*int(ratio))}{'.'*(50-int(ratio))}]")
     print(f"Progress: {getYellow(verdict_id-10)}/{client_config_data['max_decision_history']} ({getGreen(np.round((verdict_id-10)/client_config_data['max_decision_history']*100,3))}%). ETA: {getYellow(np.round((client_config_data['max_decision_history']-verdict_id+10)*avg_time_per_verdict,3))}s")
+    if verdict_scheduler != None:
+        print(verdict_scheduler.getReport())
 
 class Client:
     def __init__(self,client_name):
@@ -77,6 +101,7 @@ class Client:
     
     def setDecision(self,decision):
         self.decision = decision
+        broker_metrics.noteFrame(decision)
     
     def getReputation(self):
         return self.reputation
@@ -136,17 +161,15 @@ main_client = None
 def clamp(value,min_value=0.0,max_value=1.0):
     return max(min_value, min(value, max_value))
 
-def encodePayload(data):
-    data["source"] = "main_broker"
-    output = bytearray()
-    output.extend(map(ord,json.dumps(data)))
-    return output
+def encodePayload(data,wire_format="json"):
+    return encode(dict(data,source="main_broker"),wire_format)
 
-def decodePayload(string_data):
-    return json.loads(string_data)
+def decodePayload(raw):
+    return decode(raw)
 
 def publish(CLIENT,topic,message):
-    CLIENT.publish(topic,payload=encodePayload(message),qos=0,retain=False)
+    # Verdicts go out in the negotiated wire format, everything else as JSON
+    CLIENT.publish(topic,payload=encodePayload(message,verdict_format if topic == "verdict" else "json"),qos=0,retain=False)
 
 def on_connect(CLIENT, userdata, flags, rc):
     prCyan(f"Connected with result code {rc}")
@@ -156,20 +179,65 @@ def on_connect(CLIENT, userdata, flags, rc):
     # Subscribe to view incoming data from clients
     CLIENT.subscribe("data_V2B")
     CLIENT.subscribe("request_config")
+    CLIENT.subscribe(control_topic)
+    CLIENT.subscribe(pong_topic)
+
+activeClients = ClientRegistry() # Looks up clients by name, iterates in name order
 
-activeClients = []
+wire_formats = FormatNegotiator() # Replaced in startBroker, with settings["wire_format"] as the preferred format
+verdict_format = "json" # The format verdicts currently go out in
+
+def updateWireFormat():
+    # Re-negotiate the verdict format after the client list (or what a client accepts) changed. Returns True if it changed
+    global verdict_format
+    chosen = wire_formats.choose(client.getName() for client in activeClients)
+    if chosen == verdict_format:
+        return False
+    prCyan(f"Verdicts are now sent as {chosen}")
+    verdict_format = chosen
+    return True
 
 def issueConfig():
-    CLIENT.publish("config",payload=client_config_str,qos=0,retain=False)
+    # The client config, plus the format verdicts are sent in and the formats this broker can send
+    CLIENT.publish("config",payload=lot_config.payload(verdict_format),qos=0,retain=False)
+
+def queueConfig(new_config):
+    # Called by the config watcher thread, or for a broker_control reload. The swap waits for the next verdict
+    global pending_config
+    pending_config = new_config
+    prCyan("Config reloaded, it takes effect at the next verdict")
+
+def reloadFromControl(payload):
+    try:
+        queueConfig(configFromControl(payload,lot_config))
+    except ConfigError as e:
+        prRed(f"Keeping the current config. {e}")
+
+def applyPendingConfig():
+    # Swap in a reloaded config between verdicts. Clients, their decisions and every history stay as they are
+    global pending_config, lot_config, client_config_data, object_locations, vehicle_locations
+    new_config = pending_config
+    if new_config == None:
+        return False
+    pending_config = None
+    if new_config.max_decision_history != lot_config.max_decision_history:
+        prYellow("max_decision_history changed. The run ends at the new count")
+    lot_config = new_config
+    client_config_data = new_config.data
+    object_locations = new_config.object_locations
+    vehicle_locations = new_config.vehicle_locations
+    if result_writer != None:
+        result_writer.write({"type":"config","config":client_config_data,"object_locations":object_locations,"vehicle_locations":vehicle_locations})
+    issueConfig()
+    return True
 
 def initializeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                raise Exception("Client already exists")
-        new_client = Client(client_name)
-        activeClients.append(new_client)
-        activeClients.sort(key=lambda x: x.name)
+        if client_name in activeClients:
+            raise Exception("Client already exists")
+        new_client = activeClients.add(Client(client_name))
+        clock_sync.expect(client_name)
+        updateWireFormat()
         issueConfig()
         prCyan("Added client: "+client_name)
         return new_client
@@ -178,13 +246,13 @@ def initializeClient(client_name):
 
 def removeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                activeClients.remove(client)
-                prCyan("Removed client: "+client_name)
-                return
-        raise Exception("Client not found")
-    except:
+        activeClients.remove(client_name)
+        wire_formats.forget(client_name)
+        clock_sync.forget(client_name)
+        if updateWireFormat():
+            issueConfig()
+        prCyan("Removed client: "+client_name)
+    except KeyError:
         prRed("Failed to remove client. Client not found: "+client_name)
 
 def getClosestObject(parking_list,pos):
@@ -200,28 +268,36 @@ def getClosestObject(parking_list,pos):
 def getDistance(x1,y1,x2,y2):
     return np.sqrt((x1-x2)**2 + (y1-y2)**2)
 
-final_outputs = {}
 
 def quitIfExhausted():
     global verdict_id
-    global final_outputs
     if verdict_id >= client_config_data["max_decision_history"] + 10 or verdict_id<0:
         if verdict_id > 0:
             # Tell the clients that the data collection is done. Communication is key! :)
             publish(main_client,"finished",{"message":"I'm done!"})
+            if dashboard != None:
+                dashboard.stop()
+            if config_watcher != None:
+                config_watcher.stop()
+            if metrics_reporter != None:
+                metrics_reporter.stop()
+            clock_sync.stop()
+            if profile_control != None:
+                profile_control.stop()
             # Display the config data:
             print(f"\nConfig data: {getCyan(client_config_data)}")
-            pkg = {
-                "object_locations":object_locations,
-                "vehicle_locations":vehicle_locations,
-                "raw_data":final_outputs,
-                "config":client_config_data,
-                "test_id":test_id
-            }
-            output_file = open(f"outputs/objects/output_{test_id}.json","w")
-            output_file.write(json.dumps(pkg,indent=4))
-            wait(1)
-            exit(0)
+            # Every frame is already on disk. Fold the stream into the usual output file
+            if result_writer != None:
+                result_writer.close()
+                finalizeObjects(result_writer.path,f"outputs/objects/output_{test_id}.json")
+                if settings["archive_results"]:
+                    exportRun(f"outputs/objects/output_{test_id}.json")
+            if not hasattr(main_client,"requestShutdown"):
+                # A bare paho client gets a second to send what is queued. broker_core.py drains its queue instead,
+                # and sends "finished" last
+                wait(1)
+                exit(0)
+            main_client.requestShutdown()
         verdict_id = -1
         return True
     else:
@@ -231,6 +307,8 @@ def getVerdict():
     global last_verdict_time
     global verdict_id
 
+    applyPendingConfig()
+
     # Exit out of the loop after all the necessary data has been compiled!
     if quitIfExhausted(): return
 
@@ -239,20 +317,20 @@ def getVerdict():
     # Refresh the last verdict time
     last_verdict_time = NOW
     verdict_id += 1 # Increment the verdict ID
-
-    # Clear the output log
-    print("\033[H\033[J", end="")
+    verdict_start = perf_counter_ns()
+    broker_metrics.recordAges(NOW)
+
+    if dashboard != None:
+        # Hand the renderer a copy of what it shows. All of the formatting happens in renderDashboard
+        start = perf_counter_ns()
+        with state_lock:
+            # Names of the clients without recent data. The renderer must not read the clients themselves
+            skipped = [client.getName() for client in activeClients if client.getDecision() == None or client.getDecision()["timestamp"] < NOW - settings["oldest_allowable_data"]]
+        dashboard.update({"verdict_id":verdict_id,"time":NOW,"skipped":skipped})
+        broker_metrics.record("dashboard",start)
 
     if verdict_id <= 10:
-        print("-"*40)
-        print(f"Waiting for verdicts to accumulate ({getCyan(verdict_id)}/10)...")
-        print("-"*40)
         return
-    else:
-        print("-"*40)
-        max_dec = client_config_data["max_decision_history"]
-        print(f"Getting verdict #{getYellow(verdict_id-10)}/{max_dec} ({np.round((verdict_id-10)/max_dec,0)}%) (t=...{getCyan(np.round(NOW%10000,3))}s)")
-        print("-"*40)
     
     # Initialize a list of blank Default Dictionaries to count occurrences of each decision
     global dd
@@ -262,43 +340,66 @@ def getVerdict():
         decision = client.getDecision()
         # Throw out expired decisions
         if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
-            print(f"Skipping client: {client.getName()}")
             continue
         ############################################################################################################
         ''' DO OBJECT DETECTION STUFF '''
         ############################################################################################################
-        name = client.getName()
-        if name in final_outputs.keys():
-            final_outputs[name].append(decision["object_list"])
-        else:
-            final_outputs[name] = [decision["object_list"]]
+        if result_writer != None:
+            result_writer.write({"type":"raw","id":verdict_id,"name":client.getName(),"objects":decision["object_list"]})
+    broker_metrics.record("verdict",verdict_start)
     
 
     
 
+def renderDashboard(snapshot):
+    # One screen of console output for a verdict snapshot (see dashboard.py)
+    lines = ["-"*40]
+    NOW = snapshot["time"]
+    if snapshot["verdict_id"] <= 10:
+        lines.append(f"Waiting for verdicts to accumulate ({getCyan(snapshot['verdict_id'])}/10)...")
+        lines.append("-"*40)
+        return clear_screen + "\n".join(lines) + "\n"
+    max_dec = client_config_data["max_decision_history"]
+    lines.append(f"Getting verdict #{getYellow(snapshot['verdict_id']-10)}/{max_dec} ({np.round((snapshot['verdict_id']-10)/max_dec,0)}%) (t=...{getCyan(np.round(NOW%10000,3))}s)")
+    lines.append("-"*40)
+    for name in snapshot["skipped"]:
+        lines.append(f"Skipping client: {name}")
+    return clear_screen + "\n".join(lines) + "\n"
+
 def didEveryoneDecide():
+    # True once every live client (one with unexpired data) has reported since the last verdict
+    NOW = time.time()
+    anyone_live = False
     for client in activeClients:
-        if client.getDecision() == None:
+        decision = client.getDecision()
+        if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
+            continue
+        if decision.get("arrival_time",decision["timestamp"]) <= last_verdict_time:
             return False
-    return True
+        anyone_live = True
+    return anyone_live
 
 def getClientByName(client_name):
-    for client in activeClients:
-        if client.getName() == client_name:
-            return client
-    return None
+    return activeClients.get(client_name)
 
 def interpretData(payload):
+    start = perf_counter_ns()
     client = getClientByName(payload["source"])
-    payload["timestamp"] = time.time()
+    broker_metrics.record("lookup",start)
+    clock_sync.stamp(payload,time.time(),settings["staleness_clock"])
     if client == None:
         prCyan("Attempting to create new client, "+payload["source"])
         client = initializeClient(payload["source"])
         if client == None:
             prRed("Failed to create new client")
             return
+    start = perf_counter_ns()
     client.setDecision(payload)
-    if time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
+    broker_metrics.record("store",start)
+    if scheduler_thread != None:
+        # Verdicts run on a fixed schedule. Just let the scheduler know, in case everyone has reported now
+        scheduler_thread.notify()
+    elif time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
         getVerdict()
 
 # The callback function, it will be triggered when receiving messages
@@ -306,33 +407,68 @@ def on_message(CLIENT, userdata, msg):
     global broker_start_time
     if broker_start_time == 0:
         broker_start_time = time.time()
-    # Turn from byte array to string text
-    payload = msg.payload.decode("utf-8")
-    # Turn from string text to data structure
-    payload = decodePayload(payload)
+    broker_metrics.count(msg.topic)
+    # Turn from bytes (JSON, MessagePack or packed) to data structure
+    start = perf_counter_ns()
+    payload = decodePayload(msg.payload)
+    broker_metrics.record("decode",start)
     # Decide what to do, based on the message's topic
-    if msg.topic == "new_client":
-        # Add a new client!
-        initializeClient(payload["source"])
-    elif msg.topic == "end_client":
-        # Remove an existing client. Sad!
-        removeClient(payload["source"])
-    elif msg.topic == "data_V2B":
-        # Interpret the data
-        interpretData(payload)
-    elif msg.topic == "request_config":
-        issueConfig()
-
-CLIENT = mqtt.Client()
-CLIENT.on_connect = on_connect
-CLIENT.on_message = on_message
-main_client = CLIENT
-
-# Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
-CLIENT.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
-
-# Create connection, the three parameters are broker address, broker port number, and keep-alive time respectively
-CLIENT.connect(broker_IP, port_Num, keepalive=60)
-
-# Set the network loop blocking, it will not actively end the program before calling disconnect() or the program crash
-CLIENT.loop_forever()
\ No newline at end of file
+    with state_lock:
+        if msg.topic == "new_client":
+            # Add a new client!
+            wire_formats.accept(payload["source"],payload.get("formats"))
+            initializeClient(payload["source"])
+        elif msg.topic == "end_client":
+            # Remove an existing client. Sad!
+            removeClient(payload["source"])
+        elif msg.topic == "data_V2B":
+            # Interpret the data
+            interpretData(payload)
+        elif msg.topic == "request_config":
+            # Clients may list the wire formats they can decode, e.g. {"source":"car1","formats":["packed","json"]}
+            wire_formats.accept(payload.get("source"),payload.get("formats"))
+            updateWireFormat()
+            issueConfig()
+        elif msg.topic == control_topic:
+            if payload.get("command") == "reload_config":
+                reloadFromControl(payload)
+            elif payload.get("command") in profile_commands and profile_control != None:
+                profile_control.handle(payload)
+        elif msg.topic == pong_topic:
+            round_trip = clock_sync.onPong(payload,receiveTime(msg,time.time()))
+            if round_trip != None:
+                broker_metrics.recordAge("clock_round_trip",round_trip)
+
+def startBroker(client):
+    # Wires the broker up to an MQTT client (a real paho client, or an in-process stand-in for replays) and starts
+    # any background fusion threads. Connecting and running the network loop is up to the caller
+    global CLIENT, main_client, wire_formats, dashboard, result_writer, verdict_scheduler, scheduler_thread, config_watcher, metrics_reporter, profile_control
+    CLIENT = client
+    main_client = client
+    wire_formats = FormatNegotiator(settings["wire_format"])
+    dashboard = dashboardFromSettings(settings,renderDashboard)
+    result_writer = writerFromSettings(settings,f"outputs/objects/output_{test_id}.jsonl")
+    result_writer.write({"type":"header","test_id":test_id,"config":client_config_data,"object_locations":object_locations,"vehicle_locations":vehicle_locations})
+    config_watcher = watcherFromSettings(settings,lot_config,queueConfig,prRed)
+    broker_metrics.name = "objects"
+    metrics_reporter = reporterFromSettings(settings,lambda snapshot: publish(main_client,metrics_topic,snapshot),prRed)
+    clock_sync.start(lambda message: publish(main_client,ping_topic,message),lambda: time.time(),settings["clock_sync_interval"],prRed)
+    profile_control = ProfileControl(f"objects_{test_id}",lambda summary: publish(main_client,profile_topic,summary),settings,prCyan)
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    # Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
+    client.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
+
+    # Start the fixed-rate verdict scheduler, if verdicts should not be triggered by incoming messages
+    verdict_scheduler = schedulerFromSettings(settings,didEveryoneDecide)
+    if verdict_scheduler != None:
+        scheduler_thread = schedulerThreadFor(client,verdict_scheduler,getVerdict,state_lock)
+        scheduler_thread.start()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    test_id = args.id
+
+    # broker_core.py runs the MQTT connection, publishing, output flushing and shutdown around this module's fusion
+    runBroker(sys.modules[__name__],PahoTransport(broker_IP,port_Num))
@@ -1,12 +1,26 @@
 # parking_broker.py
-import paho.mqtt.client as mqtt
+import argparse
 import json
-from collections import defaultdict as dd
+import sys
 import time
 import numpy as np
 from colors import *
 from server_config import config as settings
+from broker_core import runBroker, PahoTransport
+from client_registry import ClientRegistry
+from ring_buffer import RingBuffer
+from plate_assignment import assignPlates, parseStack
 from time import sleep as wait
+from time import perf_counter_ns # Stage timers. Not through `time`, which replays swap for a simulated clock
+import threading
+from verdict_scheduler import schedulerThreadFor, schedulerFromSettings
+from codec import encode, decode, encodeJson, availableFormats, FormatNegotiator
+from config_model import loadConfig, configFromControl, watcherFromSettings, ConfigError, control_topic
+from verdict_delta import VerdictPublisher
+from dashboard import dashboardFromSettings, clear_screen
+from metrics import registry as broker_metrics, reporterFromSettings, metrics_topic
+from clock_sync import ClockSync, SampleAges, ping_topic, pong_topic, receiveTime
+from profiler import ProfileControl, profile_commands, profile_topic
 
 broker_IP = "localhost"
 port_Num = 1883
@@ -14,41 +28,65 @@ last_verdict_time = 0.0
 
 broker_start_time = 0
 
-client_config_file = open("parking_config.json","r")
-client_config_str = client_config_file.read()
-client_config_data = json.loads(client_config_str)
-client_config_file.close()
+# Validated once here (see config_model.py). Replaced by a new LotConfig when the config is reloaded
+lot_config = loadConfig("parking_config.json","parking")
+client_config_data = lot_config.data
+pending_config = None # A reloaded config, swapped in at the start of the next verdict
+config_watcher = None # Only used when settings["config_reload"] == "watch"
 
-empty_locations = client_config_data["empty_parking_spot_locations"]
-occupied_locations = client_config_data["occupied_parking_spot_locations"]
-truth_values = client_config_data["true_parking_occupants"]
-vehicle_locations = client_config_data["vehicle_locations"]
+empty_locations = lot_config.empty_locations
+occupied_locations = lot_config.occupied_locations
+truth_values = lot_config.truth_values
+vehicle_locations = lot_config.vehicle_locations
 
-decision_history = [] # Contents look like: 0.75, 0.67, ...
+# Spot coordinates as arrays, for vectorized closest-spot lookups
+empty_spot_index = lot_config.empty_spot_index
+occupied_spot_index = lot_config.occupied_spot_index
+
+decision_history = RingBuffer(client_config_data["max_decision_history"]) # Contents look like: 0.75, 0.67, ... (last max_decision_history verdicts only)
 verdict_id = 0
 
+state_lock = threading.RLock() # Held while client decisions change or a verdict runs
+verdict_scheduler = None # Only used when settings["verdict_trigger"] == "scheduled"
+scheduler_thread = None
+dashboard = None # Console output, see dashboard.py. None when settings["dashboard_mode"] == "off"
+metrics_reporter = None # Serves and publishes broker_metrics, see metrics.py
+profile_control = None # Runs the start_profile/stop_profile control commands, see profiler.py
+clock_sync = ClockSync() # Per-vehicle clock offsets, so frames keep their capture time. See clock_sync.py
+sample_ages = SampleAges() # Capture times of the frames the next verdict can use
+
+parser = argparse.ArgumentParser(description="Broker for Parking Lot Data")
+parser.add_argument("-id",type=int,help="Test ID number",default=0)
+test_id = 0 # Set from the command line when run as a script
+
 def log_decision(verdicts):
     accuracy = len([v for i,v in verdicts.items() if truth_values[int(i)]==v]) / len(verdicts)
     decision_history.append(accuracy)
-    if len(decision_history) > client_config_data["max_decision_history"]:
-        decision_history.pop(0)
 
-def print_decision_report():
-    global broker_start_time
-    print(f"Mean accuracy in last {getYellow(len(decision_history))} verdicts: {getGreen(np.round(np.mean(decision_history)*100,3))}%")
-    ratio = (len(decision_history)-10)/(client_config_data['max_decision_history']-10)*50
-    avg_time_per_verdict = (time.time()-broker_start_time) / len(decision_history)
+def getDecisionReport(snapshot):
+    # Returns the report as a list of lines
+    lines = []
+    count,mean,std = snapshot["decision_history"]
+    verdict_id = snapshot["verdict_id"]
+    lines.append(f"Mean accuracy in last {getYellow(count)} verdicts: {getGreen(np.round(mean*100,3))}% (std {np.round(std*100,3)}%)")
+    ratio = (count-10)/(client_config_data['max_decision_history']-10)*50
+    avg_time_per_verdict = (snapshot["time"]-broker_start_time) / count
     if avg_time_per_verdict < 0.1 or avg_time_per_verdict > 2:
         avg_time_per_verdict = 1
-    print(f"[{getCyan('#'*int(ratio))}{'.'*(50-int(ratio))}]")
-    print(f"Progress: {getYellow(verdict_id-10)}/{client_config_data['max_decision_history']} ({getGreen(np.round((verdict_id-10)/client_config_data['max_decision_history']*100,3))}%). ETA: {getYellow(np.round((client_config_data['max_decision_history']-verdict_id+10)*avg_time_per_verdict,3))}s")
+    lines.append(f"[{getCyan('#'*int(ratio))}{'.'*(50-int(ratio))}]")
+    lines.append(f"Progress: {getYellow(verdict_id-10)}/{client_config_data['max_decision_history']} ({getGreen(np.round((verdict_id-10)/client_config_data['max_decision_history']*100,3))}%). ETA: {getYellow(np.round((client_config_data['max_decision_history']-verdict_id+10)*avg_time_per_verdict,3))}s")
+    lines.extend(snapshot["reports"])
+    return lines
+
+def accuracyReport(votes,accuracy):
+    return f"Accuracy of last {getYellow(votes)} votes: {getGreen(np.round(accuracy*100,3))}%" if votes > 0 else "No decisions made yet."
 
 class Client:
     def __init__(self,client_name):
         self.name = client_name
         self.decision = None
         self.reputation = 0.5
-        self.decision_history = []
+        self.decision_history = RingBuffer(client_config_data["max_decision_history"])
 
     def makeDecision(self,decision):
         self.decision = decision
@@ -58,12 +96,18 @@ class Client:
     
     def setDecision(self,decision):
         self.decision = decision
+        broker_metrics.noteFrame(decision)
+        sample_ages.set(self.name,decision)
     
     def getReputation(self):
         return self.reputation
     
+    def getAccuracy(self):
+        # (votes, accuracy), see accuracyReport
+        return (len(self.decision_history),self.decision_history.mean())
+
     def getAccuracyReport(self):
-        return f"Accuracy of last {getYellow(len(self.decision_history))} votes: {getGreen(np.round(np.mean(self.decision_history)*100,3))}%" if len(self.decision_history) > 0 else "No decisions made yet."
+        return accuracyReport(*self.getAccuracy())
     
     def noteOutcome(self,verdicts):
         val = 0
@@ -72,18 +116,16 @@ class Client:
         if dec != None:
             dec = dec['object_list']
             val = 0
-            for obj in dec:
-                if obj['text'] == "EMPTY":
-                    closest_spot = getClosestObject(empty_locations,obj['position'])
-                    if verdicts[str(closest_spot)] == "EMPTY":
-                        val += 1
-                else:
-                    if verdicts[str(getClosestObject(occupied_locations,obj['position']))] == obj['text']:
-                        val += 1
+            empty_plates = [obj for obj in dec if obj['text'] == "EMPTY"]
+            taken_plates = [obj for obj in dec if obj['text'] != "EMPTY"]
+            # Look up the closest spots for all of this client's detections at once
+            for closest_spot in empty_spot_index.nearestMany([obj['position'] for obj in empty_plates]):
+                if verdicts[str(closest_spot)] == "EMPTY":
+                    val += 1
+            for obj,closest_spot in zip(taken_plates,occupied_spot_index.nearestMany([obj['position'] for obj in taken_plates])):
+                if verdicts[str(closest_spot)] == obj['text']:
+                    val += 1
             self.decision_history.append(val / len(verdicts))
-            # Trim the decision history to prevent memory leakage
-            if len(self.decision_history) > client_config_data["max_decision_history"]:
-                self.decision_history.pop(0)
 
         # Update reputation...
         try:
@@ -114,17 +156,25 @@ main_client = None
 def clamp(value,min_value=0.0,max_value=1.0):
     return max(min_value, min(value, max_value))
 
-def encodePayload(data):
-    data["source"] = "main_broker"
-    output = bytearray()
-    output.extend(map(ord,json.dumps(data)))
-    return output
+def encodePayload(data,wire_format="json"):
+    return encode(dict(data,source="main_broker"),wire_format)
 
-def decodePayload(string_data):
-    return json.loads(string_data)
+def decodePayload(raw):
+    return decode(raw)
 
 def publish(CLIENT,topic,message):
-    CLIENT.publish(topic,payload=encodePayload(message),qos=0,retain=False)
+    # Verdicts go out in the negotiated wire format, everything else as JSON
+    CLIENT.publish(topic,payload=encodePayload(message,verdict_format if topic == "verdict" else "json"),qos=0,retain=False)
+
+verdict_publisher = VerdictPublisher() # Replaced in startBroker, according to settings["verdict_publish_mode"]
+
+def publishVerdict(verdicts,sample_age=None):
+    # The full verdict, or (in delta mode) what changed since the last one. Keyframes also replace the retained snapshot.
+    # Verdict messages also say how old the frames behind them were: {"oldest":seconds,"newest":seconds}
+    for topic,message,retain in verdict_publisher.messages(verdict_id,verdicts):
+        if topic == "verdict":
+            message = dict(message,sample_age=sample_age)
+        main_client.publish(topic,payload=encodePayload(message,verdict_format),qos=0,retain=retain)
 
 def on_connect(CLIENT, userdata, flags, rc):
     prCyan(f"Connected with result code {rc}")
@@ -134,21 +184,69 @@ def on_connect(CLIENT, userdata, flags, rc):
     # Subscribe to view incoming data from clients
     CLIENT.subscribe("data_V2B")
     CLIENT.subscribe("request_config")
-
-activeClients = []
+    CLIENT.subscribe(control_topic)
+    CLIENT.subscribe(pong_topic)
+
+activeClients = ClientRegistry() # Looks up clients by name, iterates in name order
+
+wire_formats = FormatNegotiator() # Replaced in startBroker, with settings["wire_format"] as the preferred format
+verdict_format = "json" # The format verdicts currently go out in
+
+def updateWireFormat():
+    # Re-negotiate the verdict format after the client list (or what a client accepts) changed. Returns True if it changed
+    global verdict_format
+    chosen = wire_formats.choose(client.getName() for client in activeClients)
+    if chosen == verdict_format:
+        return False
+    prCyan(f"Verdicts are now sent as {chosen}")
+    verdict_format = chosen
+    return True
 
 def issueConfig():
-    CLIENT.publish("config",payload=client_config_str,qos=0,retain=False)
+    # The client config, plus the format verdicts are sent in and the formats this broker can send
+    CLIENT.publish("config",payload=lot_config.payload(verdict_format),qos=0,retain=False)
+
+def queueConfig(new_config):
+    # Called by the config watcher thread, or for a broker_control reload. The swap waits for the next verdict
+    global pending_config
+    pending_config = new_config
+    prCyan("Config reloaded, it takes effect at the next verdict")
+
+def reloadFromControl(payload):
+    try:
+        queueConfig(configFromControl(payload,lot_config))
+    except ConfigError as e:
+        prRed(f"Keeping the current config. {e}")
+
+def applyPendingConfig():
+    # Swap in a reloaded config between verdicts. Clients, their decisions and every history stay as they are
+    global pending_config, lot_config, client_config_data, empty_locations, occupied_locations, truth_values, vehicle_locations, empty_spot_index, occupied_spot_index
+    new_config = pending_config
+    if new_config == None:
+        return False
+    pending_config = None
+    if new_config.max_decision_history != lot_config.max_decision_history:
+        prYellow("max_decision_history changed. The run ends at the new count, histories keep their old length")
+    lot_config = new_config
+    client_config_data = new_config.data
+    empty_locations = new_config.empty_locations
+    occupied_locations = new_config.occupied_locations
+    truth_values = new_config.truth_values
+    vehicle_locations = new_config.vehicle_locations
+    empty_spot_index = new_config.empty_spot_index
+    occupied_spot_index = new_config.occupied_spot_index
+    issueConfig()
+    return True
 
 def initializeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                raise Exception("Client already exists")
-        new_client = Client(client_name)
-        activeClients.append(new_client)
-        activeClients.sort(key=lambda x: x.name)
+        if client_name in activeClients:
+            raise Exception("Client already exists")
+        new_client = activeClients.add(Client(client_name))
+        clock_sync.expect(client_name)
+        updateWireFormat()
         issueConfig()
+        verdict_publisher.requestKeyframe() # So the new client doesn't have to wait for the next scheduled one
         prCyan("Added client: "+client_name)
         return new_client
     except:
@@ -156,102 +254,95 @@ def initializeClient(client_name):
 
 def removeClient(client_name):
     try:
-        for client in activeClients:
-            if client.name == client_name:
-                activeClients.remove(client)
-                prCyan("Removed client: "+client_name)
-                return
-        raise Exception("Client not found")
-    except:
+        activeClients.remove(client_name)
+        wire_formats.forget(client_name)
+        clock_sync.forget(client_name)
+        sample_ages.remove(client_name)
+        if updateWireFormat():
+            issueConfig()
+        prCyan("Removed client: "+client_name)
+    except KeyError:
         prRed("Failed to remove client. Client not found: "+client_name)
 
-def getClosestObject(object_list,pos):
-    closest_id = 0
-    closest_distance = -1
-    for i,obj in enumerate(object_list):
-        distance = np.sqrt((obj['x']-pos['x'])**2 + (obj['y']-pos['y'])**2)
-        if distance < closest_distance or closest_distance == -1:
-            closest_distance = distance
-            closest_id = i
-    return closest_id
-
 def getDistance(x1,y1,x2,y2):
     return np.sqrt((x1-x2)**2 + (y1-y2)**2)
 
-def getVerdict():
+def quitIfExhausted():
     global verdict_id
-    global last_verdict_time
-
-    # Exit out of the loop after all the necessary data has been compiled!
     if verdict_id >= client_config_data["max_decision_history"] + 10 or verdict_id<0:
         if verdict_id > 0:
+            for topic,message,retain in verdict_publisher.clearSnapshot():
+                main_client.publish(topic,payload=message,qos=0,retain=retain)
             # Tell the clients that the data collection is done. Communication is key! :)
             publish(main_client,"finished",{"message":"I'm done!"})
+            if dashboard != None:
+                dashboard.stop()
+            if config_watcher != None:
+                config_watcher.stop()
+            if metrics_reporter != None:
+                metrics_reporter.stop()
+            clock_sync.stop()
+            if profile_control != None:
+                profile_control.stop()
             # Display the config data:
             print(f"\nConfig data: {getCyan(client_config_data)}")
-            wait(1)
-            exit(0)
+            if not hasattr(main_client,"requestShutdown"):
+                # A bare paho client gets a second to send what is queued. broker_core.py drains its queue instead,
+                # and sends "finished" last
+                wait(1)
+                exit(0)
+            main_client.requestShutdown()
         verdict_id = -1
-        return
+        return True
+    else:
+        return False
+
+def getVerdict():
+    global verdict_id
+    global last_verdict_time
+
+    applyPendingConfig()
+
+    # Exit out of the loop after all the necessary data has been compiled!
+    if quitIfExhausted(): return
 
     NOW = time.time()
-    if (NOW - last_verdict_time) < settings["verdict_min_refresh_time"]:
-        print(f"Returning. Now: {NOW}, Last: {last_verdict_time}")
+    if verdict_scheduler == None and (NOW - last_verdict_time) < settings["verdict_min_refresh_time"]:
         return
     
     # Refresh the last verdict time
     last_verdict_time = NOW
     verdict_id += 1 # Increment the verdict ID
-
-    # Initialize a list of blank Default Dictionaries to count occurrences of each decision
-    global dd
-    object_counts = dd(int) # Voting registry
-    license_plates = ["EMPTY"] * len(empty_locations)
-
+    verdict_start = perf_counter_ns()
+    broker_metrics.recordAges(NOW)
+    oldest,newest = sample_ages.window(NOW - settings["oldest_allowable_data"])
+    sample_age = None
+    if oldest != None:
+        sample_age = {"oldest":NOW - oldest,"newest":NOW - newest}
+        broker_metrics.recordAge("verdict_oldest",sample_age["oldest"])
+        broker_metrics.recordAge("verdict_newest",sample_age["newest"])
+
+    start = perf_counter_ns()
     position_tally = {}
 
-    # Clear the output log
-    print("\033[H\033[J", end="")
-
-    # Display separator for verdict presentation
-    if settings["show_verbose_output"]:
-        print("-"*40)
-        print(f"Getting verdict #{getYellow(verdict_id)} (t=...{getCyan(np.round(NOW%10000,3))}s)")
-        print("-"*40)
-
     for client in activeClients:
         decision = client.getDecision()
         # Throw out expired decisions
         if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
-            print(f"Skipping client: {client.getName()}")
             continue
         # Get the dictionary of detected objects
         detected_objects = decision["object_list"]
 
-        # Go through each detected object and tally up the position
+        # Go through each detected plate and tally up the position. EMPTY detections don't place a plate anywhere
         for qr in detected_objects:
             if qr['text'] == "EMPTY":
-                closest_spot = getClosestObject(empty_locations,qr['position'])
-                object_counts[closest_spot] -= 1
-            else:
-                if qr['text'] not in position_tally.keys():
-                    position_tally[qr['text']] = {'x':0,'y':0,'count':0}
-
-                position_tally[qr['text']]['x'] += qr['position']['x']
-                position_tally[qr['text']]['y'] += qr['position']['y']
-                position_tally[qr['text']]['count'] += 1
-        
-        # Verbose output
-        if settings["show_verbose_output"]:
-            print(f"@{getPurple(client.getName())} (rep={getYellow(np.round(client.getReputation(),3))}) ({client.getAccuracyReport()}):")
-            if len(detected_objects) > 0:
-                for qr in detected_objects:
-                    print(f"--> {getGreen(qr['text'])} (x={getCyan(np.round(qr['position']['x'],2))},y={getCyan(np.round(qr['position']['y'],2))},|d|={getCyan(np.round(qr['distance'],2))})")
-            else:
-                print(f"--> {getRed('No QR codes detected')}")
-        # example: @euclid (rep=0.500): ABCD123 (x=4.56,y=-6.40, |d|=8.41), IJKL456, XY12ZA3
+                continue
+            if qr['text'] not in position_tally.keys():
+                position_tally[qr['text']] = {'x':0,'y':0,'count':0}
 
-    print() # Get that nice, sweet newline!
+            position_tally[qr['text']]['x'] += qr['position']['x']
+            position_tally[qr['text']]['y'] += qr['position']['y']
+            position_tally[qr['text']]['count'] += 1
 
     # IDEA: Use a queue to keep track of decisions, such that no parking spot can have multiple labels in it at once
     
@@ -264,49 +355,19 @@ def getVerdict():
         mean_y = val['y'] / val['count']
         stack.append([plate,mean_x,mean_y])
 
-    while len(stack) > 0:
-        this_plate = stack.pop()
-        plate,mean_x,mean_y = this_plate
-        closest_spot = None
-        closest_dist = None
-        for i,spot in enumerate(taken_spots):
-            # Distance from the mean position of the license plate to the center of the parking spot
-            dist = getDistance(spot['position']['x'],spot['position']['y'],mean_x,mean_y)
-            # Only consider spots that would actually make an improvement
-            if closest_dist == None or dist < closest_dist:
-                if spot['plate'] == None: # If the spot is empty, just take it
-                        closest_dist = dist
-                        closest_spot = i
-                else: # If the spot is taken, only take it if the current plate is closer than the one already there
-                    if dist < getDistance(spot['position']['x'],spot['position']['y'],spot['plate'][1],spot['plate'][2]):
-                        closest_dist = dist
-                        closest_spot = i
-
-        closest = taken_spots[closest_spot]
-
-        # If replacing an old item, put it back into the stack
-        if closest['plate'] != None:
-            stack.append(closest['plate'])
-
-        closest['plate'] = this_plate
+    broker_metrics.record("tally",start)
+
+    # Optimize the license plate positions into unique 2D spots. Updates the value of taken_spots
+    start = perf_counter_ns()
+    if settings["plate_assignment"] == "optimal":
+        for spot,plate in zip(taken_spots,assignPlates(stack,occupied_spot_index.coords,settings["max_plate_distance"])):
+            spot['plate'] = plate
+    else:
+        parseStack(stack,taken_spots)
+    broker_metrics.record("assign",start)
 
-    if settings["show_verbose_output"]:
-        for i,spot in enumerate(taken_spots):
-            if spot['plate'] != None:
-                plate,mean_x,mean_y = spot['plate']
-                print(f"{getYellow(i)}) Consensus: {getGreen(plate)} ({getCyan(np.round(mean_x,2))},{getCyan(np.round(mean_y,2))})")
-            else:
-                print(f"{getYellow(i)}) Consensus: {getRed('EMPTY')}")
-    
     # Determine the most confident decisions for each object
     verdicts = {}
-    '''for i in range(len(empty_locations)):
-        count = object_counts[i]
-        if count>0:
-            verdicts[str(i)] = license_plates[i]
-        else:
-            verdicts[str(i)] = "EMPTY"
-    '''
     # Summarize the final verdicts in a simpler format
     for i,spot in enumerate(taken_spots):
         if spot['plate'] != None:
@@ -316,45 +377,122 @@ def getVerdict():
             verdicts[str(i)] = "EMPTY"
     
     # Publish the verdict
-    publish(main_client,"verdict",{"message":verdicts})
+    start = perf_counter_ns()
+    publishVerdict(verdicts,sample_age)
+    broker_metrics.record("publish",start)
 
     # Log the decision
+    start = perf_counter_ns()
     log_decision(verdicts)
+    broker_metrics.record("log_decision",start)
 
-    print()
-    print_decision_report()
-    '''if len(activeClients) > 1:
-        # Print the decision report
-        print_decision_report()
-    else:
-        prPurple("Only one client, no reputation changes to be made.")'''
-
+    start = perf_counter_ns()
     for client in activeClients:
         client.noteOutcome(verdicts)
+    broker_metrics.record("outcomes",start)
+
+    if dashboard != None:
+        # Hand the renderer a copy of what it shows. All of the formatting happens in renderDashboard
+        start = perf_counter_ns()
+        dashboard.update(dashboardSnapshot(NOW,taken_spots))
+        broker_metrics.record("dashboard",start)
+    broker_metrics.record("verdict",verdict_start)
+
+def dashboardSnapshot(NOW,taken_spots):
+    # Plain copies of everything renderDashboard shows, taken under state_lock. The renderer runs on its own thread
+    # while the next verdicts update the clients and histories, so it must not hold on to any of them
+    with state_lock:
+        clients = []
+        for client in activeClients:
+            decision = client.getDecision()
+            if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
+                clients.append((client.getName(),None))
+            elif not settings["show_verbose_output"]:
+                clients.append((client.getName(),{}))
+            else:
+                clients.append((client.getName(),{
+                    "reputation":client.getReputation(),
+                    "accuracy":client.getAccuracy(),
+                    "objects":[(qr["text"],qr["position"]["x"],qr["position"]["y"],qr["distance"]) for qr in decision["object_list"]],
+                }))
+        return {
+            "verdict_id":verdict_id,
+            "time":NOW,
+            "clients":clients,
+            "spots":[spot['plate'] for spot in taken_spots], # (plate, mean x, mean y) tuples or None
+            "decision_history":(len(decision_history),decision_history.mean(),decision_history.std()),
+            "reports":[part.getReport() for part in (verdict_scheduler,clock_sync if settings["clock_sync_interval"] > 0 else None) if part != None],
+        }
+
+def renderDashboard(snapshot):
+    # One screen of console output for a verdict snapshot (see dashboard.py)
+    lines = []
+    NOW = snapshot["time"]
+    if settings["show_verbose_output"]:
+        # Display separator for verdict presentation
+        lines.append("-"*40)
+        lines.append(f"Getting verdict #{getYellow(snapshot['verdict_id'])} (t=...{getCyan(np.round(NOW%10000,3))}s)")
+        lines.append("-"*40)
+    for name,client in snapshot["clients"]:
+        if client == None:
+            lines.append(f"Skipping client: {name}")
+            continue
+        if not settings["show_verbose_output"]:
+            continue
+        detected_objects = client["objects"]
+        lines.append(f"@{getPurple(name)} (rep={getYellow(np.round(client['reputation'],3))}) ({accuracyReport(*client['accuracy'])}):")
+        if len(detected_objects) > 0:
+            for text,x,y,distance in detected_objects:
+                lines.append(f"--> {getGreen(text)} (x={getCyan(np.round(x,2))},y={getCyan(np.round(y,2))},|d|={getCyan(np.round(distance,2))})")
+        else:
+            lines.append(f"--> {getRed('No QR codes detected')}")
+        # example: @euclid (rep=0.500): ABCD123 (x=4.56,y=-6.40, |d|=8.41), IJKL456, XY12ZA3
+    lines.append("")
+    if settings["show_verbose_output"]:
+        for i,plate in enumerate(snapshot["spots"]):
+            if plate != None:
+                plate,mean_x,mean_y = plate
+                lines.append(f"{getYellow(i)}) Consensus: {getGreen(plate)} ({getCyan(np.round(mean_x,2))},{getCyan(np.round(mean_y,2))})")
+            else:
+                lines.append(f"{getYellow(i)}) Consensus: {getRed('EMPTY')}")
+    lines.append("")
+    lines.extend(getDecisionReport(snapshot))
+    return clear_screen + "\n".join(lines) + "\n"
 
 def didEveryoneDecide():
+    # True once every live client (one with unexpired data) has reported since the last verdict
+    NOW = time.time()
+    anyone_live = False
     for client in activeClients:
-        if client.getDecision() == None:
+        decision = client.getDecision()
+        if decision == None or decision["timestamp"] < NOW - settings["oldest_allowable_data"]:
+            continue
+        if decision.get("arrival_time",decision["timestamp"]) <= last_verdict_time:
             return False
-    return True
+        anyone_live = True
+    return anyone_live
 
 def getClientByName(client_name):
-    for client in activeClients:
-        if client.getName() == client_name:
-            return client
-    return None
+    return activeClients.get(client_name)
 
 def interpretData(payload):
+    start = perf_counter_ns()
     client = getClientByName(payload["source"])
-    payload["timestamp"] = time.time()
+    broker_metrics.record("lookup",start)
+    clock_sync.stamp(payload,time.time(),settings["staleness_clock"])
     if client == None:
         prCyan("Attempting to create new client, "+payload["source"])
         client = initializeClient(payload["source"])
         if client == None:
             prRed("Failed to create new client")
             return
+    start = perf_counter_ns()
     client.setDecision(payload)
-    if time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
+    broker_metrics.record("store",start)
+    if scheduler_thread != None:
+        # Verdicts run on a fixed schedule. Just let the scheduler know, in case everyone has reported now
+        scheduler_thread.notify()
+    elif time.time() - last_verdict_time > settings["verdict_min_refresh_time"]:
         getVerdict()
 
 # The callback function, it will be triggered when receiving messages
@@ -362,33 +500,67 @@ def on_message(CLIENT, userdata, msg):
     global broker_start_time
     if broker_start_time == 0:
         broker_start_time = time.time()
-    # Turn from byte array to string text
-    payload = msg.payload.decode("utf-8")
-    # Turn from string text to data structure
-    payload = decodePayload(payload)
+    broker_metrics.count(msg.topic)
+    # Turn from bytes (JSON, MessagePack or packed) to data structure
+    start = perf_counter_ns()
+    payload = decodePayload(msg.payload)
+    broker_metrics.record("decode",start)
     # Decide what to do, based on the message's topic
-    if msg.topic == "new_client":
-        # Add a new client!
-        initializeClient(payload["source"])
-    elif msg.topic == "end_client":
-        # Remove an existing client. Sad!
-        removeClient(payload["source"])
-    elif msg.topic == "data_V2B":
-        # Interpret the data
-        interpretData(payload)
-    elif msg.topic == "request_config":
-        issueConfig()
-
-CLIENT = mqtt.Client()
-CLIENT.on_connect = on_connect
-CLIENT.on_message = on_message
-main_client = CLIENT
-
-# Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
-CLIENT.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
-
-# Create connection, the three parameters are broker address, broker port number, and keep-alive time respectively
-CLIENT.connect(broker_IP, port_Num, keepalive=60)
-
-# Set the network loop blocking, it will not actively end the program before calling disconnect() or the program crash
-CLIENT.loop_forever()
\ No newline at end of file
+    with state_lock:
+        if msg.topic == "new_client":
+            # Add a new client!
+            wire_formats.accept(payload["source"],payload.get("formats"))
+            initializeClient(payload["source"])
+        elif msg.topic == "end_client":
+            # Remove an existing client. Sad!
+            removeClient(payload["source"])
+        elif msg.topic == "data_V2B":
+            # Interpret the data
+            interpretData(payload)
+        elif msg.topic == "request_config":
+            # Clients may list the wire formats they can decode, e.g. {"source":"car1","formats":["packed","json"]}
+            wire_formats.accept(payload.get("source"),payload.get("formats"))
+            updateWireFormat()
+            issueConfig()
+        elif msg.topic == control_topic:
+            if payload.get("command") == "reload_config":
+                reloadFromControl(payload)
+            elif payload.get("command") in profile_commands and profile_control != None:
+                profile_control.handle(payload)
+        elif msg.topic == pong_topic:
+            round_trip = clock_sync.onPong(payload,receiveTime(msg,time.time()))
+            if round_trip != None:
+                broker_metrics.recordAge("clock_round_trip",round_trip)
+
+def startBroker(client):
+    # Wires the broker up to an MQTT client (a real paho client, or an in-process stand-in for replays) and starts
+    # any background fusion threads. Connecting and running the network loop is up to the caller
+    global CLIENT, main_client, wire_formats, verdict_publisher, dashboard, verdict_scheduler, scheduler_thread, config_watcher, metrics_reporter, profile_control
+    CLIENT = client
+    main_client = client
+    wire_formats = FormatNegotiator(settings["wire_format"])
+    verdict_publisher = VerdictPublisher(settings["verdict_publish_mode"],settings["verdict_keyframe_interval"])
+    dashboard = dashboardFromSettings(settings,renderDashboard)
+    config_watcher = watcherFromSettings(settings,lot_config,queueConfig,prRed)
+    broker_metrics.name = "parking"
+    metrics_reporter = reporterFromSettings(settings,lambda snapshot: publish(main_client,metrics_topic,snapshot),prRed)
+    clock_sync.start(lambda message: publish(main_client,ping_topic,message),lambda: time.time(),settings["clock_sync_interval"],prRed)
+    profile_control = ProfileControl(f"parking_{test_id}",lambda summary: publish(main_client,profile_topic,summary),settings,prCyan)
+    client.on_connect = on_connect
+    client.on_message = on_message
+
+    # Set the will message, when the Raspberry Pi is powered off, or the network is interrupted abnormally, it will send the will message to other clients
+    client.will_set('finished', encodePayload({"message":"I'm offline"}), qos=0, retain=False)
+
+    # Start the fixed-rate verdict scheduler, if verdicts should not be triggered by incoming messages
+    verdict_scheduler = schedulerFromSettings(settings,didEveryoneDecide)
+    if verdict_scheduler != None:
+        scheduler_thread = schedulerThreadFor(client,verdict_scheduler,getVerdict,state_lock)
+        scheduler_thread.start()
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    test_id = args.id
+
+    # broker_core.py runs the MQTT connection, publishing, output flushing and shutdown around this module's fusion
+    runBroker(sys.modules[__name__],PahoTransport(broker_IP,port_Num))
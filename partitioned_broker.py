@@ -0,0 +1,317 @@
+# partitioned_broker.py
+# Consolidated fusion spread over several processes (or machines), for fleets one broker thread can't keep up with.
+#
+#   python partitioned_broker.py merger -id 3          (exactly one: hands out the config, publishes verdicts)
+#   python partitioned_broker.py replica --name r1     (as many as needed, started and stopped at any time)
+#
+# Vehicles don't change: they still publish to data_V2B and listen for config/verdict/finished.
+# Every replica sees every data_V2B frame, but only decodes the frames of the vehicles it owns on a consistent hash
+# ring of the live replicas (hash_ring.py); the others are dropped after peeking at "source". MQTT shared
+# subscriptions would split the traffic at the broker instead, but they hand a vehicle's frames to any replica, and
+# fusion needs each vehicle's newest decision in exactly one place.
+# Replicas reduce their vehicles' decisions to a partial tally (summed plate positions and label scores, see
+# fusion_context.partialTally) and publish it on partition/tally. The merger adds up the newest tally of every live
+# replica and fuses the sum, which gives the same verdict as one broker holding every decision.
+# Replicas announce themselves on partition/hello. When one joins or leaves, only the vehicles whose ring position
+# changed owner move, and the old owner hands their newest decision and history over on partition/handoff.
+import argparse
+import json
+import threading
+import time
+from colors import *
+from server_config import config as settings
+from codec import encode, encodeJson, decode
+from client_registry import ClientRegistry
+from hash_ring import HashRing
+from vehicle_mailbox import peekSource
+from fusion_context import LotGeometry, LotClient, partialTally, mergeTallies, fuseTally, verdictAccuracy, liveDecisions, isExhausted
+from ring_buffer import RingBuffer
+from clock_sync import ClockSync
+
+def publish(client,topic,message):
+    client.publish(topic,payload=encodeJson(message),qos=0,retain=False)
+
+class Replica:
+    topics = ["data_V2B","end_client","verdict","finished","partition/hello","partition/bye","partition/handoff"]
+
+    def __init__(self,name,config):
+        self.name = name
+        self.config = config
+        self.geometry = LotGeometry(config)
+        self.history_length = config["max_decision_history"]
+        self.clients = ClientRegistry()
+        self.ring = HashRing([name],settings["partition_virtual_nodes"])
+        self.peers = {} # replica name -> time of its last hello
+        self.lock = threading.RLock()
+        self.dirty = False # A decision changed since the last tally
+        self.tally_seq = 0
+        self.dropped = 0 # Frames that belonged to another replica
+        self.joined = float("inf") # Frames are ignored until a heartbeat after connecting, while we learn who our peers are
+        self.clock_sync = ClockSync(assume_synced=True) # No clock_ping here, vehicle timestamps are taken as synced
+        self.stopped = threading.Event()
+        self.client = None
+        self.thread = None
+
+    def addClient(self,client_name):
+        if client_name in self.clients:
+            return self.clients.get(client_name)
+        return self.clients.add(LotClient(client_name,self.history_length))
+
+    def start(self,client):
+        self.client = client
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        self.thread = threading.Thread(target=self.run,name=f"replica_{self.name}",daemon=True)
+        self.thread.start()
+
+    def on_connect(self,client,userdata,flags,rc):
+        prCyan(f"Replica {self.name} connected with result code {rc}")
+        for topic in self.topics:
+            client.subscribe(topic)
+        publish(client,"partition/hello",{"source":self.name})
+        self.joined = time.time() + settings["partition_heartbeat"]
+
+    def on_message(self,client,userdata,msg):
+        topic = msg.topic
+        if topic == "data_V2B":
+            source = peekSource(msg.payload)
+            with self.lock:
+                if self.ring.owner(source) != self.name or time.time() < self.joined:
+                    self.dropped += 1
+                    return
+                payload = decode(msg.payload)
+                self.clock_sync.stamp(payload,time.time(),settings["staleness_clock"])
+                self.addClient(source).setDecision(payload)
+                self.dirty = True
+            return
+        payload = decode(msg.payload)
+        with self.lock:
+            if topic == "end_client":
+                if payload["source"] in self.clients:
+                    self.clients.remove(payload["source"])
+                    self.dirty = True
+            elif topic == "verdict":
+                # Score our own vehicles against the merged verdict
+                for lot_client in self.clients:
+                    lot_client.noteOutcome(payload["message"],self.geometry)
+            elif topic == "partition/hello":
+                if payload["source"] != self.name:
+                    known = payload["source"] in self.peers
+                    self.peers[payload["source"]] = time.time()
+                    if not known:
+                        # Answer right away, so a new replica doesn't have to wait a heartbeat to learn about us
+                        publish(self.client,"partition/hello",{"source":self.name})
+                        self.updateRing()
+            elif topic == "partition/bye":
+                if self.peers.pop(payload["source"],None) != None:
+                    self.updateRing()
+            elif topic == "partition/handoff":
+                if payload["to"] == self.name:
+                    self.adoptClients(payload["clients"])
+            elif topic == "finished":
+                publish(self.client,"partition/report",{"source":self.name,"client_reports":self.getClientReports()})
+                self.stopped.set()
+
+    def updateRing(self,leaving=False):
+        # Rebuild the ring from the live replicas, then hand off every vehicle that now belongs to someone else
+        ring = HashRing(list(self.peers.keys()) + ([] if leaving else [self.name]),settings["partition_virtual_nodes"])
+        handoffs = {}
+        for lot_client in list(self.clients):
+            new_owner = ring.owner(lot_client.getName())
+            if new_owner != self.name and new_owner != None:
+                handoffs.setdefault(new_owner,{})[lot_client.getName()] = {
+                    "decision":lot_client.getDecision(),
+                    "plates":lot_client.plate_history.tolist(),
+                    "objects":lot_client.object_history.tolist(),
+                }
+                self.clients.remove(lot_client.getName())
+        self.ring = ring
+        for new_owner,moved in handoffs.items():
+            publish(self.client,"partition/handoff",{"source":self.name,"to":new_owner,"clients":moved})
+        if len(handoffs) > 0:
+            self.dirty = True
+            prYellow(f"Replica {self.name}: ring is now {sorted(ring.nodes)}, handed off {sum(len(moved) for moved in handoffs.values())} vehicles")
+
+    def adoptClients(self,moved):
+        for client_name,state in moved.items():
+            lot_client = self.addClient(client_name)
+            current = lot_client.getDecision()
+            # Keep our own frame if the vehicle already sent us a newer one
+            if state["decision"] != None and (current == None or current["timestamp"] < state["decision"]["timestamp"]):
+                lot_client.setDecision(state["decision"])
+            if len(lot_client.plate_history) == 0:
+                for plates,objects in zip(state["plates"],state["objects"]):
+                    lot_client.plate_history.append(plates)
+                    lot_client.object_history.append(objects)
+        self.dirty = True
+
+    def publishTally(self):
+        now = time.time()
+        with self.lock:
+            tally = partialTally(liveDecisions(self.clients,now))
+            self.tally_seq += 1
+            self.dirty = False
+            clients = len(self.clients)
+        publish(self.client,"partition/tally",{"source":self.name,"seq":self.tally_seq,"time":now,"clients":clients,"tally":tally})
+
+    def expirePeers(self):
+        now = time.time()
+        with self.lock:
+            expired = [name for name,seen in self.peers.items() if now - seen > settings["partition_timeout"]]
+            for name in expired:
+                del self.peers[name]
+                prRed(f"Replica {self.name}: lost replica {name}")
+            if len(expired) > 0:
+                self.updateRing()
+
+    def run(self):
+        # Heartbeats every partition_heartbeat seconds. Tallies whenever something changed (at most once per
+        # verdict_min_refresh_time), and with every heartbeat anyway so the merger knows we're alive
+        next_heartbeat = 0.0
+        while not self.stopped.wait(settings["verdict_min_refresh_time"]):
+            now = time.time()
+            heartbeat = now >= next_heartbeat
+            if heartbeat:
+                next_heartbeat = now + settings["partition_heartbeat"]
+                publish(self.client,"partition/hello",{"source":self.name})
+                self.expirePeers()
+            if self.dirty or heartbeat:
+                self.publishTally()
+
+    def leave(self):
+        # Graceful shutdown: give every vehicle to its next owner, then say goodbye
+        self.stopped.set()
+        with self.lock:
+            if len(self.peers) > 0:
+                self.updateRing(leaving=True)
+        publish(self.client,"partition/bye",{"source":self.name})
+
+    def getClientReports(self):
+        return {lot_client.getName():{"plates":lot_client.plate_history.tolist(),"objects":lot_client.object_history.tolist()} for lot_client in self.clients}
+
+class Merger:
+    topics = ["new_client","request_config","partition/tally","partition/bye","partition/report"]
+
+    def __init__(self,config,test_id=0):
+        self.config = config
+        self.config_payload = encodeJson(config)
+        self.geometry = LotGeometry(config)
+        self.history_length = config["max_decision_history"]
+        self.test_id = test_id
+        self.tallies = {} # replica name -> (receive time, newest tally)
+        self.reports = {} # replica name -> client reports, sent after "finished"
+        self.plate_history = RingBuffer(self.history_length)
+        self.object_history = RingBuffer(self.history_length)
+        self.verdict_id = 0
+        self.new_tallies = False
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.reports_done = threading.Event()
+        self.client = None
+        self.thread = None
+
+    def start(self,client):
+        self.client = client
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        self.thread = threading.Thread(target=self.run,name="merger",daemon=True)
+        self.thread.start()
+
+    def on_connect(self,client,userdata,flags,rc):
+        prCyan(f"Merger connected with result code {rc}")
+        for topic in self.topics:
+            client.subscribe(topic)
+
+    def on_message(self,client,userdata,msg):
+        topic = msg.topic
+        if topic == "new_client" or topic == "request_config":
+            client.publish("config",payload=self.config_payload,qos=0,retain=False)
+            return
+        payload = decode(msg.payload)
+        with self.lock:
+            if topic == "partition/tally":
+                self.tallies[payload["source"]] = (time.time(),payload["tally"])
+                self.new_tallies = True
+            elif topic == "partition/bye":
+                self.tallies.pop(payload["source"],None)
+            elif topic == "partition/report":
+                self.reports[payload["source"]] = payload["client_reports"]
+                if set(self.tallies.keys()) <= set(self.reports.keys()):
+                    self.reports_done.set()
+
+    def getVerdict(self):
+        now = time.time()
+        with self.lock:
+            # Forget replicas that went quiet. Their vehicles will show up in someone else's tally
+            for name in [name for name,(seen,_) in self.tallies.items() if now - seen > settings["partition_timeout"]]:
+                del self.tallies[name]
+            if not self.new_tallies or len(self.tallies) == 0:
+                return
+            self.new_tallies = False
+            merged = mergeTallies([tally for _,tally in self.tallies.values()])
+        self.verdict_id += 1
+        verdicts,_ = fuseTally(merged,self.geometry)
+        self.client.publish("verdict",payload=encode(dict({"message":verdicts,"seq":self.verdict_id},source="main_broker")),qos=0,retain=False)
+        plates,objects = verdictAccuracy(verdicts,self.geometry)
+        self.plate_history.append(plates)
+        self.object_history.append(objects)
+
+    def run(self):
+        while not self.stopped.wait(settings["verdict_min_refresh_time"]):
+            if isExhausted(self.verdict_id,self.history_length):
+                self.finish()
+                return
+            self.getVerdict()
+
+    def finish(self):
+        # Same stopping rule as consolidated_broker.py. Collect the replicas' client reports, then write the usual output
+        publish(self.client,"finished",{"message":"I'm done!","source":"main_broker"})
+        self.reports_done.wait(settings["partition_timeout"])
+        client_reports = {}
+        with self.lock:
+            for reports in self.reports.values():
+                client_reports.update(reports)
+        with open(f"outputs/output_{self.test_id}.json","w") as output_file:
+            output_file.write(json.dumps({
+                "plate_history":self.plate_history.tolist(),
+                "object_history":self.object_history.tolist(),
+                "config":self.config,
+                "client_reports":client_reports,
+            }))
+        prGreen(f"Finished after {self.verdict_id} verdicts from {len(self.reports)} replicas")
+        self.stopped.set()
+
+def main():
+    parser = argparse.ArgumentParser(description="Partitioned consolidated broker")
+    parser.add_argument("role",choices=["merger","replica"])
+    parser.add_argument("--name",default=None,help="Replica name, unique among the replicas")
+    parser.add_argument("-id",type=int,help="Test ID number",default=0)
+    args = parser.parse_args()
+
+    import paho.mqtt.client as mqtt
+    with open("consolidated_config.json","r") as config_file:
+        config = json.load(config_file)
+    client = mqtt.Client()
+    if args.role == "merger":
+        node = Merger(config,args.id)
+    else:
+        if args.name == None:
+            parser.error("replicas need a --name")
+        node = Replica(args.name,config)
+        # If we die without saying goodbye, the broker says it for us
+        client.will_set("partition/bye",payload=encodeJson({"source":args.name}),qos=0,retain=False)
+    node.start(client)
+    client.connect(settings["broker_IP"],settings["port_Num"],keepalive=60)
+    client.loop_start()
+    try:
+        while not node.stopped.wait(0.5):
+            pass
+    except KeyboardInterrupt:
+        if args.role == "replica":
+            node.leave()
+            time.sleep(0.5) # Let the handoff go out
+    client.loop_stop()
+    client.disconnect()
+
+if __name__ == "__main__":
+    main()
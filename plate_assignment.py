@@ -0,0 +1,134 @@
+# plate_assignment.py
+import numpy as np
+
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None # Optional, the built-in solver below is used instead
+
+def distanceMatrix(points,spots):
+    # (P,2) x (S,2) -> (P,S) euclidean distances
+    dx = points[:,0,None] - spots[None,:,0]
+    dy = points[:,1,None] - spots[None,:,1]
+    return np.sqrt(dx*dx + dy*dy)
+
+def solveAssignment(cost):
+    # Minimum-cost assignment of every row to a distinct column (rows <= columns).
+    # Shortest augmenting path version of the Hungarian algorithm, with the inner loop over columns vectorized.
+    # Returns an array holding the chosen column for each row.
+    if linear_sum_assignment != None:
+        rows,cols = linear_sum_assignment(cost)
+        result = np.empty(cost.shape[0],dtype=np.intp)
+        result[rows] = cols
+        return result
+    n,m = cost.shape
+    u = np.zeros(n+1) # Row potentials (1-based, index 0 unused)
+    v = np.zeros(m+1) # Column potentials (index 0 is the virtual start column)
+    owner = np.zeros(m+1,dtype=np.intp) # owner[j] = row (1-based) holding column j, 0 if free
+    way = np.zeros(m+1,dtype=np.intp)
+    # Warm start: with u = row minimums every row's closest column is a zero-cost edge, so give each column
+    # to the first row that wants it. Only rows that lost such a collision need an augmenting path below.
+    nearest = np.argmin(cost,axis=1)
+    u[1:] = cost[np.arange(n),nearest]
+    unassigned = []
+    for i in range(1,n+1):
+        if owner[nearest[i-1]+1] == 0:
+            owner[nearest[i-1]+1] = i
+        else:
+            unassigned.append(i)
+    for i in unassigned:
+        owner[0] = i
+        j0 = 0
+        min_slack = np.full(m+1,np.inf)
+        used = np.zeros(m+1,dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = owner[j0]
+            free = ~used[1:]
+            slack = cost[i0-1] - u[i0] - v[1:]
+            better = free & (slack < min_slack[1:])
+            min_slack[1:][better] = slack[better]
+            way[1:][better] = j0
+            candidates = np.where(free,min_slack[1:],np.inf)
+            j1 = int(np.argmin(candidates)) + 1
+            delta = candidates[j1-1]
+            used_cols = np.flatnonzero(used)
+            u[owner[used_cols]] += delta
+            v[used_cols] -= delta
+            min_slack[1:][free] -= delta
+            j0 = j1
+            if owner[j0] == 0:
+                break
+        # Flip the augmenting path
+        while j0 != 0:
+            j1 = way[j0]
+            owner[j0] = owner[j1]
+            j0 = j1
+    result = np.empty(n,dtype=np.intp)
+    assigned = np.flatnonzero(owner[1:]) + 1
+    result[owner[assigned]-1] = assigned - 1
+    return result
+
+def assignPlates(plates,spot_coords,max_distance=None):
+    # plates: list of [plate, mean_x, mean_y] (one per distinct plate text)
+    # spot_coords: (S,2) array of occupied-spot centers
+    # Returns a list with one entry per spot: the plate assigned to it, or None.
+    # Minimizes the total plate-to-spot distance. Plates farther than max_distance from their spot stay unassigned.
+    spot_for_plate = [None] * len(spot_coords)
+    if len(plates) == 0 or len(spot_coords) == 0:
+        return spot_for_plate
+    points = np.array([(plate[1],plate[2]) for plate in plates],dtype=np.float64)
+    dist = distanceMatrix(points,spot_coords)
+    cost = dist
+    if max_distance != None:
+        # Out-of-range pairs get a cost no in-range solution can beat, so they are only used when there is no other choice
+        cost = np.where(dist > max_distance,dist + len(plates)*max_distance + 1.0,dist)
+
+    nearest = np.argmin(cost,axis=1)
+    if len(plates) <= len(spot_coords) and len(np.unique(nearest)) == len(plates):
+        # Common case: every plate's closest spot is different. That is already the optimal assignment
+        plate_rows = np.arange(len(plates))
+        spot_cols = nearest
+    elif len(plates) <= len(spot_coords):
+        plate_rows = np.arange(len(plates))
+        spot_cols = solveAssignment(cost)
+    else:
+        # More plates than spots: give every spot its best plate, and leave the rest out
+        spot_cols = np.arange(len(spot_coords))
+        plate_rows = solveAssignment(cost.T)
+
+    for row,col in zip(plate_rows,spot_cols):
+        if max_distance == None or dist[row,col] <= max_distance:
+            spot_for_plate[col] = plates[row]
+    return spot_for_plate
+
+def getDistance(x1,y1,x2,y2):
+    return np.sqrt((x1-x2)**2 + (y1-y2)**2)
+
+def parseStack(stack,taken_spots):
+    # The original greedy evict-and-retry assignment. Kept for comparison (settings["plate_assignment"] = "greedy")
+    while len(stack) > 0:
+        this_plate = stack.pop()
+        plate,mean_x,mean_y = this_plate
+        closest_spot = None
+        closest_dist = None
+        for i,spot in enumerate(taken_spots):
+            # Distance from the mean position of the license plate to the center of the parking spot
+            dist = getDistance(spot['position']['x'],spot['position']['y'],mean_x,mean_y)
+            # Only consider spots that would actually make an improvement
+            if closest_dist == None or dist < closest_dist:
+                if spot['plate'] == None: # If the spot is empty, just take it
+                        closest_dist = dist
+                        closest_spot = i
+                else: # If the spot is taken, only take it if the current plate is closer than the one already there
+                    if dist < getDistance(spot['position']['x'],spot['position']['y'],spot['plate'][1],spot['plate'][2]):
+                        closest_dist = dist
+                        closest_spot = i
+
+        closest = taken_spots[closest_spot]
+
+        # If replacing an old item, put it back into the stack
+        if closest['plate'] != None:
+            stack.append(closest['plate'])
+
+        closest['plate'] = this_plate
@@ -0,0 +1,165 @@
+# profiler.py
+# A sampling profiler that can be switched on inside a running broker, so a broker that slowed down can be looked at
+# without restarting it under cProfile (and losing its histories). It is driven from the control topic:
+#   broker_control  {"command":"start_profile"}                                  (profile_duration seconds)
+#   broker_control  {"command":"start_profile","duration":60,"interval":0.001}   (capped at profile_max_duration)
+#   broker_control  {"command":"stop_profile"}                                   (end the window early)
+#
+# A thread of its own wakes up every `interval` seconds and records where every other thread is
+# (sys._current_frames), so message handling never waits for it. When the window ends the stacks are written to
+# outputs/profiles/<broker>_<time>.collapsed, one "thread;outermost;...;innermost samples" line per stack (the format
+# flamegraph.pl and speedscope read), and a summary of the hottest functions is published on the `profile` topic.
+#
+# A thread can only be sampled when it lets go of the GIL, so time spent inside C code (NumPy, decoding) shows up
+# under the Python function that called it, and busy stretches are over-represented where the GIL changes hands.
+import os
+import sys
+import threading
+import time
+
+profile_topic = "profile"
+profile_commands = ("start_profile","stop_profile")
+profile_dir = "outputs/profiles"
+min_interval = 0.0005
+
+# Functions threads sit in while they wait for work. Samples that end in one of these are idle, and are left out of
+# the summary (not out of the .collapsed file)
+idle_functions = {
+    "threading.py":("wait","_wait_for_tstate_lock"),
+    "selectors.py":("select",),
+    "socketserver.py":("serve_forever",),
+    "client.py":("_loop","loop_forever"), # paho's network loop
+    "queue.py":("get",),
+}
+
+def frameName(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{getattr(code,'co_qualname',code.co_name)}"
+
+def isIdle(name):
+    file_name,_,function = name.partition(":")
+    return function.split(".")[-1] in idle_functions.get(file_name,())
+
+class SamplingProfiler:
+    def __init__(self,interval=0.005,duration=30.0,max_depth=128):
+        self.interval = interval
+        self.duration = duration
+        self.max_depth = max_depth
+        self.stacks = {} # (thread name, frame names outermost first) -> samples
+        self.samples = 0
+        self.start_time = 0.0
+        self.elapsed = 0.0
+        self.on_finish = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,name="sampling_profiler",daemon=True)
+
+    def sample(self):
+        names = {thread.ident:thread.name for thread in threading.enumerate()}
+        own = threading.get_ident()
+        for ident,frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = []
+            while frame != None and len(stack) < self.max_depth:
+                stack.append(frameName(frame))
+                frame = frame.f_back
+            key = (names.get(ident,str(ident)),tuple(reversed(stack)))
+            self.stacks[key] = self.stacks.get(key,0) + 1
+        self.samples += 1
+
+    def run(self):
+        self.start_time = time.time()
+        start = time.perf_counter()
+        while time.perf_counter() - start < self.duration and not self.stopped.wait(self.interval):
+            self.sample()
+        self.elapsed = time.perf_counter() - start
+        if self.on_finish != None:
+            self.on_finish(self)
+
+    def start(self,on_finish=None):
+        self.on_finish = on_finish
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def collapsed(self):
+        return [f"{';'.join((thread,) + stack)} {count}" for (thread,stack),count in sorted(self.stacks.items(),key=lambda item: -item[1])]
+
+    def summary(self,top=10):
+        # The functions busy samples were in (top_self) and passed through (top_total), as [name, samples, share of busy]
+        self_counts = {}
+        total_counts = {}
+        busy = 0
+        idle = 0
+        for (thread,stack),count in self.stacks.items():
+            if len(stack) == 0 or isIdle(stack[-1]):
+                idle += count
+                continue
+            busy += count
+            self_counts[stack[-1]] = self_counts.get(stack[-1],0) + count
+            for name in set(stack):
+                total_counts[name] = total_counts.get(name,0) + count
+        def ranked(counts):
+            return [[name,count,round(count / busy,4)] for name,count in sorted(counts.items(),key=lambda item: -item[1])[:top]]
+        return {
+            "start_time":self.start_time,
+            "duration":round(self.elapsed,3),
+            "interval":self.interval,
+            "samples":self.samples,
+            "busy_samples":busy,
+            "idle_samples":idle,
+            "threads":sorted({thread for thread,_ in self.stacks.keys()}),
+            "top_self":ranked(self_counts),
+            "top_total":ranked(total_counts),
+        }
+
+class ProfileControl:
+    # Runs the profile commands from the control topic. One profile at a time
+    def __init__(self,name,publish,settings,on_message=print):
+        self.name = name
+        self.publish = publish
+        self.settings = settings
+        self.on_message = on_message
+        self.profiler = None
+
+    def handle(self,payload):
+        command = payload.get("command")
+        if command == "start_profile":
+            if self.profiler != None and self.profiler.running():
+                self.on_message("A profile is already running")
+                return False
+            try:
+                duration = min(float(payload.get("duration",self.settings["profile_duration"])),self.settings["profile_max_duration"])
+                interval = max(float(payload.get("interval",self.settings["profile_interval"])),min_interval)
+            except (TypeError,ValueError):
+                self.on_message(f"Bad start_profile command: {payload}")
+                return False
+            self.profiler = SamplingProfiler(interval,duration).start(self.finish)
+            self.on_message(f"Profiling for up to {duration}s, one sample every {interval*1000:g}ms")
+            return True
+        if command == "stop_profile":
+            if self.profiler == None or not self.profiler.running():
+                self.on_message("No profile is running")
+                return False
+            self.profiler.stop()
+            return True
+        return False
+
+    def finish(self,profiler):
+        # Called on the profiler's thread when the window ends
+        os.makedirs(profile_dir,exist_ok=True)
+        path = os.path.join(profile_dir,f"{self.name}_{time.strftime('%Y%m%d-%H%M%S',time.localtime(profiler.start_time))}.collapsed")
+        with open(path,"w") as profile_file:
+            profile_file.write("\n".join(profiler.collapsed()) + "\n")
+        summary = dict(profiler.summary(),broker=self.name,file=path)
+        self.on_message(f"Profile written to {path}. Hottest: " + ", ".join(f"{name} ({share*100:.1f}%)" for name,_,share in summary["top_self"][:3]))
+        self.publish(summary)
+
+    def stop(self):
+        if self.profiler != None:
+            self.profiler.stop()
@@ -0,0 +1,222 @@
+# replay.py
+# Record live V2B traffic into a trace file, and replay traces into a broker's fusion logic without a network broker.
+#
+#   python replay.py record trace.jsonl                     (capture from the MQTT broker in server_config.py)
+#   python replay.py play trace.jsonl -b consolidated -s 10 (replay at 10x the recorded speed)
+#   python replay.py play trace.jsonl -b parking -s 0       (replay as fast as possible)
+#
+# Trace format (JSON Lines): a header line {"trace_version":1,"start_time":...,"topics":[...]}, then one line per message:
+# {"t": seconds since start_time, "topic": "...", "payload": "<payload text>"}, or "payload_b64" for binary (MessagePack) payloads
+import argparse
+import base64
+import contextlib
+import importlib
+import io
+import json
+import time
+from colors import *
+from server_config import config as settings
+
+trace_version = 1
+recorded_topics = ["new_client","end_client","data_V2B","request_config","clock_pong"]
+
+brokers = {
+    "consolidated":"consolidated_broker",
+    "parking":"parking_broker",
+    "objects":"object_data_collection",
+}
+
+class ReplayMessage:
+    # Just enough of paho's MQTTMessage for the brokers' on_message
+    def __init__(self,topic,payload):
+        self.topic = topic
+        self.payload = payload
+
+class InProcessClient:
+    # Stands in for paho's mqtt.Client. Publishes are counted (and optionally handed to `on_publish`) instead of sent
+    def __init__(self,on_publish=None):
+        self.on_connect = None
+        self.on_message = None
+        self.on_publish = on_publish
+        self.subscriptions = set()
+        self.published = {}
+        self.disconnected = False
+
+    def will_set(self,topic,payload=None,qos=0,retain=False):
+        pass
+
+    def subscribe(self,topic,qos=0):
+        self.subscriptions.add(topic)
+
+    def publish(self,topic,payload=None,qos=0,retain=False):
+        self.published[topic] = self.published.get(topic,0) + 1
+        if self.on_publish != None:
+            self.on_publish(topic,payload)
+
+    def disconnect(self):
+        self.disconnected = True
+
+    def deliver(self,topic,payload):
+        if isinstance(payload,str):
+            payload = payload.encode("utf-8")
+        self.on_message(self,None,ReplayMessage(topic,payload))
+
+class ReplayClock:
+    # Replaces a broker module's `time`, so the broker sees the trace's clock instead of the wall clock.
+    # That keeps verdict_min_refresh_time and oldest_allowable_data behaving as they did live, at any replay speed
+    def __init__(self,start_time):
+        self.now = start_time
+
+    def time(self):
+        return self.now
+
+    def __getattr__(self,name):
+        return getattr(time,name)
+
+def loadTrace(path):
+    with open(path,"r") as trace_file:
+        header = json.loads(trace_file.readline())
+        if header.get("trace_version") != trace_version:
+            raise ValueError(f"{path} is not a version {trace_version} trace")
+        records = [json.loads(line) for line in trace_file if line.strip()]
+    return header,records
+
+def loadBroker(name,test_id="replay",overrides=None):
+    # Imports a broker module without connecting it to anything. Settings overrides apply to the shared server_config dict
+    for key,value in (overrides or {}).items():
+        if key not in settings:
+            raise KeyError(f"Unknown setting: {key}")
+        settings[key] = value
+    module = importlib.import_module(brokers.get(name,name))
+    module.test_id = test_id
+    return module
+
+def replayTrace(module,header,records,speed=1.0,quiet=True,on_publish=None,linger=0.0):
+    # Feeds the trace into the broker. speed: 1 = recorded timing, N = N times faster, 0 = as fast as possible.
+    # Brokers with a fusion worker or verdict scheduler pace verdicts by the wall clock, so `linger` gives them
+    # that many extra seconds after the last message. Returns a dict of replay statistics
+    client = InProcessClient(on_publish)
+    clock = ReplayClock(header["start_time"])
+    module.time = clock
+    sink = io.StringIO() if quiet else None
+    delivered = 0
+    finished = False
+    wall_start = time.perf_counter()
+    with contextlib.redirect_stdout(sink) if quiet else contextlib.nullcontext():
+        module.startBroker(client)
+        try:
+            for record in records:
+                if speed > 0:
+                    delay = record["t"] / speed - (time.perf_counter() - wall_start)
+                    if delay > 0:
+                        time.sleep(delay)
+                clock.now = header["start_time"] + record["t"]
+                client.deliver(record["topic"],recordPayload(record))
+                delivered += 1
+                if sink != None:
+                    # Don't let the broker's console output pile up in memory
+                    sink.seek(0)
+                    sink.truncate()
+                if client.disconnected:
+                    finished = True
+                    break
+            linger_end = time.perf_counter() + linger
+            while not finished and not client.disconnected and time.perf_counter() < linger_end:
+                time.sleep(0.01)
+            finished = finished or client.disconnected
+        except SystemExit:
+            # The broker finished its experiment
+            finished = True
+    elapsed = time.perf_counter() - wall_start
+    return {
+        "messages":delivered,
+        "published":dict(client.published),
+        "verdicts":client.published.get("verdict",0),
+        "elapsed":elapsed,
+        "trace_duration":records[-1]["t"] if len(records) > 0 else 0.0,
+        "messages_per_second":delivered / elapsed if elapsed > 0 else 0.0,
+        "finished":finished,
+    }
+
+def recordPayload(record):
+    if "payload_b64" in record:
+        return base64.b64decode(record["payload_b64"])
+    return record["payload"]
+
+def record(path,topics,duration=None):
+    import paho.mqtt.client as mqtt
+    start_time = time.time()
+    trace_file = open(path,"w")
+    trace_file.write(json.dumps({"trace_version":trace_version,"start_time":start_time,"topics":topics}) + "\n")
+    count = [0]
+
+    def on_connect(client,userdata,flags,rc):
+        prCyan(f"Recording {topics} to {path} (result code {rc})")
+        for topic in topics:
+            client.subscribe(topic)
+
+    def on_message(client,userdata,msg):
+        entry = {"t":time.time() - start_time,"topic":msg.topic}
+        try:
+            entry["payload"] = msg.payload.decode("utf-8")
+        except UnicodeDecodeError:
+            entry["payload_b64"] = base64.b64encode(msg.payload).decode("ascii")
+        trace_file.write(json.dumps(entry) + "\n")
+        count[0] += 1
+
+    client = mqtt.Client()
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.connect(settings["broker_IP"],settings["port_Num"],keepalive=60)
+    client.loop_start()
+    try:
+        while duration == None or time.time() - start_time < duration:
+            time.sleep(0.5)
+    except KeyboardInterrupt:
+        pass
+    client.loop_stop()
+    client.disconnect()
+    trace_file.close()
+    prGreen(f"Recorded {count[0]} messages in {time.time() - start_time:.1f}s")
+
+def parseOverrides(pairs):
+    overrides = {}
+    for pair in pairs:
+        key,value = pair.split("=",1)
+        try:
+            overrides[key] = json.loads(value)
+        except json.JSONDecodeError:
+            overrides[key] = value
+    return overrides
+
+def main():
+    parser = argparse.ArgumentParser(description="Record and replay V2B traces")
+    commands = parser.add_subparsers(dest="command",required=True)
+    record_parser = commands.add_parser("record",help="Capture live traffic into a trace file")
+    record_parser.add_argument("trace")
+    record_parser.add_argument("-t","--topics",nargs="+",default=recorded_topics)
+    record_parser.add_argument("-d","--duration",type=float,default=None,help="Stop after this many seconds (default: Ctrl+C)")
+    play_parser = commands.add_parser("play",help="Replay a trace into a broker's fusion logic, in-process")
+    play_parser.add_argument("trace")
+    play_parser.add_argument("-b","--broker",default="consolidated",help=f"One of {list(brokers.keys())}, or a module name")
+    play_parser.add_argument("-s","--speed",type=float,default=1.0,help="1 = recorded timing, N = N times faster, 0 = as fast as possible")
+    play_parser.add_argument("-id",default="replay",help="Test ID used for the broker's output files")
+    play_parser.add_argument("--set",nargs="*",default=[],metavar="KEY=VALUE",help="Override server_config settings, e.g. ingest_mode=mailbox")
+    play_parser.add_argument("--linger",type=float,default=0.0,help="Seconds to keep a threaded broker running after the last message")
+    play_parser.add_argument("--verbose",action="store_true",help="Show the broker's console output")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        record(args.trace,args.topics,args.duration)
+        return
+
+    header,records = loadTrace(args.trace)
+    module = loadBroker(args.broker,args.id,parseOverrides(args.set))
+    stats = replayTrace(module,header,records,args.speed,quiet=not args.verbose,linger=args.linger)
+    prGreen(f"Replayed {stats['messages']}/{len(records)} messages ({stats['trace_duration']:.1f}s of trace) in {stats['elapsed']:.2f}s")
+    print(f"Throughput: {getYellow(round(stats['messages_per_second'],1))} msg/s, verdicts published: {getYellow(stats['verdicts'])}")
+    if stats["finished"]:
+        prCyan("The broker finished its experiment before the end of the trace")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+# reputation_fusion.py
+# Weighted object fusion: every client's vote for a label counts calibrated confidence x distance weight x reputation.
+#
+# Each client's newest object_list is written into a dense (objects, clients, labels) confidence array when it
+# arrives, so a verdict is a handful of array operations over the whole fleet instead of a Python loop per client,
+# and reputations are updated for every client at once after each verdict.
+# object_list entries may be {label: score} (consolidated/objects brokers) or [label, score, distance] (main_broker).
+#
+# Distance used to be weighted with 1/log(distance), which is infinite at distance 1, negative below it and
+# undefined at 0 (NoneObject's distance). safeDistanceWeight is 1 at distance 0 and falls off like 1/log(distance)
+# further away.
+import numpy as np
+from server_config import config as settings
+
+min_confidence = 1e-6 # Confidences are clipped into [min_confidence, 1 - min_confidence] before calibration
+
+def safeDistanceWeight(distance):
+    distance = np.nan_to_num(np.asarray(distance,dtype=np.float64),nan=0.0)
+    return 1.0 / np.log(np.e + np.maximum(distance,0.0))
+
+class ObjectFusion:
+    def __init__(self,object_ids,calibration=None,capacity=64,label_capacity=16):
+        # calibration: {label: [scale, bias]}. A label's confidence p becomes sigmoid(scale*logit(p) + bias).
+        # Labels without an entry are used as reported
+        self.object_ids = list(object_ids)
+        self.object_index = {object_id:i for i,object_id in enumerate(self.object_ids)}
+        self.calibration = dict(calibration or {})
+        self.labels = []
+        self.label_index = {}
+        self.client_rows = {} # client name -> row
+        self.free_rows = []
+        self.rows = 0 # Rows in use, including freed ones
+        objects = len(self.object_ids)
+        self.confidence = np.zeros((objects,capacity,label_capacity),dtype=np.float32) # 0 = not reported
+        self.distance = np.zeros((objects,capacity),dtype=np.float32)
+        self.timestamps = np.full(capacity,-np.inf)
+        self.reputation = np.full(capacity,0.5)
+        self.active = np.zeros(capacity,dtype=bool)
+        self.scale = np.ones(label_capacity,dtype=np.float32)
+        self.bias = np.zeros(label_capacity,dtype=np.float32)
+        self.last_verdict = np.full(objects,-1) # Winning label column per object, -1 = no verdict
+        self.last_calibrated = None
+
+    def growClients(self):
+        extra = self.confidence.shape[1] # Double the capacity
+        self.confidence = np.concatenate([self.confidence,np.zeros_like(self.confidence)],axis=1)
+        self.distance = np.concatenate([self.distance,np.zeros_like(self.distance)],axis=1)
+        self.timestamps = np.concatenate([self.timestamps,np.full(extra,-np.inf)])
+        self.reputation = np.concatenate([self.reputation,np.full(extra,0.5)])
+        self.active = np.concatenate([self.active,np.zeros(extra,dtype=bool)])
+
+    def growLabels(self):
+        capacity = self.confidence.shape[2]
+        self.confidence = np.concatenate([self.confidence,np.zeros_like(self.confidence)],axis=2)
+        self.scale = np.concatenate([self.scale,np.ones(capacity,dtype=np.float32)])
+        self.bias = np.concatenate([self.bias,np.zeros(capacity,dtype=np.float32)])
+
+    def setObjects(self,object_ids):
+        # A new object list (after a config reload). Clients and reputations stay, their frames start over
+        if list(object_ids) == self.object_ids:
+            return
+        self.object_ids = list(object_ids)
+        self.object_index = {object_id:i for i,object_id in enumerate(self.object_ids)}
+        self.confidence = np.zeros((len(self.object_ids),) + self.confidence.shape[1:],dtype=np.float32)
+        self.distance = np.zeros((len(self.object_ids),self.distance.shape[1]),dtype=np.float32)
+        self.last_verdict = np.full(len(self.object_ids),-1)
+
+    def labelColumn(self,label):
+        if label not in self.label_index:
+            if len(self.labels) == self.confidence.shape[2]:
+                self.growLabels()
+            column = len(self.labels)
+            self.labels.append(label)
+            self.label_index[label] = column
+            self.scale[column],self.bias[column] = self.calibration.get(label,(1.0,0.0))
+        return self.label_index[label]
+
+    def clientRow(self,client_name):
+        if client_name not in self.client_rows:
+            if len(self.free_rows) > 0:
+                row = self.free_rows.pop()
+            else:
+                if self.rows == self.confidence.shape[1]:
+                    self.growClients()
+                row = self.rows
+                self.rows += 1
+            self.client_rows[client_name] = row
+            self.active[row] = True
+            self.reputation[row] = 0.5
+        return self.client_rows[client_name]
+
+    def setFrame(self,client_name,object_list,timestamp):
+        row = self.clientRow(client_name)
+        self.confidence[:,row,:] = 0
+        self.distance[:,row] = 0
+        for object_id,entry in object_list.items():
+            o = self.object_index.get(object_id)
+            if o == None or entry == None:
+                continue
+            # labelColumn may grow self.confidence, so look the column up before indexing
+            if isinstance(entry,dict):
+                for label,score in entry.items():
+                    column = self.labelColumn(label)
+                    self.confidence[o,row,column] = score
+            elif entry[0] != "None":
+                column = self.labelColumn(entry[0])
+                self.confidence[o,row,column] = entry[1]
+                self.distance[o,row] = entry[2] if len(entry) > 2 else 0.0
+        self.timestamps[row] = timestamp
+
+    def removeClient(self,client_name):
+        row = self.client_rows.pop(client_name,None)
+        if row == None:
+            return
+        self.confidence[:,row,:] = 0
+        self.active[row] = False
+        self.timestamps[row] = -np.inf
+        self.free_rows.append(row)
+
+    def getReputation(self,client_name):
+        row = self.client_rows.get(client_name)
+        return float(self.reputation[row]) if row != None else 0.5
+
+    def calibrated(self):
+        # (objects, clients, labels) calibrated confidences, 0 where nothing was reported
+        raw = self.confidence[:,:self.rows,:len(self.labels)]
+        columns = np.flatnonzero((self.scale[:len(self.labels)] != 1) | (self.bias[:len(self.labels)] != 0))
+        if len(columns) == 0:
+            return raw
+        # Only the labels that have a calibration need the logit round trip
+        calibrated = raw.copy()
+        p = np.clip(raw[:,:,columns],min_confidence,1 - min_confidence)
+        adjusted = 1.0 / (1.0 + np.exp(-(self.scale[columns] * np.log(p / (1 - p)) + self.bias[columns])))
+        calibrated[:,:,columns] = np.where(raw[:,:,columns] > 0,adjusted,0)
+        return calibrated
+
+    def liveClients(self,now):
+        # Rows of clients with unexpired data
+        return self.active[:self.rows] & (self.timestamps[:self.rows] >= now - settings["oldest_allowable_data"])
+
+    def scores(self,now,calibrated=None):
+        # (objects, labels) summed weighted votes
+        if calibrated is None:
+            calibrated = self.calibrated()
+        weights = safeDistanceWeight(self.distance[:,:self.rows]) * (self.reputation[:self.rows] * self.liveClients(now))[None,:]
+        # One (1, clients) x (clients, labels) product per object
+        return np.matmul(weights.astype(np.float32)[:,None,:],calibrated)[:,0,:]
+
+    def verdicts(self,now,none_value="None"):
+        # {object_id: winning label}. none_value for objects no live client saw
+        self.last_calibrated = self.calibrated() # Reused by updateReputations
+        scores = self.scores(now,self.last_calibrated)
+        if scores.shape[1] == 0:
+            self.last_verdict = np.full(len(self.object_ids),-1)
+            return {object_id:none_value for object_id in self.object_ids}
+        best = np.argmax(scores,axis=1)
+        best[scores[np.arange(len(best)),best] <= 0] = -1
+        self.last_verdict = best
+        return {object_id:(self.labels[column] if column >= 0 else none_value) for object_id,column in zip(self.object_ids,best)}
+
+    def updateReputations(self,now):
+        # Every live client that reported an object gains reputation_increment if its top label matches the last
+        # verdict and loses reputation_decrement if not. Objects without a verdict don't count either way.
+        # Returns the number of (client, object) votes that lost
+        if self.rows == 0 or len(self.labels) == 0:
+            return 0
+        calibrated = self.last_calibrated
+        if calibrated is None or calibrated.shape[:2] != (len(self.object_ids),self.rows):
+            calibrated = self.calibrated()
+        top = calibrated.argmax(axis=2) # (objects, clients)
+        reported = np.take_along_axis(calibrated,top[:,:,None],axis=2)[:,:,0] > 0
+        decided = (self.last_verdict >= 0)[:,None]
+        agree = reported & decided & (top == self.last_verdict[:,None])
+        disagree = reported & decided & ~agree
+        change = agree.sum(axis=0) * settings["reputation_increment"] - disagree.sum(axis=0) * settings["reputation_decrement"]
+        live = self.liveClients(now)
+        self.reputation[:self.rows][live] = np.clip(self.reputation[:self.rows][live] + change[live],settings["min_reputation"],1.0)
+        return int(disagree[:,live].sum())
@@ -0,0 +1,172 @@
+# result_writer.py
+# Append-only, crash-safe experiment results.
+#
+# While the broker runs, every record (one per verdict, one per client frame, ...) is appended to a JSON Lines file
+# next to the usual output file (outputs/output_{id}.jsonl). A background thread batches the writes and fsyncs
+# every fsync_interval seconds, so a crash or kill loses at most the last few records. At the end of a run the stream
+# is folded into the existing outputs/.../output_{id}.json layout. A stream left behind by a crashed run can be
+# finalized by hand:
+#
+#   python result_writer.py outputs/output_3.jsonl                 (consolidated_broker.py results)
+#   python result_writer.py outputs/objects/output_3.jsonl objects (object_data_collection.py results)
+import argparse
+import json
+import os
+import threading
+from codec import encodeJson, decodeJson
+
+class ResultWriter:
+    def __init__(self,path,flush_interval=0.5,fsync_interval=5.0):
+        # fsync_interval: seconds between fsyncs. 0 = after every flush, None = leave it to the OS.
+        # The flush thread can be handed over to a caller that runs tick() every flush_interval itself (detach)
+        self.path = path
+        self.file = open(path,"wb") # A new run replaces the old stream, like it replaces the old output file
+        self.flush_interval = flush_interval
+        self.fsync_interval = fsync_interval
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock() # tick() and close() can come from different threads once detached
+        self.pending = []
+        self.records = 0
+        self.since_fsync = 0.0
+        self.closed = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run,name="result_writer",daemon=True)
+        self.thread.start()
+
+    def write(self,record):
+        # Called on the fusion path: encode and queue, the file is only touched by the flush thread
+        line = encodeJson(record) + b"\n"
+        with self.lock:
+            self.pending.append(line)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if len(pending) > 0:
+            self.file.write(b"".join(pending))
+            self.file.flush()
+            self.records += len(pending)
+        return len(pending)
+
+    def sync(self):
+        os.fsync(self.file.fileno())
+        self.since_fsync = 0.0
+
+    def tick(self):
+        # One flush_interval's worth of work: write what is queued, fsync when it is due
+        with self.file_lock:
+            if self.closed:
+                return 0
+            wrote = self.flush()
+            self.since_fsync += self.flush_interval
+            if wrote > 0 and self.fsync_interval != None and self.since_fsync >= self.fsync_interval:
+                self.sync()
+        return wrote
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.tick()
+
+    def detach(self):
+        # Stop the flush thread. The caller runs tick() from now on (broker_core.py does, from its event loop)
+        self.stopped.set()
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def close(self):
+        self.stopped.set()
+        if self.thread != None and self.thread is not threading.current_thread():
+            self.thread.join()
+        with self.file_lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.flush()
+            if self.fsync_interval != None:
+                self.sync()
+            self.file.close()
+
+def readRecords(path):
+    # Yields the records in a stream. A torn last line (the writer was killed mid-write) is skipped
+    with open(path,"rb") as stream:
+        for line in stream:
+            if not line.endswith(b"\n"):
+                break
+            yield decodeJson(line)
+
+def writerFromSettings(settings,path):
+    return ResultWriter(path,settings["result_flush_interval"],settings["result_fsync_interval"])
+
+def finalizeConsolidated(stream_path,output_path):
+    # Rebuilds consolidated_broker.py's output file:
+    # {"plate_history":[...],"object_history":[...],"config":{...},"client_reports":{name:{"plates":[...],"objects":[...]}}}
+    config = {}
+    plate_history = []
+    object_history = []
+    client_reports = {}
+    clients = None
+    for record in readRecords(stream_path):
+        kind = record["type"]
+        if kind == "header" or kind == "config":
+            config = record["config"] # A reloaded config replaces the one the run started with
+        elif kind == "verdict":
+            plate_history.append(record["plates"])
+            object_history.append(record["objects"])
+        elif kind == "outcomes":
+            for name,(plates,objects) in record["clients"].items():
+                report = client_reports.setdefault(name,{"plates":[],"objects":[]})
+                report["plates"].append(plates)
+                report["objects"].append(objects)
+        elif kind == "end":
+            clients = record["clients"]
+    # The in-memory histories only ever held the last max_decision_history values
+    keep = config.get("max_decision_history",len(plate_history))
+    if clients == None:
+        clients = sorted(client_reports.keys()) # The run never finished, report everyone we heard from
+    empty = {"plates":[],"objects":[]}
+    with open(output_path,"w") as output_file:
+        output_file.write(json.dumps({
+            "plate_history":plate_history[-keep:],
+            "object_history":object_history[-keep:],
+            "config":config,
+            "client_reports":{name:{key:values[-keep:] for key,values in client_reports.get(name,empty).items()} for name in clients},
+        }))
+
+def finalizeObjects(stream_path,output_path):
+    # Rebuilds object_data_collection.py's output file:
+    # {"object_locations":{...},"vehicle_locations":{...},"raw_data":{name:[object_list,...]},"config":{...},"test_id":...}
+    header = {}
+    raw_data = {}
+    for record in readRecords(stream_path):
+        if record["type"] == "header":
+            header = record
+        elif record["type"] == "config":
+            header = dict(header,**record) # A reloaded config replaces the one the run started with
+        elif record["type"] == "raw":
+            raw_data.setdefault(record["name"],[]).append(record["objects"])
+    with open(output_path,"w") as output_file:
+        output_file.write(json.dumps({
+            "object_locations":header.get("object_locations"),
+            "vehicle_locations":header.get("vehicle_locations"),
+            "raw_data":raw_data,
+            "config":header.get("config"),
+            "test_id":header.get("test_id"),
+        }))
+
+def main():
+    parser = argparse.ArgumentParser(description="Turn a result stream into the usual output JSON file")
+    parser.add_argument("stream",help="outputs/output_{id}.jsonl or outputs/objects/output_{id}.jsonl")
+    parser.add_argument("kind",nargs="?",choices=["consolidated","objects"],default="consolidated")
+    parser.add_argument("-o","--output",default=None,help="Output file (default: the stream's path with .json)")
+    args = parser.parse_args()
+    output_path = args.output or os.path.splitext(args.stream)[0] + ".json"
+    if args.kind == "objects":
+        finalizeObjects(args.stream,output_path)
+    else:
+        finalizeConsolidated(args.stream,output_path)
+    print(f"Wrote {output_path}")
+
+if __name__ == "__main__":
+    main()
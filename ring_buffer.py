@@ -0,0 +1,74 @@
+# ring_buffer.py
+import numpy as np
+
+class RingBuffer:
+    # Fixed-capacity history of floats, backed by a NumPy array.
+    # Appending is O(1) (the oldest value is overwritten once full), and the running sums make mean/variance O(1) too.
+    def __init__(self,capacity):
+        if capacity < 1:
+            raise ValueError("Ring buffer capacity must be at least 1")
+        self.capacity = capacity
+        self.data = np.zeros(capacity,dtype=np.float64)
+        self.start = 0 # Index of the oldest value
+        self.count = 0
+        self.total = 0.0
+        self.total_sq = 0.0
+        self.appends = 0
+
+    def append(self,value):
+        value = float(value)
+        if self.count == self.capacity:
+            old = self.data[self.start]
+            self.total -= old
+            self.total_sq -= old*old
+            self.data[self.start] = value
+            self.start = (self.start + 1) % self.capacity
+        else:
+            self.data[self.count] = value
+            self.count += 1
+        self.total += value
+        self.total_sq += value*value
+        # Adding and subtracting floats slowly drifts, so recompute the sums from scratch once per lap
+        self.appends += 1
+        if self.appends % self.capacity == 0:
+            valid = self.data[:self.count]
+            self.total = float(valid.sum())
+            self.total_sq = float(np.dot(valid,valid))
+
+    def mean(self):
+        if self.count == 0:
+            return float("nan")
+        return self.total / self.count
+
+    def var(self):
+        if self.count == 0:
+            return float("nan")
+        mean = self.total / self.count
+        return max(0.0,self.total_sq / self.count - mean*mean)
+
+    def std(self):
+        return np.sqrt(self.var())
+
+    def last(self):
+        # The newest value
+        if self.count == 0:
+            return float("nan")
+        return float(self.data[(self.start + self.count - 1) % self.capacity])
+
+    def values(self):
+        # Copy of the contents, oldest first
+        if self.count < self.capacity:
+            return self.data[:self.count].copy()
+        return np.concatenate((self.data[self.start:],self.data[:self.start]))
+
+    def tolist(self):
+        return self.values().tolist()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter(self.tolist())
+
+    def __repr__(self):
+        return f"RingBuffer({self.tolist()})"
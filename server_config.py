@@ -7,4 +7,38 @@ config = {
     "reputation_increment": 0.005, # Amount to increment or decrement client reputation by when they make a right decision
     "reputation_decrement": 0.010, # Amount to decrement client reputation by when they make a wrong decision
     "min_reputation": 0.35, # Minimum reputation value
+    "plate_assignment": "greedy", # "greedy" = the original evict-and-retry stack, "optimal" = minimum total distance plate-to-spot assignment (see plate_assignment.py: milliseconds per verdict for small lots, but a crowded lot of hundreds of spots can take hundreds of ms without scipy)
+    "max_plate_distance": None, # Plates farther than this from every free spot stay unassigned (None = no limit). Only used by "optimal"
+    "verdict_trigger": "message", # "message" = verdict when V2B data arrives and verdict_min_refresh_time has passed, "scheduled" = fixed-rate verdicts
+    "verdict_rate": 20, # Target verdicts per second when verdict_trigger is "scheduled"
+    "verdict_when_all_reported": False, # When scheduled, also fire a verdict as soon as every live client has reported since the last one
+    "fusion_mode": "batch", # "batch" = rebuild the tallies from every client's decision each verdict, "incremental" = keep running tallies (see incremental_fusion.py)
+    "object_fusion": "sum", # "sum" = plain sum of label scores, "weighted" = confidence x distance x reputation weighted votes (see reputation_fusion.py)
+    "confidence_calibration": {}, # Per-label [scale, bias] applied to detector confidences in logit space, e.g. {"person": [0.8, 0.0]}
+    "temporal_window": 1, # Verdicts each spot/object verdict is voted over (see temporal_fusion.py). 1 = every verdict stands alone
+    "temporal_decay": 0.8, # Weight a temporal vote keeps per verdict, so newer verdicts count more
+    "ingest_mode": "inline", # "inline" = fuse on the MQTT network thread, "queued" = hand frames to a separate fusion worker thread,
+                             # "mailbox" = like "queued", but only the newest frame per vehicle is kept (undecoded) until fusion time
+    "ingest_queue_size": 256, # Max number of data frames waiting for the fusion worker (queued mode only)
+    "ingest_drop_policy": "coalesce", # What to do when the ingest queue is full: "drop_oldest", "drop_newest", or "coalesce" (keep newest frame per vehicle)
+    "verdict_publish_mode": "full", # "full" = every verdict carries every spot and object, "delta" = only what changed, plus keyframes (see verdict_delta.py)
+    "verdict_keyframe_interval": 50, # In delta mode, send the full verdict at least once every this many verdicts
+    "dashboard_mode": "threaded", # Console output: "threaded" = redrawn by its own thread at dashboard_rate, "inline" = redrawn after every verdict, "off"
+    "dashboard_rate": 4, # Max dashboard redraws per second in "threaded" mode
+    "result_flush_interval": 0.5, # Seconds between writes of the result stream (outputs/.../output_{id}.jsonl)
+    "result_fsync_interval": 5.0, # Seconds between fsyncs of the result stream. 0 = every write, None = leave it to the OS
+    "archive_results": False, # Also export each finished run's output file as a columnar archive in outputs/archive (see archive.py)
+    "partition_virtual_nodes": 64, # Points per replica on partitioned_broker.py's hash ring. More = a more even split of the vehicles
+    "partition_heartbeat": 1.0, # Seconds between partitioned_broker.py replica heartbeats (partition/hello)
+    "partition_timeout": 3.0, # A replica that has been silent this long is dropped from the ring and from the merged verdict
+    "config_reload": "off", # "watch" = pick up edits to the client config file while running (see config_model.py), "off" = only on broker_control
+    "config_reload_interval": 1.0, # Seconds between checks of the client config file when config_reload is "watch"
+    "wire_format": "json", # Preferred verdict format: "json", "msgpack" or "packed". Only used while every client accepts it (see codec.py)
+    "metrics_port": 0, # Stage timings, message counts and data age as Prometheus text on http://127.0.0.1:<port>/metrics (see metrics.py). 0 = off. Give each broker running on the same host its own port, e.g. 9108
+    "metrics_interval": 5.0, # Seconds between summaries on the metrics topic. 0 = off
+    "clock_sync_interval": 10.0, # Seconds between clock_ping messages to estimate each vehicle's clock offset (see clock_sync.py). 0 = off, vehicle clocks are taken as already synced
+    "staleness_clock": "arrival", # What oldest_allowable_data is measured from: "arrival" = when a frame reached the broker, "capture" = when the vehicle captured it
+    "profile_duration": 30.0, # Seconds a start_profile command samples for, unless it asks for a duration (see profiler.py)
+    "profile_max_duration": 600.0, # Longest profile a start_profile command can ask for
+    "profile_interval": 0.005, # Seconds between profiler samples
 }
\ No newline at end of file
@@ -0,0 +1,41 @@
+# spot_index.py
+import numpy as np
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None # Optional, only used for big lots
+
+kd_tree_min_spots = 128 # Lots with at least this many spots get a KD-tree (if scipy is installed)
+
+def positionArray(positions):
+    # [{'x':..,'y':..}, ...] -> (N,2) float array
+    return np.array([(pos['x'],pos['y']) for pos in positions],dtype=np.float64).reshape(-1,2)
+
+class SpotIndex:
+    # Parking spot (or object) coordinates, loaded once into a contiguous (N,2) array.
+    # Answers "which spot is closest to this position" for one position or a whole frame's worth at once.
+    def __init__(self,locations):
+        self.coords = np.ascontiguousarray(positionArray(locations))
+        self.tree = None
+        if cKDTree != None and len(self.coords) >= kd_tree_min_spots:
+            self.tree = cKDTree(self.coords)
+
+    def __len__(self):
+        return len(self.coords)
+
+    def nearestMany(self,positions):
+        # positions: (K,2) array or a list of {'x','y'} dicts. Returns a (K,) array of spot indices.
+        # Ties go to the lowest spot index, like the old getClosestObject loop.
+        if not isinstance(positions,np.ndarray):
+            positions = positionArray(positions)
+        if len(positions) == 0:
+            return np.zeros(0,dtype=np.intp)
+        if self.tree != None:
+            return self.tree.query(positions)[1]
+        dx = positions[:,0,None] - self.coords[None,:,0]
+        dy = positions[:,1,None] - self.coords[None,:,1]
+        return np.argmin(dx*dx + dy*dy,axis=1)
+
+    def nearest(self,pos):
+        return int(self.nearestMany(np.array([[pos['x'],pos['y']]],dtype=np.float64))[0])
@@ -0,0 +1,200 @@
+# temporal_fusion.py
+# Temporal smoothing of verdicts: each spot's plate and each object's label is a decayed vote over the last `window`
+# single-frame verdicts, instead of whatever the newest frames happened to say. One bad frame no longer flips a spot.
+#
+# The votes live in a (slots, candidates) NumPy array. Every verdict decays it, adds the new verdict's votes, and takes
+# back the vote that just left the window, so a verdict costs O(slots) no matter how long the window is. Candidates
+# nobody in the window voted for give their column back, so the array only grows with the candidates in the window.
+# A plate can only win one spot: when smoothing makes two spots agree on a plate, the spot with more votes for it
+# keeps it, and the other one falls back to its next best candidate.
+#
+#   python temporal_fusion.py trace.jsonl --window 5 --decay 0.8
+# replays a trace (see replay.py, or make one with `python load_generator.py --transport trace -o trace.jsonl`) through
+# consolidated_broker.py with and without smoothing, and compares accuracy, verdict flips and time per verdict.
+import argparse
+import multiprocessing
+import os
+import time
+import numpy as np
+
+class VoteWindow:
+    # Decayed votes over the last `window` inputs, for a fixed number of slots
+    def __init__(self,slots,window,decay):
+        self.slots = slots
+        self.window = window
+        self.decay = decay
+        self.tail = decay ** window # What a vote is worth by the time it leaves the window
+        self.values = [None] * 8 # column -> the candidate (plate text, label, NoneObject, ...), None for a free column
+        self.columns = {} # str(candidate) -> column
+        self.free = list(range(7,-1,-1)) # Unused columns, lowest last
+        self.votes = np.zeros((slots,8))
+        self.recent = np.full((window,slots),-1,dtype=np.intp) # Ring of the columns voted for by the last inputs
+        self.position = 0
+        self.count = 0
+        self.rows = np.arange(slots)
+        self.winners = np.zeros(slots,dtype=np.intp)
+
+    def column(self,value):
+        key = str(value)
+        if key not in self.columns:
+            if len(self.free) == 0:
+                width = self.votes.shape[1]
+                self.votes = np.concatenate([self.votes,np.zeros_like(self.votes)],axis=1)
+                self.values.extend([None] * width)
+                self.free = list(range(2*width-1,width-1,-1))
+            column = self.free.pop()
+            self.columns[key] = column
+            self.values[column] = value
+        return self.columns[key]
+
+    def prune(self,keep):
+        # Frees the columns of the candidates nobody in the window voted for, other than `keep`. Their votes have left
+        # the window (the tail is taken back as they do), so all that is left of them is rounding error
+        live = np.zeros(self.votes.shape[1],dtype=bool)
+        live[self.recent[self.recent >= 0]] = True
+        for key,column in list(self.columns.items()):
+            if not live[column] and key not in keep:
+                del self.columns[key]
+                self.values[column] = None
+                self.votes[:,column] = 0.0
+                self.free.append(column)
+        self.free.sort(reverse=True)
+
+    def add(self,values):
+        # values: one candidate per slot. Returns the winning candidate per slot
+        keys = set(str(value) for value in values)
+        if sum(1 for key in keys if key not in self.columns) > len(self.free):
+            self.prune(keys)
+        columns = np.array([self.column(value) for value in values],dtype=np.intp)
+        self.votes *= self.decay
+        if self.count == self.window:
+            self.votes[self.rows,self.recent[self.position]] -= self.tail
+        self.votes[self.rows,columns] += 1.0
+        self.recent[self.position] = columns
+        self.position = (self.position + 1) % self.window
+        self.count = min(self.count + 1,self.window)
+        self.winners = np.argmax(self.votes,axis=1)
+        return [self.values[column] for column in self.winners]
+
+    def distinct(self,shared):
+        # The winners of the last add(), with no candidate winning more than one slot (`shared`, e.g. "EMPTY", may).
+        # Slots pick in order of how many votes their winner has, each taking its best candidate that is still free,
+        # or `shared` if there is none
+        shared_column = self.columns.get(str(shared),-1)
+        counts = np.bincount(self.winners,minlength=self.votes.shape[1])
+        if shared_column >= 0:
+            counts[shared_column] = 0
+        if counts.max(initial=0) <= 1:
+            return [self.values[column] for column in self.winners]
+        minimum = self.tail / 2 # Below any vote still in the window, above the rounding error left by the ones that left
+        taken = set()
+        result = [shared] * self.slots
+        for slot in np.argsort(-self.votes[self.rows,self.winners],kind="stable"):
+            for column in np.argsort(-self.votes[slot],kind="stable"):
+                if self.votes[slot,column] < minimum:
+                    break
+                if column == shared_column:
+                    break
+                if column not in taken:
+                    taken.add(column)
+                    result[slot] = self.values[column]
+                    break
+        return result
+
+class TemporalFusion:
+    def __init__(self,window,decay):
+        self.window = window
+        self.decay = decay
+        self.spot_ids = None
+        self.object_ids = None
+
+    def reset(self,spot_ids,object_ids):
+        self.spot_ids = spot_ids
+        self.object_ids = object_ids
+        self.plates = VoteWindow(len(spot_ids),self.window,self.decay)
+        self.objects = VoteWindow(len(object_ids),self.window,self.decay)
+
+    def smooth(self,verdicts):
+        # Single-frame verdicts in, smoothed verdicts out (same layout)
+        spot_ids = list(verdicts["plates"].keys())
+        object_ids = list(verdicts["objects"].keys())
+        if spot_ids != self.spot_ids or object_ids != self.object_ids:
+            self.reset(spot_ids,object_ids) # First verdict, or the lot changed (config reload)
+        self.plates.add(list(verdicts["plates"].values()))
+        return {
+            "plates":dict(zip(spot_ids,self.plates.distinct("EMPTY"))),
+            "objects":dict(zip(object_ids,self.objects.add(list(verdicts["objects"].values())))),
+        }
+
+def temporalFromSettings(settings):
+    if settings["temporal_window"] <= 1:
+        return None
+    return TemporalFusion(settings["temporal_window"],settings["temporal_decay"])
+
+def countFlips(verdict_list):
+    # Number of times any spot or object changed its verdict between consecutive verdicts
+    flips = 0
+    for before,after in zip(verdict_list,verdict_list[1:]):
+        for kind in ("plates","objects"):
+            flips += sum(1 for key,value in after[kind].items() if before[kind].get(key) != value)
+    return flips
+
+def identityAccuracy(verdict_list,object_identities):
+    # Mean share of objects whose verdict is one of the object's identities. verdictAccuracy compares the label with the
+    # whole object entry from the config, so the broker's own object accuracy is always 0
+    if len(verdict_list) == 0:
+        return 0.0
+    return float(np.mean([np.mean([value in object_identities.get(key,()) for key,value in verdict["objects"].items()]) for verdict in verdict_list]))
+
+def runVariant(trace_path,overrides,results):
+    # Runs in its own process, so every variant starts from a freshly imported broker
+    import replay
+    from codec import decode
+    header,records = replay.loadTrace(trace_path)
+    module = replay.loadBroker("consolidated","temporal_eval",dict(overrides,dashboard_mode="off"))
+    timings = []
+    getVerdict = module.getVerdict
+    def timedVerdict():
+        start = time.perf_counter()
+        getVerdict()
+        timings.append(time.perf_counter() - start)
+    module.getVerdict = timedVerdict
+    verdicts = []
+    replay.replayTrace(module,header,records,speed=0,on_publish=lambda topic,payload: verdicts.append(decode(payload)["message"]) if topic == "verdict" else None)
+    for path in ("outputs/output_temporal_eval.json","outputs/output_temporal_eval.jsonl"):
+        if os.path.exists(path):
+            os.remove(path)
+    results.put({
+        "verdicts":len(verdicts),
+        "plate_accuracy":module.plate_history.mean(),
+        "plate_accuracy_std":module.plate_history.std(),
+        "object_accuracy":identityAccuracy(verdicts,module.lot_config.object_identities),
+        "flips":countFlips(verdicts),
+        "latency_p50":float(np.percentile(timings,50)) if len(timings) > 0 else 0.0,
+        "latency_p99":float(np.percentile(timings,99)) if len(timings) > 0 else 0.0,
+    })
+
+def compareOnTrace(trace_path,window,decay,extra=None):
+    # [(name, results)] for the single-frame baseline and the smoothed variant
+    variants = [("single frame",{"temporal_window":1}),(f"window {window}, decay {decay}",{"temporal_window":window,"temporal_decay":decay})]
+    compared = []
+    for name,overrides in variants:
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=runVariant,args=(trace_path,dict(extra or {},**overrides),results))
+        worker.start()
+        compared.append((name,results.get()))
+        worker.join()
+    return compared
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare temporally smoothed verdicts with single-frame verdicts on a trace")
+    parser.add_argument("trace")
+    parser.add_argument("--window",type=int,default=5,help="Verdicts per vote window")
+    parser.add_argument("--decay",type=float,default=0.8,help="Weight kept by a vote per verdict")
+    args = parser.parse_args()
+    print(f"{'variant':>26} {'verdicts':>9} {'plates':>8} {'std':>7} {'objects':>8} {'flips':>6} {'p50 (ms)':>9} {'p99 (ms)':>9}")
+    for name,r in compareOnTrace(args.trace,args.window,args.decay):
+        print(f"{name:>26} {r['verdicts']:>9} {r['plate_accuracy']*100:>7.2f}% {r['plate_accuracy_std']*100:>6.2f}% {r['object_accuracy']*100:>7.2f}% {r['flips']:>6} {r['latency_p50']*1000:>9.3f} {r['latency_p99']*1000:>9.3f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# vehicle_mailbox.py
+import json
+from codec import decode
+import re
+import threading
+from collections import defaultdict as dd
+
+# Finds the top-level "source" field of a raw V2B frame without parsing the rest of it. Vehicles send it as the last
+# key, and a string value followed by the closing brace of the whole payload can only belong to the outermost object
+string_pattern = rb'"((?:[^"\\]|\\.)*)"'
+trailing_source_pattern = re.compile(rb'"source"\s*:\s*' + string_pattern + rb'\s*}\s*$')
+# Otherwise: walk the strings and brackets (skipping everything else) to find "source" at depth 1
+token_pattern = re.compile(string_pattern + rb'\s*(:)?|[{}\[\]]')
+value_pattern = re.compile(rb'\s*' + string_pattern)
+
+def findTopLevelSource(raw):
+    depth = 0
+    for token in token_pattern.finditer(raw):
+        first = raw[token.start()]
+        if first == 0x7b or first == 0x5b: # { [
+            depth += 1
+        elif first == 0x7d or first == 0x5d: # } ]
+            depth -= 1
+        elif depth == 1 and token.group(2) != None and token.group(1) == b"source":
+            return value_pattern.match(raw,token.end())
+    return None
+
+def peekSource(raw):
+    match = trailing_source_pattern.search(raw)
+    if match == None and raw.lstrip()[:1] == b"{":
+        match = findTopLevelSource(raw)
+    if match == None:
+        # Not JSON, or "source" isn't a string. Fall back to a full parse
+        return decode(raw).get("source")
+    source = match.group(1)
+    if b"\\" in source:
+        return json.loads(b'"' + source + b'"')
+    return source.decode("utf-8")
+
+class VehicleMailbox:
+    # One slot per vehicle, holding only the newest raw (undecoded) V2B frame.
+    # A burst of frames between two verdicts costs one json.loads at fusion time instead of one per frame.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.slots = {} # source -> (raw bytes, receive time)
+        self.received = dd(int) # source -> number of frames posted, for the vehicles still here
+        self.superseded = dd(int) # source -> number of frames overwritten before anyone read them
+        self.received_total = 0 # The same over the whole run, including vehicles that left
+        self.superseded_total = 0
+
+    def post(self,source,raw,receive_time):
+        with self.lock:
+            if source in self.slots:
+                self.superseded[source] += 1
+                self.superseded_total += 1
+            self.slots[source] = (raw,receive_time)
+            self.received[source] += 1
+            self.received_total += 1
+
+    def collect(self):
+        # Take the newest frame from every vehicle that posted since the last collect
+        with self.lock:
+            slots = self.slots
+            self.slots = {}
+        return slots
+
+    def discard(self,source):
+        # Drop the vehicle's unread frame and its counters. Called when its end_client is applied, so a frame from
+        # before it left can't bring it back at the next fusion
+        with self.lock:
+            self.slots.pop(source,None)
+            self.received.pop(source,None)
+            self.superseded.pop(source,None)
+
+    def getCounters(self,source):
+        with self.lock:
+            return self.received.get(source,0), self.superseded.get(source,0)
+
+    def getReport(self):
+        with self.lock:
+            received = self.received_total
+            superseded = self.superseded_total
+        return f"Mailbox: {received} frames received, {superseded} superseded unread ({(superseded/received*100) if received > 0 else 0:.1f}%)"
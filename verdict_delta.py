@@ -0,0 +1,83 @@
+# verdict_delta.py
+# Delta-encoded verdict publishing.
+#
+# In "delta" mode a verdict message only carries the spots and objects whose consensus changed:
+#   {"message":{"plates":{"3":"ABC123"},"objects":{}},"seq":42,"base":41,"keyframe":false}
+# seq is the verdict_id, base is the seq of the previous verdict message. A client that applied `base` can apply this
+# one; a client that missed a message waits for the next keyframe (the full table, "keyframe":true), which goes out
+# every keyframe_interval verdicts and whenever a client joins. Unchanged verdicts are not sent at all.
+# Entries that are no longer in the verdict (e.g. an object that left the lot) are listed by key path:
+#   {"message":{"plates":{},"objects":{}},"removed":[["objects","o3"]],"seq":43,"base":42,"keyframe":false}
+# Every keyframe is also kept as a retained message on snapshot_topic, so a vehicle connecting mid-run gets the
+# latest one from the MQTT broker right away, and applies deltas from the next keyframe on.
+snapshot_topic = "verdict_snapshot"
+
+def diffTables(old,new,removed,path=()):
+    # The entries of `new` that differ from `old`. Nested tables (consolidated_broker.py's plates/objects) are diffed
+    # one level down, and kept in the result even when empty so the message keeps its shape. Keys of `old` that are
+    # gone from `new` are appended to `removed` as key paths
+    changes = {}
+    changed = False
+    for key,value in new.items():
+        if isinstance(value,dict):
+            old_value = old.get(key)
+            changes[key],sub_changed = diffTables(old_value if isinstance(old_value,dict) else {},value,removed,path + (key,))
+            changed = changed or sub_changed
+        elif key not in old or old[key] != value:
+            changes[key] = value
+            changed = True
+    for key in old:
+        if key not in new:
+            removed.append(list(path) + [key])
+            changed = True
+    return changes,changed
+
+class VerdictPublisher:
+    # Turns each verdict into the (topic, message, retain) tuples to publish
+    def __init__(self,mode="full",keyframe_interval=50):
+        if mode not in ("full","delta"):
+            raise ValueError(f"Unknown verdict publish mode: {mode}")
+        self.mode = mode
+        self.keyframe_interval = max(1,keyframe_interval)
+        self.last_verdicts = None # What clients have been told so far
+        self.last_seq = None
+        self.since_keyframe = 0
+        self.force_keyframe = True
+        self.sent = {"keyframes":0,"deltas":0,"skipped":0}
+
+    def requestKeyframe(self):
+        # e.g. a client just joined
+        self.force_keyframe = True
+
+    def messages(self,seq,verdicts):
+        if self.mode == "full":
+            return [("verdict",{"message":verdicts},False)]
+        self.since_keyframe += 1
+        if self.force_keyframe or self.last_verdicts == None or self.since_keyframe >= self.keyframe_interval:
+            self.force_keyframe = False
+            self.since_keyframe = 0
+            self.sent["keyframes"] += 1
+            message = {"message":verdicts,"seq":seq,"keyframe":True}
+            self.last_verdicts = verdicts
+            self.last_seq = seq
+            # Only keyframes replace the retained snapshot. Re-sending the whole table with every delta would cost
+            # more than sending full verdicts
+            return [("verdict",message,False),(snapshot_topic,message,True)]
+        removed = []
+        changes,changed = diffTables(self.last_verdicts,verdicts,removed)
+        if not changed:
+            self.sent["skipped"] += 1
+            return []
+        self.sent["deltas"] += 1
+        message = {"message":changes,"seq":seq,"base":self.last_seq,"keyframe":False}
+        if len(removed) > 0:
+            message["removed"] = removed
+        self.last_verdicts = verdicts
+        self.last_seq = seq
+        return [("verdict",message,False)]
+
+    def clearSnapshot(self):
+        # An empty retained message removes the snapshot from the MQTT broker, so the next run doesn't start from it
+        if self.mode == "full":
+            return []
+        return [(snapshot_topic,None,True)]
@@ -0,0 +1,111 @@
+# verdict_scheduler.py
+import threading
+import time
+from colors import *
+
+class VerdictScheduler:
+    # Keeps verdicts on a fixed-rate grid driven by the monotonic clock.
+    # If a verdict takes longer than its slot, the slots it ate into are skipped (and counted) instead of firing a burst
+    # of back-to-back verdicts to catch up. Optionally, a verdict fires early once `ready()` says every live client has reported.
+    def __init__(self,rate,ready=None):
+        if rate <= 0:
+            raise ValueError("Verdict rate must be positive")
+        self.period = 1.0 / rate
+        self.ready = ready
+        self.next_slot = time.monotonic() + self.period
+        # Metrics
+        self.verdicts = 0
+        self.early_verdicts = 0
+        self.overruns = 0
+        self.skipped_slots = 0
+        self.last_duration = 0.0
+        self.max_duration = 0.0
+
+    def timeUntilNext(self):
+        return max(0.0,self.next_slot - time.monotonic())
+
+    def isDue(self):
+        if time.monotonic() >= self.next_slot:
+            return True
+        return self.ready != None and self.ready()
+
+    def runSlot(self,run_verdict):
+        start = time.monotonic()
+        early = start < self.next_slot
+        try:
+            run_verdict()
+        finally:
+            end = time.monotonic()
+            self.verdicts += 1
+            self.last_duration = end - start
+            self.max_duration = max(self.max_duration,self.last_duration)
+            if early:
+                # Everyone reported before the slot came up. Restart the grid from here
+                self.early_verdicts += 1
+                self.next_slot = start + self.period
+            else:
+                self.next_slot += self.period
+            if end > self.next_slot:
+                missed = int((end - self.next_slot) / self.period) + 1
+                self.overruns += 1
+                self.skipped_slots += missed
+                self.next_slot += missed * self.period
+                prRed(f"Verdict overran its {self.period*1000:.1f}ms slot ({self.last_duration*1000:.1f}ms), skipping {missed} slot(s)")
+
+    def getReport(self):
+        return (f"Scheduler: {1/self.period:.1f} Hz, {self.verdicts} verdicts ({self.early_verdicts} early), "
+                f"{self.overruns} overruns, {self.skipped_slots} skipped slots, "
+                f"last {self.last_duration*1000:.1f}ms / max {self.max_duration*1000:.1f}ms")
+
+class SchedulerThread(threading.Thread):
+    # Runs verdicts on a VerdictScheduler for brokers that fuse on the network thread.
+    # `lock` must also be held by whoever updates client decisions
+    def __init__(self,scheduler,run_verdict,lock,on_exit=None):
+        super().__init__(name="verdict-scheduler",daemon=True)
+        self.scheduler = scheduler
+        self.run_verdict = run_verdict
+        self.lock = lock
+        self.on_exit = on_exit
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+
+    def notify(self):
+        # Called when new data arrives, so the "everyone reported" trigger is checked right away
+        self.wakeup.set()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+
+    def run(self):
+        try:
+            while not self.stopping.is_set():
+                self.wakeup.wait(self.scheduler.timeUntilNext())
+                self.wakeup.clear()
+                with self.lock:
+                    if self.scheduler.isDue():
+                        self.scheduler.runSlot(self.run_verdict)
+        except SystemExit:
+            # The broker finished its experiment (quitIfExhausted)
+            pass
+        finally:
+            self.stopping.set()
+            if self.on_exit != None:
+                self.on_exit()
+
+def schedulerThreadFor(client,scheduler,run_verdict,lock):
+    # broker_core.py's client runs scheduled verdicts as a task on its event loop. A paho client gets a thread
+    if hasattr(client,"scheduledFusion"):
+        return client.scheduledFusion(scheduler,run_verdict,lock)
+    return SchedulerThread(scheduler,run_verdict,lock,on_exit=client.disconnect)
+
+def schedulerFromSettings(settings,ready,fallback=False):
+    # Builds the scheduler described by server_config.py. With the "message" trigger there is no scheduler,
+    # unless `fallback` is set (the fusion worker always needs one), in which case it runs at verdict_min_refresh_time
+    if settings["verdict_trigger"] == "scheduled":
+        return VerdictScheduler(settings["verdict_rate"],ready if settings["verdict_when_all_reported"] else None)
+    elif settings["verdict_trigger"] != "message":
+        raise ValueError(f"Unknown verdict trigger '{settings['verdict_trigger']}', expected 'message' or 'scheduled'")
+    if fallback:
+        return VerdictScheduler(1.0/settings["verdict_min_refresh_time"])
+    return None